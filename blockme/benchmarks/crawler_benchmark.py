@@ -0,0 +1,115 @@
+"""
+End-to-end throughput benchmark for the Crawler.
+
+Starts a FakeGeth server, points a Crawler at it and at a database
+(PostgreSQL, or a throwaway SQLite file by default), crawls a fixed
+number of blocks and writes blocks/sec, transactions/sec and per-stage
+times to a JSON results file.
+"""
+import datetime
+import json
+import os
+import platform
+import subprocess
+import tempfile
+import time
+
+from blockme.benchmarks.fake_geth import FakeGeth
+from blockme.util.logging_util import get_blockme_console_logger
+from blockme.workflows.ethereum import Crawler
+
+
+def _git_revision():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'],
+            stderr=subprocess.DEVNULL).decode('utf-8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmark(blocks=2000, transactions_per_block=100, latency=0.0,
+                  db_url=None, fixture_file=None, output='bench_results.json',
+                  **crawler_kwargs):
+    """
+    Crawl `blocks` blocks from a fake geth and record the results.
+
+    blocks :: number of blocks to crawl, starting at block 1
+    transactions_per_block :: transaction density of synthetic blocks
+    latency :: seconds the fake geth waits before each response
+    db_url :: database to load into; defaults to a temporary SQLite file
+    fixture_file :: optional JSON file of recorded blocks to serve
+    output :: path of the JSON results file
+    crawler_kwargs :: passed through to Crawler (chunk_size, fetchers, ...)
+
+    Returns the results dict.
+    """
+    logger = get_blockme_console_logger()
+    if db_url is None:
+        db_url = 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'bench.db')
+
+    if fixture_file:
+        geth = FakeGeth.from_fixture_file(
+            fixture_file, latency=latency,
+            transactions_per_block=transactions_per_block)
+    else:
+        geth = FakeGeth(
+            head=blocks, latency=latency,
+            transactions_per_block=transactions_per_block)
+
+    with geth:
+        host, port = geth.url.rsplit(':', 1)
+        crawler = Crawler(
+            start=False, host=host, rpc_port=port, db_url=db_url,
+            **crawler_kwargs)
+        try:
+            crawler.max_block_geth = crawler.highest_block_eth()
+            last = min(blocks, crawler.max_block_geth)
+            ranges = crawler.database_client.get_unsynced_ranges(1, last)
+
+            logger.info(f'Benchmarking {last} blocks against {db_url}...')
+            started = time.monotonic()
+            crawler.process_ranges(ranges)
+            elapsed = time.monotonic() - started
+        finally:
+            crawler.close()
+
+    num_blocks = sum(l - f + 1 for f, l in ranges)
+    num_transactions = sum(
+        len(geth.fixtures[n]['transactions']) if n in geth.fixtures
+        else transactions_per_block
+        for f, l in ranges for n in range(f, l + 1))
+    pipeline = crawler.pipeline
+    results = {
+        'timestamp': datetime.datetime.utcnow().isoformat(),
+        'git_revision': _git_revision(),
+        'python': platform.python_version(),
+        'config': {
+            'blocks': num_blocks,
+            'transactions_per_block': transactions_per_block,
+            'latency': latency,
+            'db_dialect': db_url.split(':', 1)[0],
+            'fixture_file': fixture_file,
+            'loader': crawler.database_client.loader,
+            'chunk_size': crawler.chunk_size,
+            'batch_size': crawler.batch_size,
+            'fetchers': crawler.fetchers,
+            'decoders': crawler.decoders,
+            'max_in_flight': crawler.max_in_flight,
+            'receipts': crawler.receipts,
+        },
+        'seconds': elapsed,
+        'blocks_per_second': num_blocks / elapsed if elapsed else None,
+        'transactions_per_second': num_transactions / elapsed if elapsed else None,
+        'stage_seconds': dict(pipeline.stage_seconds) if pipeline else {},
+        'rpc_requests': geth.requests_served,
+        'rpc_calls': geth.calls_served,
+        'metrics': crawler.metrics.snapshot(),
+    }
+
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+    logger.info(
+        f"{results['blocks_per_second']:.1f} blocks/s, "
+        f"{results['transactions_per_second']:.1f} tx/s; results in {output}")
+    return results
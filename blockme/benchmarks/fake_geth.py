@@ -0,0 +1,248 @@
+"""
+A local stand-in for geth's JSON-RPC endpoint, for benchmarking.
+
+Answers `eth_blockNumber`, `eth_getBlockByNumber`, `eth_getBlockReceipts`
+and `eth_getTransactionReceipt`, both as single calls and in JSON-RPC 2.0
+batches. Blocks are either generated
+deterministically from their number or served from a fixture file of
+recorded `eth_getBlockByNumber` results.
+"""
+import json
+import random
+import threading
+import time
+
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+
+def _hex(n):
+    return hex(n)
+
+
+def _hash(rng, bits=256):
+    return '0x' + format(rng.getrandbits(bits), f'0{bits // 4}x')
+
+
+def synthetic_block(n, transactions_per_block=100):
+    """
+    Build a deterministic, realistically shaped block for block number `n`
+    with `transactions_per_block` full transaction objects.
+    """
+    rng = random.Random(n)
+    block_hash = _hash(rng)
+    transactions = []
+    for i in range(transactions_per_block):
+        transactions.append({
+            "hash": _hash(rng),
+            "nonce": _hex(rng.randrange(1 << 20)),
+            "blockHash": block_hash,
+            "blockNumber": _hex(n),
+            "transactionIndex": _hex(i),
+            "from": _hash(rng, 160),
+            "to": _hash(rng, 160),
+            "value": _hex(rng.getrandbits(64)),
+            "gas": _hex(21000),
+            "gasPrice": _hex(20 * 10 ** 9),
+            "input": "0x",
+        })
+    return {
+        "number": _hex(n),
+        "hash": block_hash,
+        "parentHash": _hash(random.Random(n - 1)) if n > 0 else '0x' + '0' * 64,
+        "nonce": _hash(rng, 64),
+        "sha3Uncles": _hash(rng),
+        "logsBloom": "0x0",
+        "transactionsRoot": _hash(rng),
+        "stateRoot": _hash(rng),
+        "receiptsRoot": _hash(rng),
+        "miner": _hash(rng, 160),
+        "difficulty": _hex(rng.getrandbits(48)),
+        "totalDifficulty": _hex(rng.getrandbits(64)),
+        "size": _hex(rng.randrange(500, 50000)),
+        "extraData": "0x",
+        "gasLimit": _hex(8000000),
+        "gasUsed": _hex(21000 * transactions_per_block),
+        "timestamp": _hex(1438269988 + 15 * n),
+        "transactions": transactions,
+        "uncles": [],
+    }
+
+
+def synthetic_receipts(block):
+    """
+    Build receipts, with zero to two logs each, for the transactions of a
+    synthetic (or recorded) block.
+    """
+    rng = random.Random(block["hash"])
+    receipts = []
+    log_index = 0
+    cumulative_gas = 0
+    for t in block["transactions"]:
+        logs = []
+        for _ in range(rng.randrange(3)):
+            logs.append({
+                "address": t["to"] or _hash(rng, 160),
+                "topics": [_hash(rng) for _ in range(rng.randrange(1, 5))],
+                "data": _hash(rng),
+                "blockNumber": block["number"],
+                "transactionHash": t["hash"],
+                "transactionIndex": t["transactionIndex"],
+                "blockHash": block["hash"],
+                "logIndex": _hex(log_index),
+                "removed": False,
+            })
+            log_index += 1
+        gas_used = int(t["gas"], 16)
+        cumulative_gas += gas_used
+        receipts.append({
+            "transactionHash": t["hash"],
+            "transactionIndex": t["transactionIndex"],
+            "blockHash": block["hash"],
+            "blockNumber": block["number"],
+            "from": t["from"],
+            "to": t["to"],
+            "cumulativeGasUsed": _hex(cumulative_gas),
+            "gasUsed": _hex(gas_used),
+            "contractAddress": None,
+            "logs": logs,
+            "logsBloom": "0x0",
+            "status": "0x1",
+            "effectiveGasPrice": t["gasPrice"],
+        })
+    return receipts
+
+
+class FakeGeth(object):
+    """
+    Serve fake chain data over HTTP on `host`:`port` (port 0 picks a free
+    port; see `url` once started).
+
+    head :: the block number returned by eth_blockNumber
+    transactions_per_block :: transactions in each synthetic block
+    latency :: seconds to sleep before answering each HTTP request
+    fixtures :: optional dict of block number -> recorded block result,
+                served instead of synthetic blocks where present
+    block_receipts :: answer eth_getBlockReceipts; when False it fails as
+                      on nodes that lack it, and receipts can only be
+                      fetched per transaction
+    """
+
+    def __init__(self, head=10000, transactions_per_block=100, latency=0.0,
+                 host='127.0.0.1', port=0, fixtures=None, block_receipts=True):
+        self.head = head
+        self.block_receipts = block_receipts
+        # Transaction hash -> block number, for eth_getTransactionReceipt
+        self.transaction_blocks = {}
+        self.transactions_per_block = transactions_per_block
+        self.latency = latency
+        self.fixtures = fixtures or {}
+        self.requests_served = 0
+        self.calls_served = 0
+        self._lock = threading.Lock()
+
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers['Content-Length']))
+                response = json.dumps(fake.handle(json.loads(body))).encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(response)))
+                self.end_headers()
+                self.wfile.write(response)
+
+            def log_message(self, format, *args):
+                pass
+
+        class Server(ThreadingMixIn, HTTPServer):
+            daemon_threads = True
+
+        self.server = Server((host, port), Handler)
+        self.thread = None
+
+    @classmethod
+    def from_fixture_file(cls, path, **kwargs):
+        """
+        Build a server from a JSON file holding a list of recorded
+        eth_getBlockByNumber results (or full responses with a "result").
+        The head defaults to the highest recorded block.
+        """
+        with open(path) as f:
+            recorded = json.load(f)
+        fixtures = {}
+        for block in recorded:
+            block = block.get("result", block)
+            fixtures[int(block["number"], 16)] = block
+        kwargs.setdefault('head', max(fixtures) if fixtures else 0)
+        return cls(fixtures=fixtures, **kwargs)
+
+    @property
+    def url(self):
+        host, port = self.server.server_address
+        return f'http://{host}:{port}'
+
+    def block(self, n):
+        """Returns block `n`, or None beyond the head."""
+        if n > self.head:
+            return None
+        if n in self.fixtures:
+            block = self.fixtures[n]
+        else:
+            block = synthetic_block(n, self.transactions_per_block)
+        for t in block["transactions"]:
+            self.transaction_blocks[t["hash"]] = n
+        return block
+
+    def _answer(self, call):
+        method = call.get("method")
+        params = call.get("params") or []
+        response = {"jsonrpc": "2.0", "id": call.get("id")}
+        if method == "eth_blockNumber":
+            response["result"] = _hex(self.head)
+        elif method == "eth_getBlockByNumber":
+            response["result"] = self.block(int(params[0], 16))
+        elif method == "eth_getBlockReceipts" and self.block_receipts:
+            block = self.block(int(params[0], 16))
+            response["result"] = synthetic_receipts(block) if block else None
+        elif method == "eth_getTransactionReceipt":
+            n = self.transaction_blocks.get(params[0])
+            receipts = synthetic_receipts(self.block(n)) if n is not None else []
+            response["result"] = next(
+                (r for r in receipts if r["transactionHash"] == params[0]), None)
+        else:
+            response["error"] = {
+                "code": -32601, "message": f"the method {method} does not exist"}
+        return response
+
+    def handle(self, payload):
+        """Answer a decoded JSON-RPC payload (a single call or a batch)."""
+        if self.latency:
+            time.sleep(self.latency)
+        calls = payload if isinstance(payload, list) else [payload]
+        with self._lock:
+            self.requests_served += 1
+            self.calls_served += len(calls)
+        if isinstance(payload, list):
+            return [self._answer(call) for call in payload]
+        return self._answer(payload)
+
+    def start(self):
+        """Serve in a background thread."""
+        self.thread = threading.Thread(
+            target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
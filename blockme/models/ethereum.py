@@ -1,7 +1,8 @@
 import datetime
 import settings
 
-from sqlalchemy import Column, String, BigInteger, DateTime, ForeignKey, Numeric
+from sqlalchemy import Column, String, BigInteger, Integer, Date, DateTime, ForeignKey, \
+    Numeric, LargeBinary, Text
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy import event
 from sqlalchemy.schema import DDL
@@ -11,6 +12,13 @@ from sqlalchemy.orm import relationship
 # db = create_engine(db_string)
 base = declarative_base()
 
+# Hashes and addresses are stored as raw bytes (BYTEA on PostgreSQL), and
+# 256-bit quantities as exact numerics wide enough for any uint256
+Hash = LargeBinary(32)
+AddressBytes = LargeBinary(20)
+Uint256 = Numeric(78, 0)
+Ether = Numeric(78, 18)
+
 
 class Block(base):
     """
@@ -42,15 +50,15 @@ class Block(base):
     __table_args__ = {"schema": settings.ETHEREUM_SCHEMA}
 
     number = Column(BigInteger, primary_key=True, autoincrement=False, index=True)
-    block_hash = Column(String(256), unique=True)
-    parent_hash = Column(String(256))
-    nonce = Column(String(256))
-    transactions_root = Column(String(256))
-    state_root = Column(String(256))
-    receipt_root = Column(String(256))
-    miner = Column(String(256))
-    difficulty = Column(String(256))
-    total_difficulty = Column(String(256))
+    block_hash = Column(Hash, unique=True)
+    parent_hash = Column(Hash)
+    nonce = Column(LargeBinary(8))
+    transactions_root = Column(Hash)
+    state_root = Column(Hash)
+    receipt_root = Column(Hash)
+    miner = Column(AddressBytes)
+    difficulty = Column(Uint256)
+    total_difficulty = Column(Uint256)
     size = Column(BigInteger)
     gas_limit = Column(BigInteger)
     gase_used = Column(BigInteger)
@@ -70,6 +78,26 @@ class Block(base):
     #     primaryjoin='Block.block_hash==Transaction.block_hash',
     #     foreign_keys='Block.block_hash')
 
+class Address(base):
+    """
+    A dimension table of every account address seen as a transaction
+    sender or recipient. Transactions reference addresses by `id`, which
+    keeps their rows and indexes narrow.
+    """
+
+    __tablename__ = 'address'
+    __table_args__ = {"schema": settings.ETHEREUM_SCHEMA}
+
+    # SQLite only autoincrements INTEGER primary keys
+    id = Column(
+        BigInteger().with_variant(Integer, 'sqlite'),
+        primary_key=True,
+        autoincrement=True
+    )
+    address = Column(AddressBytes, unique=True, nullable=False)
+    dt_inserted = Column(DateTime, default=datetime.datetime.utcnow)
+
+
 class Transaction(base):
     """
     A table representation of select fields for an ethereum transaction
@@ -92,15 +120,21 @@ class Transaction(base):
     __tablename__ = 'transaction'
     __table_args__ = {"schema": settings.ETHEREUM_SCHEMA}
 
-    db_id = Column(BigInteger, primary_key=True, autoincrement=True)
-    transaction_hash = Column(String(256), unique=True)
+    # SQLite only autoincrements INTEGER primary keys
+    db_id = Column(
+        BigInteger().with_variant(Integer, 'sqlite'),
+        primary_key=True,
+        autoincrement=True
+    )
+    transaction_hash = Column(Hash, unique=True)
     block_number = Column(BigInteger, ForeignKey(Block.number), index=True)
-    block_hash = Column(String(256), ForeignKey(Block.block_hash))
-    nonce = Column(String(256))
+    block_hash = Column(Hash, ForeignKey(Block.block_hash))
+    nonce = Column(BigInteger)
     transaction_index = Column(BigInteger)
-    sender = Column(String(256), index=True)
-    receipt = Column(String(256), index=True)
-    value = Column(Numeric(20,10))
+    sender_id = Column(BigInteger, ForeignKey(Address.id), index=True)
+    receipt_id = Column(BigInteger, ForeignKey(Address.id), index=True)
+    # In ether, exact to the wei
+    value = Column(Ether)
     gas = Column(BigInteger)
     gas_price = Column(BigInteger)
     dt_inserted = Column(
@@ -111,6 +145,231 @@ class Transaction(base):
 
     block_numbers = relationship("Block", foreign_keys='Transaction.block_number')
     block_hashes = relationship("Block", foreign_keys='Transaction.block_hash')
+    sender = relationship("Address", foreign_keys='Transaction.sender_id')
+    receipt = relationship("Address", foreign_keys='Transaction.receipt_id')
+
+
+class Receipt(base):
+    """
+    A table representation of select fields for a transaction receipt
+
+    {
+        "transactionHash": "0xefb6c796269c0d1f15fdedb5496fa196eb7fb55b601c0fa527609405519fd581",
+        "transactionIndex": "0x0",
+        "blockHash": "0xcb5cab7266694daa0d28cbf40496c08dd30bf732c41e0455e7ad389c10d79f4f",
+        "blockNumber": "0xf4241",
+        "from": "0x2a65aca4d5fc5b5c859090a6c34d164135398226",
+        "to": "0x819f4b08e6d3baa33ba63f660baed65d2a6eb64c",
+        "cumulativeGasUsed": "0x5208",
+        "gasUsed": "0x5208",
+        "contractAddress": null,
+        "logs": [...],
+        "status": "0x1",
+        "effectiveGasPrice": "0xba43b7400"
+    }
+
+    `status` is only set from Byzantium on; earlier receipts carry the
+    post-transaction state `root` instead.
+    """
+
+    __tablename__ = 'receipt'
+    __table_args__ = {"schema": settings.ETHEREUM_SCHEMA}
+
+    transaction_hash = Column(Hash, primary_key=True)
+    block_number = Column(BigInteger, ForeignKey(Block.number), index=True)
+    transaction_index = Column(BigInteger)
+    cumulative_gas_used = Column(BigInteger)
+    gas_used = Column(BigInteger)
+    contract_address = Column(AddressBytes)
+    status = Column(Integer)
+    root = Column(Hash)
+    effective_gas_price = Column(BigInteger)
+    dt_inserted = Column(
+        DateTime,
+        default=datetime.datetime.utcnow,
+        onupdate=datetime.datetime.utcnow
+    )
+
+
+class Log(base):
+    """
+    A table representation of an event log emitted by a transaction
+
+    {
+        "address": "0xa0b86991c6218b36c1d19d4a2e9eb0ce3606eb48",
+        "topics": ["0xddf252ad1be2c89b69c2b068fc378daa952ba7f163c4a11628f55a4df523b3ef", ...],
+        "data": "0x000000000000000000000000000000000000000000000000000000003b9aca00",
+        "blockNumber": "0xf4241",
+        "transactionHash": "0xefb6c796269c0d1f15fdedb5496fa196eb7fb55b601c0fa527609405519fd581",
+        "transactionIndex": "0x0",
+        "blockHash": "0xcb5cab7266694daa0d28cbf40496c08dd30bf732c41e0455e7ad389c10d79f4f",
+        "logIndex": "0x0",
+        "removed": false
+    }
+    """
+
+    __tablename__ = 'log'
+    __table_args__ = {"schema": settings.ETHEREUM_SCHEMA}
+
+    block_number = Column(
+        BigInteger, ForeignKey(Block.number), primary_key=True, autoincrement=False)
+    log_index = Column(BigInteger, primary_key=True, autoincrement=False)
+    transaction_hash = Column(Hash, index=True)
+    transaction_index = Column(BigInteger)
+    address = Column(AddressBytes, index=True)
+    topic0 = Column(Hash, index=True)
+    topic1 = Column(Hash)
+    topic2 = Column(Hash)
+    topic3 = Column(Hash)
+    data = Column(LargeBinary)
+    dt_inserted = Column(
+        DateTime,
+        default=datetime.datetime.utcnow,
+        onupdate=datetime.datetime.utcnow
+    )
+
+
+class DailyStats(base):
+    """
+    Blocks, transactions and gas used per UTC day, maintained as chunks
+    are committed (see blockme.util.rollup_util).
+    """
+
+    __tablename__ = 'daily_stats'
+    __table_args__ = {"schema": settings.ETHEREUM_SCHEMA}
+
+    day = Column(Date, primary_key=True)
+    block_count = Column(BigInteger, nullable=False, default=0)
+    transaction_count = Column(BigInteger, nullable=False, default=0)
+    gas_used = Column(BigInteger, nullable=False, default=0)
+
+
+class SenderStats(base):
+    """
+    Transactions sent and ether sent per sender address, maintained as
+    chunks are committed.
+    """
+
+    __tablename__ = 'sender_stats'
+    __table_args__ = {"schema": settings.ETHEREUM_SCHEMA}
+
+    sender_id = Column(BigInteger, ForeignKey(Address.id), primary_key=True,
+                       autoincrement=False)
+    transaction_count = Column(BigInteger, nullable=False, default=0, index=True)
+    value = Column(Ether, nullable=False, default=0)
+
+    sender = relationship("Address")
+
+
+class MinerStats(base):
+    """
+    Blocks mined and the gas they used per miner address, maintained as
+    chunks are committed.
+    """
+
+    __tablename__ = 'miner_stats'
+    __table_args__ = {"schema": settings.ETHEREUM_SCHEMA}
+
+    miner = Column(AddressBytes, primary_key=True)
+    block_count = Column(BigInteger, nullable=False, default=0, index=True)
+    gas_used = Column(BigInteger, nullable=False, default=0)
+
+
+class SyncState(base):
+    """
+    Inclusive ranges of block numbers whose blocks and transactions have
+    been committed to the database.
+
+    Adjacent and overlapping ranges are merged as they are recorded, so
+    the table holds roughly one row per contiguous run of stored blocks.
+    """
+
+    __tablename__ = 'sync_state'
+    __table_args__ = {"schema": settings.ETHEREUM_SCHEMA}
+
+    range_start = Column(BigInteger, primary_key=True, autoincrement=False)
+    range_end = Column(BigInteger, nullable=False)
+    dt_updated = Column(
+        DateTime,
+        default=datetime.datetime.utcnow,
+        onupdate=datetime.datetime.utcnow
+    )
+
+
+class RangeLease(base):
+    """
+    A block range handed out to a backfill worker.
+
+    Ranges are aligned to the lease size so workers on different machines
+    agree on their boundaries. A worker that crashes stops renewing its
+    lease, and once `lease_expires` passes the range can be leased again.
+
+    status :: 'pending', 'leased' or 'done'
+    """
+
+    __tablename__ = 'range_lease'
+    __table_args__ = {"schema": settings.ETHEREUM_SCHEMA}
+
+    range_start = Column(BigInteger, primary_key=True, autoincrement=False)
+    range_end = Column(BigInteger, nullable=False)
+    status = Column(String(16), nullable=False, default='pending', index=True)
+    owner = Column(String(256))
+    lease_expires = Column(DateTime)
+    dt_updated = Column(
+        DateTime,
+        default=datetime.datetime.utcnow,
+        onupdate=datetime.datetime.utcnow
+    )
+
+
+class FailedBlock(base):
+    """
+    A dead-letter entry for a block that could not be fetched or
+    inserted. Entries are retried in batches and deleted in the same
+    transaction that finally stores the block.
+
+    stage :: 'fetch' or 'insert'
+    attempts :: the number of times the block has failed
+    """
+
+    __tablename__ = 'failed_block'
+    __table_args__ = {"schema": settings.ETHEREUM_SCHEMA}
+
+    number = Column(BigInteger, primary_key=True, autoincrement=False)
+    stage = Column(String(16), nullable=False)
+    error = Column(Text)
+    attempts = Column(Integer, nullable=False, default=1, index=True)
+    dt_first_failed = Column(DateTime, default=datetime.datetime.utcnow)
+    dt_updated = Column(
+        DateTime,
+        default=datetime.datetime.utcnow,
+        onupdate=datetime.datetime.utcnow
+    )
+
+
+class DeferredIndex(base):
+    """
+    An index or constraint dropped from the block or transaction table
+    for a bulk load, with the DDL that rebuilds it.
+
+    Rows are deleted in the same transaction that rebuilds them, so an
+    interrupted rebuild picks up where it stopped.
+
+    kind :: 'index', 'unique' or 'foreign_key'
+    """
+
+    __tablename__ = 'deferred_index'
+    __table_args__ = {"schema": settings.ETHEREUM_SCHEMA}
+
+    name = Column(String(256), primary_key=True)
+    table_name = Column(String(256), nullable=False)
+    kind = Column(String(16), nullable=False)
+    definition = Column(Text, nullable=False)
+    dt_updated = Column(
+        DateTime,
+        default=datetime.datetime.utcnow,
+        onupdate=datetime.datetime.utcnow
+    )
 
 
 event.listen(
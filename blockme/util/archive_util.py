@@ -0,0 +1,175 @@
+"""
+An append-only archive of raw blocks returned by geth.
+
+Each block's `eth_getBlockByNumber` result is stored as an individually
+zlib-compressed JSON record appended to a segment file. Segment files
+hold `segment_size` consecutive block numbers each:
+
+    <archive_dir>/segment-000000000000.dat   blocks 0 .. segment_size - 1
+    <archive_dir>/segment-000000100000.dat   ...
+
+A dense index file maps a block number to the record that holds it. The
+entry for block n lives at byte n * ENTRY_SIZE and holds the record's
+offset and compressed length within its segment, so any block can be
+located and read through mmap in O(1). A zero length marks a block that
+has not been archived.
+
+Appends take an exclusive flock on the segment file, so several threads
+or processes may share one archive.
+"""
+import fcntl
+import mmap
+import os
+import struct
+import threading
+import zlib
+
+from blockme.util.crawler_util import json_dumps, json_loads
+from blockme.util.logging_util import get_blockme_console_logger
+
+
+ENTRY = struct.Struct('<QI4x')
+ENTRY_SIZE = ENTRY.size
+
+
+class ArchiveError(Exception):
+    pass
+
+
+class BlockArchive(object):
+    """
+    Read and append raw blocks in an archive directory.
+
+    archive_dir :: directory holding the segment and index files
+    segment_size :: block numbers per segment file
+    compression_level :: zlib compression level used for new records
+    """
+
+    INDEX_FILE = 'index.bin'
+
+    def __init__(self, archive_dir, segment_size=100000, compression_level=6):
+        self.logger = get_blockme_console_logger()
+        self.archive_dir = archive_dir
+        self.segment_size = segment_size
+        self.compression_level = compression_level
+        os.makedirs(archive_dir, exist_ok=True)
+
+        self.lock = threading.Lock()
+        self.index_fd = os.open(
+            os.path.join(archive_dir, self.INDEX_FILE), os.O_RDWR | os.O_CREAT)
+        self.index_map = None
+        self.segment_fds = {}
+        self.segment_maps = {}
+
+    def close(self):
+        """Close every open file and mapping. Safe to call twice."""
+        with self.lock:
+            if self.index_fd is None:
+                return
+            if self.index_map is not None:
+                self.index_map.close()
+                self.index_map = None
+            for m in self.segment_maps.values():
+                m.close()
+            self.segment_maps = {}
+            for fd in self.segment_fds.values():
+                os.close(fd)
+            self.segment_fds = {}
+            os.close(self.index_fd)
+            self.index_fd = None
+
+    def _segment_path(self, segment_start):
+        return os.path.join(
+            self.archive_dir, f'segment-{segment_start:012d}.dat')
+
+    def _segment_fd(self, segment_start):
+        fd = self.segment_fds.get(segment_start)
+        if fd is None:
+            fd = os.open(
+                self._segment_path(segment_start),
+                os.O_RDWR | os.O_CREAT | os.O_APPEND)
+            self.segment_fds[segment_start] = fd
+        return fd
+
+    def _segment_start(self, n):
+        return n - n % self.segment_size
+
+    def append(self, n, block):
+        """
+        Append the raw result for block `n`. Re-archiving a block appends a
+        new record and points the index at it.
+        """
+        self.append_many([(n, block)])
+
+    def append_many(self, blocks):
+        """
+        Append raw results for many blocks.
+
+        blocks :: an iterable of (block number, result dict) tuples
+        """
+        records = [
+            (n, zlib.compress(json_dumps(block), self.compression_level))
+            for n, block in blocks
+        ]
+        with self.lock:
+            for n, record in records:
+                fd = self._segment_fd(self._segment_start(n))
+                fcntl.flock(fd, fcntl.LOCK_EX)
+                try:
+                    offset = os.fstat(fd).st_size
+                    os.write(fd, record)
+                finally:
+                    fcntl.flock(fd, fcntl.LOCK_UN)
+                os.pwrite(
+                    self.index_fd, ENTRY.pack(offset, len(record)),
+                    n * ENTRY_SIZE)
+
+    def _index_entry(self, n):
+        """Returns (offset, length) for block `n`, or None if not archived."""
+        position = n * ENTRY_SIZE
+        if self.index_map is None or len(self.index_map) < position + ENTRY_SIZE:
+            size = os.fstat(self.index_fd).st_size
+            if size < position + ENTRY_SIZE:
+                return None
+            if self.index_map is not None:
+                self.index_map.close()
+            self.index_map = mmap.mmap(
+                self.index_fd, size, access=mmap.ACCESS_READ)
+        offset, length = ENTRY.unpack_from(self.index_map, position)
+        if length == 0:
+            return None
+        return offset, length
+
+    def _segment_map(self, segment_start, end):
+        m = self.segment_maps.get(segment_start)
+        if m is None or len(m) < end:
+            if m is not None:
+                m.close()
+            fd = self._segment_fd(segment_start)
+            m = mmap.mmap(fd, os.fstat(fd).st_size, access=mmap.ACCESS_READ)
+            self.segment_maps[segment_start] = m
+        return m
+
+    def get(self, n):
+        """Returns the raw result dict for block `n`, or None if not archived."""
+        with self.lock:
+            entry = self._index_entry(n)
+            if entry is None:
+                return None
+            offset, length = entry
+            m = self._segment_map(self._segment_start(n), offset + length)
+            record = m[offset:offset + length]
+        try:
+            return json_loads(zlib.decompress(record))
+        except (zlib.error, ValueError) as e:
+            raise ArchiveError(f'Corrupt archive record for block {n}: {e}')
+
+    def highest_block(self):
+        """Returns the highest archived block number, or None."""
+        with self.lock:
+            n = os.fstat(self.index_fd).st_size // ENTRY_SIZE - 1
+            while n >= 0:
+                if self._index_entry(n) is not None:
+                    return n
+                n -= 1
+        return None
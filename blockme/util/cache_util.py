@@ -0,0 +1,58 @@
+"""
+Small in-process caches.
+"""
+import collections
+import threading
+import time
+
+
+class LRUCache(object):
+    """
+    A thread-safe mapping holding at most `max_size` entries, evicting
+    the least recently used entry when full. With a `ttl` (in seconds),
+    entries also expire that long after they were put.
+    """
+
+    def __init__(self, max_size, ttl=None):
+        self.max_size = max(1, max_size)
+        self.ttl = ttl
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key, default=None):
+        """Returns the cached value for `key`, marking it recently used."""
+        with self.lock:
+            try:
+                value, expires = self.entries[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            if expires is not None and expires <= time.monotonic():
+                del self.entries[key]
+                self.misses += 1
+                return default
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        expires = time.monotonic() + self.ttl if self.ttl is not None else None
+        with self.lock:
+            self.entries[key] = (value, expires)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self.lock:
+            entry = self.entries.pop(key, None)
+        return entry[0] if entry is not None else default
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
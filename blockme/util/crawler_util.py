@@ -1,6 +1,86 @@
 """Util functions for interacting with geth and mongo."""
+import datetime
+import decimal
+import json
+import operator
 import os
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+
+# JSON
+# ----
+def json_loads(data):
+    """Decode JSON from str or bytes, using orjson when it is installed."""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def json_dumps(obj):
+    """Encode `obj` as compact UTF-8 JSON bytes, using orjson when installed."""
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, separators=(',', ':')).encode('utf-8')
+
+
+def json_load_projected(fp, keep):
+    """
+    Incrementally decode one JSON document from the file-like `fp` with
+    ijson, building only the object members for which `keep(prefix,
+    key)` is true; `prefix` is the ijson path of the object (e.g.
+    "item.result"). Skipped members are parsed past without ever being
+    built, so the memory used is bounded by what is kept rather than by
+    the size of the document.
+
+    Raises ValueError if the document is malformed.
+    """
+    stack = []
+    root = None
+    skipping = None
+    try:
+        for prefix, event, value in ijson.parse(fp):
+            if skipping is not None:
+                if event in ('start_map', 'start_array'):
+                    skipping += 1
+                elif event in ('end_map', 'end_array'):
+                    skipping -= 1
+                if skipping == 0:
+                    skipping = None
+                continue
+            if event == 'map_key':
+                if keep(prefix, value):
+                    stack[-1][1] = value
+                else:
+                    skipping = 0
+                continue
+            if event in ('end_map', 'end_array'):
+                stack.pop()
+                continue
+            if event == 'start_map':
+                value = {}
+            elif event == 'start_array':
+                value = []
+            if not stack:
+                root = value
+            elif stack[-1][1] is None:
+                stack[-1][0].append(value)
+            else:
+                stack[-1][0][stack[-1][1]] = value
+            if event in ('start_map', 'start_array'):
+                stack.append([value, None])
+    except ijson.JSONError as e:
+        raise ValueError(f'Malformed JSON: {e}') from e
+    return root
+
 
 # Geth
 # ----
@@ -59,3 +139,283 @@ def decode_block(block):
 
     except:
         return None, None
+
+
+def build_batch_payload(calls):
+    """
+    Build a JSON-RPC 2.0 batch array from a list of (method, params) tuples.
+
+    The position of each call in `calls` is used as its request id so
+    responses can be matched back with `match_batch_responses`.
+    """
+    return [
+        {"method": method, "params": params, "jsonrpc": "2.0", "id": i}
+        for i, (method, params) in enumerate(calls)
+    ]
+
+
+def match_batch_responses(responses, num_calls):
+    """
+    Match a JSON-RPC 2.0 batch response back to its requests by `id`.
+
+    Geth is free to answer a batch in any order, and individual calls
+    may fail while the rest succeed. Returns a list of length `num_calls`
+    where each entry is a (result, error) tuple: `error` is None on
+    success and the JSON-RPC error object (or a short message) otherwise.
+    """
+    matched = [(None, {"message": "no response for request id"})] * num_calls
+    if isinstance(responses, dict):
+        # A malformed batch is answered with a single error object
+        error = responses.get("error", {"message": "unexpected response"})
+        return [(None, error)] * num_calls
+
+    for response in responses:
+        request_id = response.get("id")
+        if not isinstance(request_id, int) or not 0 <= request_id < num_calls:
+            continue
+        if response.get("error") is not None:
+            matched[request_id] = (None, response["error"])
+        else:
+            matched[request_id] = (response.get("result"), None)
+    return matched
+
+
+def numbers_to_ranges(numbers):
+    """
+    Collapse block numbers into a sorted list of inclusive (first, last)
+    ranges, e.g. [1, 2, 3, 7, 8] -> [(1, 3), (7, 8)].
+    """
+    ranges = []
+    for n in sorted(set(numbers)):
+        if ranges and ranges[-1][1] + 1 == n:
+            ranges[-1] = (ranges[-1][0], n)
+        else:
+            ranges.append((n, n))
+    return ranges
+
+
+def merge_ranges(ranges):
+    """
+    Merge overlapping and adjacent inclusive (first, last) ranges.
+    """
+    merged = []
+    for first, last in sorted(ranges):
+        if merged and merged[-1][1] + 1 >= first:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], last))
+        else:
+            merged.append((first, last))
+    return merged
+
+
+def subtract_ranges(start, end, ranges):
+    """
+    Returns the parts of [start, end] not covered by `ranges` as a sorted
+    list of inclusive (first, last) ranges.
+    """
+    remaining = []
+    cursor = start
+    for first, last in merge_ranges(ranges):
+        if last < cursor:
+            continue
+        if first > end:
+            break
+        if first > cursor:
+            remaining.append((cursor, first - 1))
+        cursor = max(cursor, last + 1)
+    if cursor <= end:
+        remaining.append((cursor, end))
+    return remaining
+
+
+# Columnar decoding
+# -----------------
+# (column, json key, converter) for every field loaded from a block or
+# transaction. `None` means the value is stored as-is.
+BLOCK_FIELDS = (
+    ('number', 'number', 'hex'),
+    ('block_hash', 'hash', 'bytes'),
+    ('parent_hash', 'parentHash', 'bytes'),
+    ('nonce', 'nonce', 'bytes'),
+    ('transactions_root', 'transactionsRoot', 'bytes'),
+    ('state_root', 'stateRoot', 'bytes'),
+    ('receipt_root', 'receiptsRoot', 'bytes'),
+    ('miner', 'miner', 'bytes'),
+    ('difficulty', 'difficulty', 'hex'),
+    ('total_difficulty', 'totalDifficulty', 'hex'),
+    ('size', 'size', 'hex'),
+    ('gas_limit', 'gasLimit', 'hex'),
+    ('gase_used', 'gasUsed', 'hex'),
+    ('timestamp', 'timestamp', 'timestamp'),
+)
+
+TRANSACTION_FIELDS = (
+    ('transaction_hash', 'hash', 'bytes'),
+    ('block_number', 'blockNumber', 'hex'),
+    ('block_hash', 'blockHash', 'bytes'),
+    ('nonce', 'nonce', 'hex'),
+    ('transaction_index', 'transactionIndex', 'hex'),
+    ('sender', 'from', 'bytes'),
+    ('receipt', 'to', 'bytes'),
+    ('value', 'value', 'ether'),
+    ('gas', 'gas', 'hex'),
+    ('gas_price', 'gasPrice', 'hex'),
+)
+
+# Receipts omit `status` before Byzantium, `root` after it and
+# `effectiveGasPrice` before London; decode_receipt_columns fills them in
+RECEIPT_FIELDS = (
+    ('transaction_hash', 'transactionHash', 'bytes'),
+    ('block_number', 'blockNumber', 'hex'),
+    ('transaction_index', 'transactionIndex', 'hex'),
+    ('cumulative_gas_used', 'cumulativeGasUsed', 'hex'),
+    ('gas_used', 'gasUsed', 'hex'),
+    ('contract_address', 'contractAddress', 'bytes'),
+    ('status', 'status', 'optional_hex'),
+    ('root', 'root', 'bytes'),
+    ('effective_gas_price', 'effectiveGasPrice', 'optional_hex'),
+)
+
+OPTIONAL_RECEIPT_KEYS = ('contractAddress', 'status', 'root', 'effectiveGasPrice')
+
+LOG_FIELDS = (
+    ('block_number', 'blockNumber', 'hex'),
+    ('log_index', 'logIndex', 'hex'),
+    ('transaction_hash', 'transactionHash', 'bytes'),
+    ('transaction_index', 'transactionIndex', 'hex'),
+    ('address', 'address', 'bytes'),
+    ('data', 'data', 'bytes'),
+)
+
+# Logs carry up to four topics, stored in columns topic0 .. topic3
+LOG_TOPICS = 4
+
+_BLOCK_KEYS = frozenset([key for _, key, _ in BLOCK_FIELDS] + ['transactions'])
+_TRANSACTION_KEYS = frozenset(key for _, key, _ in TRANSACTION_FIELDS)
+
+
+def keep_block_field(prefix, key):
+    """
+    json_load_projected filter for a batch of eth_getBlockByNumber
+    responses: keeps the block and transaction fields that are loaded
+    and drops the rest (input data, signatures, logs blooms, ...).
+    """
+    if prefix == 'item.result':
+        return key in _BLOCK_KEYS
+    if prefix == 'item.result.transactions.item':
+        return key in _TRANSACTION_KEYS
+    return True
+
+_EPOCH = datetime.datetime(1970, 1, 1)
+
+
+def hex_to_bytes(value):
+    """Convert a "0x..." hex string to bytes (None stays None)."""
+    if value is None:
+        return None
+    return bytes.fromhex(value[2:])
+
+
+def hex_column(values):
+    """Convert a column of hex strings to ints in one pass."""
+    return list(map(int, values, [16] * len(values)))
+
+
+def bytes_column(values):
+    """Convert a column of "0x..." hex strings (or None) to bytes."""
+    fromhex = bytes.fromhex
+    return [fromhex(v[2:]) if v is not None else None for v in values]
+
+
+def optional_hex_column(values):
+    """Convert a column of hex strings, some of which may be None, to ints."""
+    return [int(v, 16) if v is not None else None for v in values]
+
+
+def timestamp_column(values):
+    """Convert a column of hex unix timestamps to UTC datetimes."""
+    epoch = _EPOCH
+    delta = datetime.timedelta
+    return [epoch + delta(seconds=s) for s in hex_column(values)]
+
+
+def ether_column(values):
+    """Convert a column of hex wei amounts to exact Decimal ether."""
+    Decimal = decimal.Decimal
+    return [Decimal(f'{v}E-18') for v in hex_column(values)]
+
+
+_CONVERTERS = {
+    'hex': hex_column,
+    'optional_hex': optional_hex_column,
+    'bytes': bytes_column,
+    'timestamp': timestamp_column,
+    'ether': ether_column,
+}
+
+
+def decode_columns(objects, fields):
+    """
+    Decode a batch of json-decoded blocks or transactions into columns.
+
+    Every field is pulled out of every object in a single itemgetter pass,
+    transposed into columns, and each column is then converted as a
+    whole, rather than converting field by field, object by object.
+
+    Returns a dict mapping column name to a list of values.
+    """
+    getter = operator.itemgetter(*[key for _, key, _ in fields])
+    transposed = zip(*map(getter, objects)) if objects else [()] * len(fields)
+    columns = {}
+    for (column, _, converter), values in zip(fields, transposed):
+        values = list(values)
+        if converter is not None:
+            values = _CONVERTERS[converter](values)
+        columns[column] = values
+    return columns
+
+
+def decode_block_columns(blocks):
+    """Decode a batch of blocks into columns keyed by Block column name."""
+    return decode_columns(blocks, BLOCK_FIELDS)
+
+
+def decode_transaction_columns(transactions):
+    """Decode a batch of transactions into columns keyed by Transaction column name."""
+    return decode_columns(transactions, TRANSACTION_FIELDS)
+
+
+def decode_receipt_columns(receipts):
+    """Decode a batch of transaction receipts into columns keyed by Receipt column name."""
+    for receipt in receipts:
+        for key in OPTIONAL_RECEIPT_KEYS:
+            receipt.setdefault(key, None)
+    return decode_columns(receipts, RECEIPT_FIELDS)
+
+
+def decode_log_columns(logs):
+    """Decode a batch of event logs into columns keyed by Log column name."""
+    columns = decode_columns(logs, LOG_FIELDS)
+    topics = [log['topics'] for log in logs]
+    for i in range(LOG_TOPICS):
+        columns[f'topic{i}'] = bytes_column(
+            [t[i] if len(t) > i else None for t in topics])
+    return columns
+
+
+def column_length(columns):
+    """Returns the number of rows in a dict of columns."""
+    for values in columns.values():
+        return len(values)
+    return 0
+
+
+def columns_to_rows(columns):
+    """Convert a dict of columns into a list of row dicts."""
+    names = list(columns)
+    return [dict(zip(names, row)) for row in zip(*columns.values())]
+
+
+def rows_to_columns(names, rows):
+    """Convert a list of row tuples into a dict of columns keyed by `names`."""
+    columns = list(zip(*rows)) if rows else [()] * len(names)
+    return {name: list(values) for name, values in zip(names, columns)}
@@ -1,15 +1,28 @@
+import csv
+import datetime
+import io
+import os
+import re
+import threading
 import settings
 
-from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
-from sqlalchemy import create_engine   
-from sqlalchemy.orm import sessionmaker
-from sqlalchemy_utils.functions import database_exists, create_database
+from sqlalchemy import create_engine, event, inspect, or_, case
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.orm import aliased, sessionmaker
 from sqlalchemy.sql.expression import func
 
-from blockme.util.parser_util import convert_base_16_unix_time_to_datetime
-from blockme.models.ethereum import Block, Transaction, base
+from blockme.util.crawler_util import merge_ranges, subtract_ranges, \
+    decode_block_columns, decode_transaction_columns, column_length, \
+    columns_to_rows, rows_to_columns
+from blockme.models.ethereum import Block, Transaction, Address, Receipt, Log, \
+    SyncState, RangeLease, DeferredIndex, FailedBlock, base
+from blockme.util.cache_util import LRUCache
+from blockme.util import rollup_util
 from blockme.util.logging_util import get_blockme_file_logger
+from blockme.util.metrics_util import get_metrics_registry
 
 
 class BaseDatabaseException(Exception):
@@ -20,12 +33,322 @@ class SessionDoesNotExist(BaseDatabaseException):
     pass
 
 
+class LeaseLost(BaseDatabaseException):
+    pass
+
+
+class InvalidIndexes(BaseDatabaseException):
+    pass
+
+
+def _copy_column(values):
+    """Render a column for COPY: bytes are written in bytea hex format."""
+    for v in values:
+        if v is not None:
+            if isinstance(v, bytes):
+                return ['\\x' + b.hex() if b is not None else None for b in values]
+            return values
+    return values
+
+
+class _CSVStream(object):
+    """
+    A file-like object rendering rows as CSV as COPY reads it, so the
+    whole payload is never held as text at once.
+    """
+
+    def __init__(self, rows):
+        self.rows = iter(rows)
+        self.buffer = io.StringIO()
+        self.writer = csv.writer(self.buffer)
+
+    def read(self, size=-1):
+        for row in self.rows:
+            self.writer.writerow(row)
+            if 0 <= size <= self.buffer.tell():
+                break
+        data = self.buffer.getvalue()
+        self.buffer.seek(0)
+        self.buffer.truncate()
+        return data
+
+
+# Rows built and handed to bulk_insert_mappings at a time by the orm loader
+ORM_BATCH_SIZE = 10000
+
+
+def attach_sqlite_schema(engine):
+    """
+    SQLite has no schemas, so attach a second database file under the
+    ethereum schema name on every new connection. Lets the models run
+    against SQLite as a lightweight stand-in for PostgreSQL (the ORM
+    loader only; COPY and range leasing need PostgreSQL).
+    """
+    database = engine.url.database
+    if database and database != ':memory:':
+        schema_file = f'{database}.{settings.ETHEREUM_SCHEMA}'
+    else:
+        schema_file = ':memory:'
+
+    @event.listens_for(engine, 'connect')
+    def attach(dbapi_connection, connection_record):
+        dbapi_connection.execute(
+            f"ATTACH DATABASE '{schema_file}' AS {settings.ETHEREUM_SCHEMA}")
+
+
+# PostgreSQL NOTIFY channel announcing committed and removed blocks, as
+# "commit:<first>:<last>", "rollback:<number>" (blocks above it removed)
+# or "delete:<first>:<last>"
+CHAIN_CHANNEL = 'blockme_chain'
+
+# Tables whose secondary indexes and foreign keys are deferred during a
+# bulk load
+BULK_LOAD_TABLES = ('block', 'transaction', 'receipt', 'log')
+
+# Tables created range-partitioned by block number when PARTITION_SIZE is set
+PARTITIONED_TABLES = ('block', 'transaction')
+
+# Monotone columns whose B-tree indexes are rebuilt as BRIN indexes after
+# a bulk load: a fraction of the size, and near free to maintain
+BRIN_COLUMNS = {
+    'block': ('timestamp',),
+    'transaction': ('block_number',),
+    'receipt': ('block_number',),
+}
+
+
+def _brin_index_definition(definition, table):
+    """
+    Rewrite a single-column B-tree index definition, as returned by
+    pg_get_indexdef, to a BRIN index if the column is in BRIN_COLUMNS.
+    """
+    match = re.search(r'USING btree \("?(\w+)"?\)$', definition)
+    if match is None or match.group(1) not in BRIN_COLUMNS.get(table, ()):
+        return definition
+    return definition[:match.start()] + f'USING brin ("{match.group(1)}")'
+
+
+def _recursive_index_definition(definition):
+    """
+    pg_get_indexdef renders an index on a partitioned table as
+    CREATE INDEX ... ON ONLY <table>, which would build an invalid index on
+    the parent alone. Drop the ONLY so the rebuild covers every partition.
+    """
+    return definition.replace(' ON ONLY ', ' ON ', 1)
+
+
+def _partitioned_table_ddl(table, dialect, constraints, partition_key):
+    """
+    CREATE TABLE statement for a model's table as a table partitioned by
+    range of `partition_key`, with the given table constraints.
+    """
+    columns = []
+    for column in table.columns:
+        if column.primary_key and column.autoincrement is True:
+            column_type = 'BIGSERIAL'
+        else:
+            column_type = column.type.compile(dialect=dialect)
+        columns.append(f'"{column.name}" {column_type}')
+    return (
+        f'CREATE TABLE {table.schema}.{table.name} '
+        f'({", ".join(columns + constraints)}) '
+        f'PARTITION BY RANGE ({partition_key})'
+    )
+
+
+def create_partitioned_tables(engine):
+    """
+    Create the block and transaction tables partitioned by block number,
+    unless they already exist. Partitions are added by
+    EthereumDatabaseHelper.ensure_partitions.
+
+    PostgreSQL can only enforce uniqueness within a partition, so the
+    hashes get plain indexes, transactions are unique on (block_number,
+    transaction_index), and transaction.block_hash has no foreign key.
+    Timestamps and transaction block numbers get BRIN indexes.
+    """
+    schema = settings.ETHEREUM_SCHEMA
+    if engine.has_table(Block.__tablename__, schema=schema):
+        return False
+
+    statements = [
+        f'CREATE SCHEMA IF NOT EXISTS {schema}',
+        _partitioned_table_ddl(
+            Block.__table__, engine.dialect,
+            ['PRIMARY KEY (number)'], 'number'),
+        f'CREATE INDEX block_block_hash_idx ON {schema}.block (block_hash)',
+        f'CREATE INDEX block_timestamp_brin ON {schema}.block USING brin ("timestamp")',
+        _partitioned_table_ddl(
+            Transaction.__table__, engine.dialect,
+            ['PRIMARY KEY (block_number, db_id)',
+             'CONSTRAINT transaction_block_number_transaction_index_key '
+             'UNIQUE (block_number, transaction_index)'],
+            'block_number'),
+        f'CREATE INDEX transaction_transaction_hash_idx '
+        f'ON {schema}.transaction (transaction_hash)',
+        f'CREATE INDEX transaction_sender_id_idx ON {schema}.transaction (sender_id)',
+        f'CREATE INDEX transaction_receipt_id_idx ON {schema}.transaction (receipt_id)',
+        f'CREATE INDEX transaction_block_number_brin '
+        f'ON {schema}.transaction USING brin (block_number)',
+        f'ALTER TABLE {schema}.transaction ADD CONSTRAINT transaction_block_number_fkey '
+        f'FOREIGN KEY (block_number) REFERENCES {schema}.block (number)',
+        f'ALTER TABLE {schema}.transaction ADD CONSTRAINT transaction_sender_id_fkey '
+        f'FOREIGN KEY (sender_id) REFERENCES {schema}.address (id)',
+        f'ALTER TABLE {schema}.transaction ADD CONSTRAINT transaction_receipt_id_fkey '
+        f'FOREIGN KEY (receipt_id) REFERENCES {schema}.address (id)',
+    ]
+    with engine.begin() as connection:
+        for statement in statements[:1]:
+            connection.execute(statement)
+        Address.__table__.create(connection, checkfirst=True)
+        for statement in statements[1:]:
+            connection.execute(statement)
+    return True
+
+
+# Engines (and so connection pools) shared by every helper in a process,
+# keyed by (pid, url) so a forked child never reuses its parent's
+# connections, and the schemas already checked in this process
+_engines = {}
+_prepared_schemas = set()
+_engines_lock = threading.Lock()
+
+
+def get_engine(db_url, pool_size=settings.DB_POOL_SIZE,
+               max_overflow=settings.DB_MAX_OVERFLOW,
+               pool_timeout=settings.DB_POOL_TIMEOUT,
+               pool_recycle=settings.DB_POOL_RECYCLE):
+    """
+    Returns this process's engine for `db_url`, creating it on first use.
+
+    PostgreSQL engines hold a pool of `pool_size` connections, growing by
+    up to `max_overflow` under load; connections are checked before being
+    handed out and replaced after `pool_recycle` seconds. SQLite engines
+    keep SQLAlchemy's default pool, with the ethereum schema attached.
+    """
+    key = (os.getpid(), db_url)
+    with _engines_lock:
+        engine = _engines.get(key)
+        if engine is not None:
+            return engine
+        if db_url.startswith('sqlite'):
+            # Worker threads use connections opened by other threads
+            engine = create_engine(
+                db_url, connect_args={'check_same_thread': False})
+            attach_sqlite_schema(engine)
+        else:
+            engine = create_engine(
+                db_url,
+                pool_size=pool_size,
+                max_overflow=max_overflow,
+                pool_timeout=pool_timeout,
+                pool_recycle=pool_recycle,
+                pool_pre_ping=True
+            )
+        _engines[key] = engine
+        return engine
+
+
+def _existing_tables(engine):
+    """Returns the (schema, table) pairs that exist in the database."""
+    if engine.dialect.name == 'postgresql':
+        # The inspector leaves out partitioned tables (relkind 'p')
+        with engine.connect() as connection:
+            return set(connection.execute(
+                "SELECT n.nspname, c.relname FROM pg_class c "
+                "JOIN pg_namespace n ON n.oid = c.relnamespace "
+                "WHERE c.relkind IN ('r', 'p')"
+            ).fetchall())
+    inspector = inspect(engine)
+    default_schema = engine.dialect.default_schema_name
+    schemas = {t.schema or default_schema for t in base.metadata.sorted_tables}
+    return {
+        (schema, name) for schema in schemas
+        for name in inspector.get_table_names(schema=schema)
+    }
+
+
+def prepare_schema(engine, partition_size=0, logger=None):
+    """
+    Create the database and any missing tables, once per process for each
+    engine. Only a connection and a listing of the existing tables are
+    needed when the schema is already up to date, so helpers start fast.
+    Returns True if the schema was checked by this call.
+    """
+    key = (id(engine), partition_size)
+    with _engines_lock:
+        if key in _prepared_schemas:
+            return False
+        try:
+            connection = engine.connect()
+        except OperationalError:
+            # Only pay for sqlalchemy_utils when the database may be missing
+            from sqlalchemy_utils.functions import database_exists, create_database
+            if database_exists(engine.url):
+                raise
+            if logger:
+                logger.info(f"The db doesn't exist. Creating the "
+                            f"database: {engine.url.database}...")
+            create_database(engine.url)
+            connection = engine.connect()
+        connection.close()
+
+        if partition_size and engine.dialect.name == 'postgresql':
+            if create_partitioned_tables(engine) and logger:
+                logger.info(
+                    f"Created partitioned tables, {partition_size} "
+                    "blocks per partition.")
+
+        # Pick up any tables added since the database was created
+        existing = _existing_tables(engine)
+        default_schema = engine.dialect.default_schema_name
+        missing = [
+            table for table in base.metadata.sorted_tables
+            if (table.schema or default_schema, table.name) not in existing
+        ]
+        if missing:
+            if logger:
+                logger.info(
+                    f"Creating tables: {', '.join(t.name for t in missing)}")
+            base.metadata.create_all(engine, tables=missing)
+
+        _prepared_schemas.add(key)
+        return True
+
+
 class AbstractDatabaseHelper(object):
 
-    def __init__(self):
+    def __init__(self, db_url=settings.DATABASE_URL,
+                 partition_size=settings.PARTITION_SIZE,
+                 rollups=settings.MAINTAIN_ROLLUPS):
         self.logger = get_blockme_file_logger()
+        self.metrics = get_metrics_registry()
+        self.db_url = db_url
+        self.partition_size = partition_size
+        self.rollups = rollups
         self.session = self.create_database_session()
 
+        # Callables run with the CHAIN_CHANNEL payload after blocks are
+        # committed or rolled back through this helper
+        self.chain_listeners = []
+
+    def _announce_chain_change(self, payload):
+        """
+        Queue a CHAIN_CHANNEL notification in the current transaction, so
+        other processes hear of it exactly when it commits. Returns the
+        payload for _chain_changed.
+        """
+        if self.session.get_bind().dialect.name == 'postgresql':
+            self.session.execute(
+                'SELECT pg_notify(:channel, :payload)',
+                {'channel': CHAIN_CHANNEL, 'payload': payload})
+        return payload
+
+    def _chain_changed(self, payload):
+        """Run the in-process chain listeners once a change has committed."""
+        for listener in self.chain_listeners:
+            listener(payload)
+
     def get_latest_block_in_database(self):
         """
         Obtains the datetime (in UTC) of the most recent
@@ -42,110 +365,1181 @@ class AbstractDatabaseHelper(object):
         results = self.session.query(func.min(Block.timestamp)).all()
         return results[0][0]
 
-    def get_block_queue(self):
+    def get_synced_ranges(self):
         """
-        Returns a list of block numbers already in the database.
+        Returns the committed block ranges recorded in the sync state table
+        as a sorted, merged list of inclusive (first, last) ranges.
         """
-        queue = deque()
-        results = self.session.query(Block.number).distinct()
-        for r in results:
-            queue.append(r[0])
-        return queue
+        results = self.session.query(
+            SyncState.range_start, SyncState.range_end
+        ).order_by(SyncState.range_start)
+        return merge_ranges([(first, last) for first, last in results])
 
-    def create_database_session(self):
+    def get_unsynced_ranges(self, start, end):
         """
-        Obtains a database engine and creates one if it doesn't exist.
+        Returns the block ranges in [start, end] that have not been
+        committed, according to the sync state table.
         """
-        db_string = settings.PG_DATABASE
-        db = create_engine(db_string)
+        return subtract_ranges(start, end, self.get_synced_ranges())
 
-        self.logger.info("Checking if database exists...")
-        if not database_exists(db.url):
-            self.logger.info(f"The db doesn't exist. Creating the "
-                "database: {settings.PG_DATABASE_NAME}...")
-            create_database(db.url)
-            base.metadata.create_all(db)
-            self.logger.info(f"{settings.PG_DATABASE_NAME} created.")
-        else:
-            self.logger.info("Database exists.")
+    def get_highest_synced_block(self):
+        """
+        Returns the highest committed block number, or None if nothing
+        has been synced yet.
+        """
+        results = self.session.query(func.max(SyncState.range_end)).all()
+        return results[0][0]
 
-        Session = sessionmaker(db)
-        session = Session()
-        return session
+    def mark_range_synced(self, first, last):
+        """
+        Record [first, last] as committed, merging it with any overlapping
+        or adjacent ranges. Does not commit, so the caller can make this
+        part of the same transaction as the rows it describes.
+        """
+        neighbours = self.session.query(SyncState).filter(
+            SyncState.range_start <= last + 1,
+            SyncState.range_end >= first - 1
+        ).with_for_update().all()
+        for r in neighbours:
+            first = min(first, r.range_start)
+            last = max(last, r.range_end)
+            self.session.delete(r)
+        # Flush the deletes first in case the merged range reuses a start
+        self.session.flush()
+        self.session.add(SyncState(range_start=first, range_end=last))
+        self.session.query(FailedBlock).filter(
+            FailedBlock.number.between(first, last)
+        ).delete(synchronize_session=False)
 
+    def unmark_range_synced(self, first, last):
+        """
+        Remove [first, last] from the sync state, splitting any range that
+        spans it. Does not commit.
+        """
+        overlapping = self.session.query(SyncState).filter(
+            SyncState.range_start <= last,
+            SyncState.range_end >= first
+        ).with_for_update().all()
+        remaining = []
+        for r in overlapping:
+            if r.range_start < first:
+                remaining.append((r.range_start, first - 1))
+            if r.range_end > last:
+                remaining.append((last + 1, r.range_end))
+            self.session.delete(r)
+        self.session.flush()
+        for range_start, range_end in remaining:
+            self.session.add(SyncState(range_start=range_start, range_end=range_end))
 
-class EthereumDatabaseHelper(AbstractDatabaseHelper):
+    def record_synced_ranges(self, synced_ranges):
+        """
+        Record `synced_ranges` as committed on their own, for chunks
+        whose rows were only written to sinks outside the database.
+        """
+        try:
+            for first, last in synced_ranges:
+                self.mark_range_synced(first, last)
+            self.session.commit()
+        except:
+            self.session.rollback()
+            raise
 
-    def insert_blocks(self, block_list):
+    def recover_session(self):
         """
-        Inserts blocks to the initialized database.
+        Roll back whatever the session was doing after a failed write, so
+        the next write starts from a clean transaction.
+        """
+        try:
+            self.session.rollback()
+        except:
+            self.logger.exception('Rolling back the session failed.')
+            self.session.close()
 
-        block_list :: a list of json-decoded block objects
+    def record_failed_blocks(self, numbers, stage, error=None):
+        """
+        Add `numbers` to the dead-letter table, or bump their attempt
+        count if they are already there. Commits.
+
+        stage :: 'fetch' or 'insert'
+        error :: a short description of the failure
         """
+        numbers = sorted(set(numbers))
+        if not numbers:
+            return
+        error = error[:4096] if error else None
+        now = datetime.datetime.utcnow()
+        table = FailedBlock.__table__
+        try:
+            if self.session.get_bind().dialect.name == 'postgresql':
+                stmt = pg_insert(table)
+                stmt = stmt.on_conflict_do_update(
+                    index_elements=[table.c.number],
+                    set_={
+                        'stage': stmt.excluded.stage,
+                        'error': stmt.excluded.error,
+                        'attempts': table.c.attempts + 1,
+                        'dt_updated': stmt.excluded.dt_updated,
+                    }
+                )
+                self.session.execute(stmt, [
+                    {'number': n, 'stage': stage, 'error': error, 'attempts': 1,
+                     'dt_first_failed': now, 'dt_updated': now}
+                    for n in numbers
+                ])
+            else:
+                for n in numbers:
+                    updated = self.session.execute(
+                        table.update().where(table.c.number == n).values(
+                            stage=stage, error=error, dt_updated=now,
+                            attempts=table.c.attempts + 1)
+                    ).rowcount
+                    if not updated:
+                        self.session.execute(table.insert().values(
+                            number=n, stage=stage, error=error, attempts=1,
+                            dt_first_failed=now, dt_updated=now))
+            self.session.commit()
+        except:
+            self.session.rollback()
+            raise
+        self.metrics.inc('dead_letter_blocks_total', len(numbers), {'stage': stage})
+
+    def get_failed_blocks(self, max_attempts=None):
+        """
+        Returns the block numbers in the dead-letter table, sorted, leaving
+        out those that have already failed `max_attempts` times.
+        """
+        query = self.session.query(FailedBlock.number)
+        if max_attempts is not None:
+            query = query.filter(FailedBlock.attempts < max_attempts)
+        return [n for n, in query.order_by(FailedBlock.number)]
+
+    def get_block_hash(self, number):
+        """Returns the stored hash of block `number`, or None."""
+        result = self.session.query(Block.block_hash).filter(
+            Block.number == number).first()
+        if result is None or result[0] is None:
+            return None
+        return bytes(result[0])
+
+    def _delete_blocks(self, first, last=None):
+        """
+        Delete blocks `first` to `last` (or every block from `first` up),
+        with their transactions, receipts and logs, taking them out of
+        the rollups. Does not commit; returns the number of blocks removed.
+        """
+        def within(column):
+            return column >= first if last is None else column.between(first, last)
+
+        if self.rollups:
+            blocks = self.session.query(
+                *[getattr(Block, c) for c in rollup_util.BLOCK_COLUMNS]
+            ).filter(within(Block.number)).all()
+            transactions = self.session.query(
+                *[getattr(Transaction, c) for c in rollup_util.TRANSACTION_COLUMNS]
+            ).filter(within(Transaction.block_number)).all()
+            self.apply_rollup_deltas(rollup_util.rollup_deltas(
+                rows_to_columns(rollup_util.BLOCK_COLUMNS, blocks),
+                rows_to_columns(rollup_util.TRANSACTION_COLUMNS, transactions)
+            ), sign=-1)
+            # drop rows whose count fell to zero (the first value column)
+            for model, _, values in rollup_util.ROLLUPS:
+                self.session.query(model).filter(
+                    getattr(model, values[0]) <= 0
+                ).delete(synchronize_session=False)
+        for table in (Log, Receipt, Transaction):
+            self.session.query(table).filter(
+                within(table.block_number)
+            ).delete(synchronize_session=False)
+        return self.session.query(Block).filter(
+            within(Block.number)
+        ).delete(synchronize_session=False)
+
+    def rollback_blocks_after(self, number):
+        """
+        Delete every block above `number`, with its transactions, receipts
+        and logs, and trim the sync state to match. Used to undo blocks
+        orphaned by a reorg. Commits; returns the number of blocks removed.
+        """
+        try:
+            removed = self._delete_blocks(number + 1)
+            self.session.query(SyncState).filter(
+                SyncState.range_start > number
+            ).delete(synchronize_session=False)
+            self.session.query(SyncState).filter(
+                SyncState.range_end > number
+            ).update({'range_end': number}, synchronize_session=False)
+            payload = self._announce_chain_change(f'rollback:{number}')
+            self.session.commit()
+        except:
+            self.session.rollback()
+            raise
+        self._chain_changed(payload)
+        self.logger.info(f'Rolled back {removed} blocks above {number}.')
+        return removed
+
+    def delete_block_ranges(self, ranges):
+        """
+        Delete the blocks in inclusive (first, last) `ranges`, with their
+        transactions, receipts and logs, and take the ranges out of the
+        sync state so they are crawled again. Commits; returns the number
+        of blocks removed.
+        """
+        removed = 0
+        for first, last in merge_ranges(ranges):
+            try:
+                removed += self._delete_blocks(first, last)
+                self.unmark_range_synced(first, last)
+                payload = self._announce_chain_change(f'delete:{first}:{last}')
+                self.session.commit()
+            except:
+                self.session.rollback()
+                raise
+            self._chain_changed(payload)
+        self.logger.info(f'Deleted {removed} blocks in {len(ranges)} ranges.')
+        return removed
+
+    def apply_rollup_deltas(self, deltas, sign=1):
+        """
+        Add (or with sign=-1, subtract) the output of
+        rollup_util.rollup_deltas to the rollup tables. Keys are updated
+        in sorted order so concurrent workers can't deadlock. Does not
+        commit.
+        """
+        postgresql = self.session.get_bind().dialect.name == 'postgresql'
+        for model, key, columns in rollup_util.ROLLUPS:
+            totals = deltas.get(model)
+            if not totals:
+                continue
+            table = model.__table__
+            rows = [
+                dict(zip(columns, [sign * v for v in values]), **{key: k})
+                for k, values in sorted(totals.items())
+            ]
+            if postgresql:
+                stmt = pg_insert(table)
+                stmt = stmt.on_conflict_do_update(
+                    index_elements=[table.c[key]],
+                    set_={c: table.c[c] + stmt.excluded[c] for c in columns}
+                )
+                self.session.execute(stmt, rows)
+                continue
+            for row in rows:
+                updated = self.session.execute(
+                    table.update().where(table.c[key] == row[key]).values(
+                        {c: table.c[c] + row[c] for c in columns})
+                ).rowcount
+                if not updated:
+                    self.session.execute(table.insert().values(row))
+
+    def initialize_sync_state(self):
+        """
+        Seed the sync state table from the block table for databases that
+        were populated before sync state was tracked. This scans the block
+        table once; afterwards the sync state table is kept up to date as
+        chunks are committed.
+        """
+        if self.session.query(SyncState.range_start).first() is not None:
+            return
+
+        lowest, highest = self.session.query(
+            func.min(Block.number), func.max(Block.number)).one()
+        if lowest is None:
+            return
+
+        self.logger.info('Seeding sync state from existing blocks...')
+        missing = self.get_missing_block_ranges(lowest, highest)
+        for first, last in subtract_ranges(lowest, highest, missing):
+            self.session.add(SyncState(range_start=first, range_end=last))
+        self.session.commit()
+        self.logger.info('Sync state seeded.')
+
+    def create_range_leases(self, ranges, lease_size):
+        """
+        Make sure a lease row exists for every `lease_size`-aligned window
+        that overlaps `ranges`, the currently unsynced block ranges.
+        Existing windows are extended if the chain head has moved past
+        their recorded end, and completed windows that still have unsynced
+        blocks (e.g. blocks geth failed to return) go back to pending.
+        """
+        windows = {}
+        for first, last in ranges:
+            window_start = first - first % lease_size
+            while window_start <= last:
+                window_end = min(window_start + lease_size - 1, last)
+                windows[window_start] = max(
+                    windows.get(window_start, window_end), window_end)
+                window_start += lease_size
+        if not windows:
+            return
+
+        table = RangeLease.__table__
+        stmt = pg_insert(table).values([
+            {'range_start': start, 'range_end': end, 'status': 'pending',
+             'dt_updated': datetime.datetime.utcnow()}
+            for start, end in sorted(windows.items())
+        ])
+        extended = stmt.excluded.range_end > table.c.range_end
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[table.c.range_start],
+            set_={
+                'range_end': case(
+                    [(extended, stmt.excluded.range_end)],
+                    else_=table.c.range_end),
+                'status': case(
+                    [(table.c.status == 'done', 'pending')],
+                    else_=table.c.status),
+            }
+        )
+        self.session.execute(stmt)
+        self.session.commit()
+
+    def lease_range(self, owner, lease_seconds=settings.LEASE_SECONDS):
+        """
+        Lease the lowest pending (or expired) range to `owner`.
+
+        Returns an inclusive (first, last) tuple, or None when there is no
+        work left. Uses SKIP LOCKED so concurrent workers never wait on
+        each other.
+        """
+        now = datetime.datetime.utcnow()
+        lease = self.session.query(RangeLease).filter(
+            RangeLease.status != 'done',
+            or_(RangeLease.status == 'pending', RangeLease.lease_expires < now)
+        ).order_by(
+            RangeLease.range_start
+        ).with_for_update(skip_locked=True).first()
+
+        if lease is None:
+            self.session.commit()
+            return None
+
+        if lease.status == 'leased':
+            self.logger.info(
+                f'Reclaiming expired lease {lease.range_start} from {lease.owner}')
+        lease.status = 'leased'
+        lease.owner = owner
+        lease.lease_expires = now + datetime.timedelta(seconds=lease_seconds)
+        leased = (lease.range_start, lease.range_end)
+        self.session.commit()
+        return leased
+
+    def renew_lease(self, range_start, owner, lease_seconds=settings.LEASE_SECONDS):
+        """
+        Push back the expiry of a lease held by `owner`. Raises LeaseLost if
+        the lease has been reclaimed by another worker.
+        """
+        expires = datetime.datetime.utcnow() + datetime.timedelta(seconds=lease_seconds)
+        updated = self.session.query(RangeLease).filter(
+            RangeLease.range_start == range_start,
+            RangeLease.owner == owner,
+            RangeLease.status == 'leased'
+        ).update({'lease_expires': expires}, synchronize_session=False)
+        self.session.commit()
+        if not updated:
+            raise LeaseLost(f'Lease on range {range_start} is no longer held by {owner}')
+
+    def complete_lease(self, range_start, owner, processed_end):
+        """
+        Release a lease after its range has been processed up to
+        `processed_end`. The lease is marked done unless its range was
+        extended in the meantime, in which case it goes back to pending.
+        """
+        self.session.query(RangeLease).filter(
+            RangeLease.range_start == range_start,
+            RangeLease.owner == owner
+        ).update({
+            'status': case(
+                [(RangeLease.range_end <= processed_end, 'done')],
+                else_='pending'),
+            'owner': None,
+            'lease_expires': None,
+        }, synchronize_session=False)
+        self.session.commit()
+
+    def get_missing_block_ranges(self, start, end, window=settings.GAP_SCAN_WINDOW):
+        """
+        Returns the block numbers in [start, end] that are not in the
+        database as a sorted list of inclusive (first, last) ranges.
+
+        Gaps are found inside the database with a LEAD() window over
+        Block.number, one `window`-sized slice of the chain at a time, so
+        neither the query nor this process ever holds every block number.
+        """
+        ranges = []
+
+        def add(first, last):
+            if first > last:
+                return
+            if ranges and ranges[-1][1] + 1 >= first:
+                ranges[-1] = (ranges[-1][0], max(ranges[-1][1], last))
+            else:
+                ranges.append((first, last))
+
+        for lo in range(start, end + 1, window):
+            hi = min(lo + window - 1, end)
+            in_window = Block.number.between(lo, hi)
+
+            lowest, highest = self.session.query(
+                func.min(Block.number), func.max(Block.number)
+            ).filter(in_window).one()
+            if lowest is None:
+                add(lo, hi)
+                continue
+
+            next_number = func.lead(Block.number).over(order_by=Block.number)
+            numbers = self.session.query(
+                Block.number.label('number'),
+                next_number.label('next_number')
+            ).filter(in_window).subquery()
+            gaps = self.session.query(
+                numbers.c.number + 1, numbers.c.next_number - 1
+            ).filter(numbers.c.next_number > numbers.c.number + 1)
+
+            add(lo, lowest - 1)
+            for first, last in gaps.order_by(numbers.c.number):
+                add(first, last)
+            add(highest + 1, hi)
+
+        return ranges
+
+    def get_highest_stored_block(self):
+        """Returns the highest block number in the block table, or None."""
+        return self.session.query(func.max(Block.number)).scalar()
+
+    def get_block_hashes(self, numbers, batch_size=500):
+        """Returns a dict of block number -> stored hash for `numbers`."""
+        numbers = sorted(set(numbers))
+        hashes = {}
+        for i in range(0, len(numbers), batch_size):
+            results = self.session.query(Block.number, Block.block_hash).filter(
+                Block.number.in_(numbers[i:i + batch_size]))
+            for number, block_hash in results:
+                if block_hash is not None:
+                    hashes[number] = bytes(block_hash)
+        return hashes
+
+    def find_inconsistent_blocks(self, first, last, session=None):
+        """
+        Returns the sorted numbers of blocks in [first, last] that break
+        the chain's invariants, found with two set-based queries:
+
+            a block whose parent_hash is not the hash of the stored block
+            before it; both blocks are reported, as either may be stale
+            a block number whose transactions don't carry the stored
+            block's hash, or that has transactions but no block
+
+        Missing blocks are left to get_missing_block_ranges.
+        """
+        session = session or self.session
+        parent = aliased(Block)
+        bad = set()
+        broken_links = session.query(Block.number).join(
+            parent, parent.number == Block.number - 1
+        ).filter(
+            Block.number.between(first, last),
+            parent.block_hash != Block.parent_hash
+        )
+        for number, in broken_links:
+            bad.update((number - 1, number))
+
+        mismatched = session.query(Transaction.block_number).outerjoin(
+            Block, Block.number == Transaction.block_number
+        ).filter(
+            Transaction.block_number.between(first, last),
+            or_(Block.number.is_(None), Block.block_hash != Transaction.block_hash)
+        ).distinct()
+        bad.update(number for number, in mismatched)
+        return sorted(bad)
+
+    def verify_chain(self, start, end, window=settings.VERIFY_WINDOW,
+                     workers=settings.VERIFY_WORKERS):
+        """
+        Run find_inconsistent_blocks over [start, end] in `window`-block
+        slices, `workers` slices at a time, each on its own connection.
+        Returns the sorted numbers of the inconsistent blocks.
+        """
+        def check(bounds):
+            session = self.Session()
+            try:
+                with self.metrics.timer('verify_seconds'):
+                    return self.find_inconsistent_blocks(*bounds, session=session)
+            finally:
+                session.close()
+
+        windows = [
+            (lo, min(lo + window - 1, end)) for lo in range(start, end + 1, window)]
+        bad = set()
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+            for numbers in executor.map(check, windows):
+                bad.update(numbers)
+        return sorted(bad)
+
+    def create_database_session(self):
+        """
+        Obtains a session on the process's pooled engine, creating the
+        database and its tables the first time the engine is used.
+        """
+        self.engine = get_engine(self.db_url)
+        if prepare_schema(self.engine, self.partition_size, self.logger):
+            self.logger.info("Database schema checked.")
+        # Factory for sessions of worker threads, which must not share
+        # self.session
+        self.Session = sessionmaker(bind=self.engine)
+        return self.Session()
+
+    def close(self):
+        """Return the session's connection to the pool."""
+        self.session.close()
+
+
+class EthereumDatabaseHelper(AbstractDatabaseHelper):
+
+    def __init__(self, loader=settings.DB_LOADER, db_url=settings.DATABASE_URL,
+                 partition_size=settings.PARTITION_SIZE,
+                 address_cache_size=settings.ADDRESS_CACHE_SIZE):
+        """
+        loader :: 'orm' to insert through SQLAlchemy bulk inserts, or 'copy'
+                  to stream rows through PostgreSQL's COPY FROM STDIN
+        db_url :: the SQLAlchemy database URL to connect to
+        partition_size :: blocks per partition if the block and transaction
+                          tables are created partitioned; 0 for plain tables
+        address_cache_size :: address -> id mappings kept in memory
+        """
+        if loader not in ('orm', 'copy'):
+            raise ValueError(f'Unknown loader {loader!r}, expected orm or copy')
+        self.loader = loader
+        # Highest block number the existing partitions can hold
+        self.partitioned_up_to = None
+        self.address_cache = LRUCache(address_cache_size)
+        super().__init__(db_url=db_url, partition_size=partition_size)
+
+    def _check_session(self):
         if self.session is None:
             raise SessionDoesNotExist(
                 'There is no database session created. Initialize a session first.'
             )
 
-        blocks_to_insert = []
+    def copy_columns(self, table, columns, returning=None):
+        """
+        Stream columnar data into `table` with COPY FROM STDIN.
+
+        Rows are first copied into a temporary staging table and then moved
+        across with INSERT ... ON CONFLICT DO NOTHING, so re-loading rows
+        that are already present is a no-op. Runs inside the current
+        session transaction; the caller commits.
+
+        table :: the model class to load into
+        columns :: a dict mapping column name to a list of values
+        returning :: optional column name; its values for the rows actually
+                     inserted (i.e. not already present) are returned
+        """
+        target = f'{table.__table__.schema}.{table.__tablename__}'
+        staging = f'staging_{table.__tablename__}'
+        column_list = ', '.join(columns)
+        labels = {'table': table.__tablename__}
+
+        with self.metrics.timer('row_build_seconds', labels):
+            values = [_copy_column(v) for v in columns.values()]
+
+        cursor = self.session.connection().connection.cursor()
+        try:
+            cursor.execute(
+                f'CREATE TEMP TABLE IF NOT EXISTS {staging} AS '
+                f'SELECT {column_list} FROM {target} WITH NO DATA'
+            )
+            with self.metrics.timer('insert_seconds', labels):
+                cursor.copy_expert(
+                    f'COPY {staging} ({column_list}) FROM STDIN WITH (FORMAT csv)',
+                    _CSVStream(zip(*values))
+                )
+                insert = (
+                    f'INSERT INTO {target} ({column_list}) '
+                    f'SELECT {column_list} FROM {staging} ON CONFLICT DO NOTHING'
+                )
+                if returning:
+                    insert += f' RETURNING {returning}'
+                cursor.execute(insert)
+                inserted = [row[0] for row in cursor.fetchall()] if returning else None
+                cursor.execute(f'TRUNCATE {staging}')
+        finally:
+            cursor.close()
+        return inserted
+
+    def insert_columns(self, table, columns, commit=True, returning=None):
+        """
+        Inserts decoded columns into `table` with the configured loader.
+
+        table :: the model class to load into
+        columns :: a dict mapping column name to a list of values, as
+                   produced by crawler_util.decode_columns
+        commit :: commit the session once the rows are inserted
+        returning :: optional column name whose values for the newly
+                     inserted rows are returned
+
+        Both loaders skip rows that are already present (by primary key or
+        unique constraint), so re-loading blocks is a no-op.
+        """
+        self._check_session()
+
+        num_rows = column_length(columns)
+        if num_rows == 0:
+            return []
+        columns = dict(columns)
+        columns['dt_inserted'] = [datetime.datetime.utcnow()] * num_rows
+
+        self.logger.info(f'Inserting {num_rows} rows into {table.__tablename__}.')
+        labels = {'table': table.__tablename__}
+        if self.loader == 'copy':
+            inserted = self.copy_columns(table, columns, returning)
+        else:
+            inserted = [] if returning else None
+            # Row dicts are built a batch at a time rather than all at once
+            for start in range(0, num_rows, ORM_BATCH_SIZE):
+                batch = {
+                    name: values[start:start + ORM_BATCH_SIZE]
+                    for name, values in columns.items()
+                }
+                with self.metrics.timer('row_build_seconds', labels):
+                    rows = columns_to_rows(batch)
+                with self.metrics.timer('insert_seconds', labels):
+                    batch_inserted = self._insert_new_rows(table, rows, returning)
+                if returning:
+                    inserted.extend(batch_inserted)
+        if commit:
+            with self.metrics.timer('commit_seconds'):
+                self.session.commit()
+        self.metrics.inc('rows_inserted_total', num_rows, labels)
+        self.logger.info(f'{num_rows} rows inserted into {table.__tablename__}.')
+        return inserted
+
+    def _insert_new_rows(self, table, rows, returning=None):
+        """
+        Insert row dicts into `table`, skipping rows that conflict with one
+        already present. Returns the `returning` column of the rows that
+        were inserted, if given.
+        """
+        target = table.__table__
+        if self._is_postgresql():
+            stmt = pg_insert(target).values(rows).on_conflict_do_nothing()
+            if returning:
+                stmt = stmt.returning(target.c[returning])
+                return [value for value, in self.session.execute(stmt)]
+            self.session.execute(stmt)
+            return None
+
+        existing = set()
+        if returning:
+            column = target.c[returning]
+            values = [row[returning] for row in rows]
+            for start in range(0, len(values), 500):
+                existing.update(value for value, in self.session.query(column).filter(
+                    column.in_(values[start:start + 500])))
+        self.session.execute(
+            target.insert().prefix_with('OR IGNORE'), rows)
+        if returning:
+            return [row[returning] for row in rows if row[returning] not in existing]
+        return None
 
+    def insert_blocks(self, block_list, commit=True):
+        """
+        Inserts blocks to the initialized database.
+
+        block_list :: a list of json-decoded block objects
+        commit :: commit the session once the blocks are inserted
+        """
         self.logger.info(f'Parsing {len(block_list)} blocks...')
-        for b in block_list:
-            block = {}
-            block['number'] = int(b['number'], 16)
-            block['block_hash'] = b['hash']
-            block['parent_hash'] = b['parentHash']
-            block['nonce'] = b['nonce']
-            block['transactions_root'] = b['transactionsRoot']
-            block['state_root'] = b['stateRoot']
-            block['receipt_root'] = b['receiptsRoot']
-            block['miner'] = b['miner']
-            block['difficulty'] = b['difficulty']
-            block['total_difficulty'] = b['totalDifficulty']
-            block['size'] = int(b['size'], 16)
-            block['gas_limit'] = int(b['gasLimit'], 16)
-            block['gase_used'] = int(b['gasUsed'], 16)
-            block['timestamp'] = convert_base_16_unix_time_to_datetime(b['timestamp'])
-
-            blocks_to_insert.append(Block(**block))
-
-        num_blocks = len(blocks_to_insert)
-        self.logger.info(f'Inserting {num_blocks} blocks to the database.')
-        self.session.bulk_save_objects(blocks_to_insert)
-        self.session.commit()
-        self.logger.info(f'{num_blocks} blocks inserted.')
+        self.insert_columns(Block, decode_block_columns(block_list), commit)
 
-    def insert_transactions(self, transaction_list):
+    def insert_transactions(self, transaction_list, commit=True):
         """
         Inserts transactions to the initialized database.
 
         transaction_list :: a list of json-decoded transaction objects
+        commit :: commit the session once the transactions are inserted
         """
-        if self.session is None:
-            raise SessionDoesNotExist(
-                'There is no database session created. Initialize a session first.'
-            )
+        self.logger.info(f'Parsing {len(transaction_list)} transactions...')
+        self.insert_columns(
+            Transaction,
+            self.encode_addresses(decode_transaction_columns(transaction_list)),
+            commit
+        )
 
-        transactions_to_insert = []
+    def _lookup_addresses(self, addresses, batch_size=500):
+        """Returns a dict of address -> id for those of `addresses` stored."""
+        addresses = sorted(addresses)
+        found = {}
+        for i in range(0, len(addresses), batch_size):
+            results = self.session.query(Address.address, Address.id).filter(
+                Address.address.in_(addresses[i:i + batch_size]))
+            for address, address_id in results:
+                found[bytes(address)] = address_id
+        return found
 
-        self.logger.info(f'Parsing {len(transaction_list)} transactions...')
-        for t in transaction_list:
-            transaction = {}
-            transaction['transaction_hash'] = int(t['hash'], 16)
-            transaction['block_number'] = int(t['blockNumber'], 16)
-            transaction['block_hash'] = t['blockHash']
-            transaction['nonce'] = t['nonce']
-            transaction['transaction_index'] = int(t['transactionIndex'], 16)
-            transaction['sender'] = t['from']
-            transaction['receipt'] = t['to']
-            transaction['value'] = int(t['value'], 16)/1000000000000000000.
-            transaction['gas'] = int(t['gas'], 16)
-            transaction['gas_price'] = int(t['gasPrice'], 16)
-
-            transactions_to_insert.append(Transaction(**transaction))
-
-        num_transactions = len(transactions_to_insert)
-        self.logger.info(f'Inserting {num_transactions} transactions to the database.')
-        self.session.bulk_save_objects(transactions_to_insert)
+    def resolve_addresses(self, addresses):
+        """
+        Map raw addresses to their ids in the address table, adding any
+        that are new. Addresses are looked up in the LRU cache first, and
+        the misses resolved in batches. Commits, so new addresses are
+        visible to other workers straight away.
+
+        Returns a dict of address -> id; None is ignored.
+        """
+        ids = {}
+        misses = set()
+        for address in set(addresses):
+            if address is None:
+                continue
+            address_id = self.address_cache.get(address)
+            if address_id is None:
+                misses.add(address)
+            else:
+                ids[address] = address_id
+        self.metrics.inc('address_cache_hits_total', len(ids))
+        self.metrics.inc('address_cache_misses_total', len(misses))
+        if not misses:
+            return ids
+
+        try:
+            with self.metrics.timer('address_resolve_seconds'):
+                found = self._lookup_addresses(misses)
+                new = sorted(misses.difference(found))
+                if new:
+                    # Sorted, so concurrent workers lock rows in the same order
+                    now = datetime.datetime.utcnow()
+                    rows = [{'address': a, 'dt_inserted': now} for a in new]
+                    if self._is_postgresql():
+                        stmt = pg_insert(Address.__table__).on_conflict_do_nothing()
+                    else:
+                        stmt = Address.__table__.insert().prefix_with('OR IGNORE')
+                    self.session.execute(stmt, rows)
+                    found.update(self._lookup_addresses(new))
+                self.session.commit()
+        except:
+            self.session.rollback()
+            raise
+
+        for address, address_id in found.items():
+            self.address_cache.put(address, address_id)
+        ids.update(found)
+        return ids
+
+    def encode_addresses(self, transaction_columns):
+        """
+        Replace the raw `sender` and `receipt` columns of decoded
+        transaction columns with `sender_id` and `receipt_id` columns of
+        address ids. Returns a new dict.
+        """
+        columns = dict(transaction_columns)
+        senders = columns.pop('sender', [])
+        receipts = columns.pop('receipt', [])
+        ids = self.resolve_addresses(senders + receipts).get
+        columns['sender_id'] = [ids(a) for a in senders]
+        columns['receipt_id'] = [ids(a) for a in receipts]
+        return columns
+
+    def migrate_to_binary_storage(self):
+        """
+        Convert a PostgreSQL database created with hex-string columns to the
+        binary schema: hashes and addresses to BYTEA, difficulties to
+        NUMERIC(78, 0), transaction nonces to BIGINT and values to
+        NUMERIC(78, 18). Transaction hashes written as decimal integers by
+        older loaders are converted too. Safe to re-run; does nothing once
+        the block table has been migrated.
+        """
+        schema = settings.ETHEREUM_SCHEMA
+        column_type = self.session.execute(
+            "SELECT data_type FROM information_schema.columns "
+            "WHERE table_schema = :schema AND table_name = 'block' "
+            "AND column_name = 'block_hash'",
+            {'schema': schema}
+        ).scalar()
+        if column_type is None or column_type == 'bytea':
+            self.logger.info('Binary storage migration not needed.')
+            return
+
+        hex_to_bytea = "decode(substring({0} from 3), 'hex')"
+        hex_to_numeric = "pg_temp.hex_to_numeric(substring({0} from 3))"
+        statements = [
+            # Exact hex -> numeric for values wider than 64 bits
+            """CREATE FUNCTION pg_temp.hex_to_numeric(h text) RETURNS numeric AS $$
+                SELECT coalesce(sum(
+                    ('x' || lpad(substr(h, i, 1), 8, '0'))::bit(32)::int::numeric
+                    * 16::numeric ^ (length(h) - i)), 0)
+                FROM generate_series(1, length(h)) AS i
+            $$ LANGUAGE sql IMMUTABLE""",
+            # Transaction hashes stored as decimal text by the old loader
+            """CREATE FUNCTION pg_temp.numeric_to_bytea(n numeric, width int)
+            RETURNS bytea AS $$
+            DECLARE
+                result bytea := ''::bytea;
+                v numeric := n;
+            BEGIN
+                WHILE v > 0 LOOP
+                    result := decode(lpad(to_hex(mod(v, 256)::int), 2, '0'), 'hex') || result;
+                    v := div(v, 256);
+                END LOOP;
+                RETURN decode(repeat('00', greatest(width - length(result), 0)), 'hex') || result;
+            END
+            $$ LANGUAGE plpgsql IMMUTABLE""",
+            f"ALTER TABLE {schema}.transaction "
+            f"DROP CONSTRAINT IF EXISTS transaction_block_hash_fkey",
+        ]
+        for column in ('block_hash', 'parent_hash', 'nonce', 'transactions_root',
+                       'state_root', 'receipt_root', 'miner'):
+            statements.append(
+                f"ALTER TABLE {schema}.block ALTER COLUMN {column} TYPE bytea "
+                f"USING {hex_to_bytea.format(column)}")
+        for column in ('difficulty', 'total_difficulty'):
+            statements.append(
+                f"ALTER TABLE {schema}.block ALTER COLUMN {column} TYPE numeric(78, 0) "
+                f"USING {hex_to_numeric.format(column)}")
+        for column in ('block_hash', 'sender', 'receipt'):
+            statements.append(
+                f"ALTER TABLE {schema}.transaction ALTER COLUMN {column} TYPE bytea "
+                f"USING {hex_to_bytea.format(column)}")
+        statements += [
+            f"ALTER TABLE {schema}.transaction ALTER COLUMN transaction_hash TYPE bytea "
+            f"USING CASE WHEN transaction_hash LIKE '0x%' "
+            f"THEN {hex_to_bytea.format('transaction_hash')} "
+            f"ELSE pg_temp.numeric_to_bytea(transaction_hash::numeric, 32) END",
+            f"ALTER TABLE {schema}.transaction ALTER COLUMN nonce TYPE bigint "
+            f"USING {hex_to_numeric.format('nonce')}::bigint",
+            f"ALTER TABLE {schema}.transaction ALTER COLUMN value TYPE numeric(78, 18)",
+            f"ALTER TABLE {schema}.transaction ADD CONSTRAINT transaction_block_hash_fkey "
+            f"FOREIGN KEY (block_hash) REFERENCES {schema}.block (block_hash)",
+        ]
+
+        self.logger.info('Migrating hashes and addresses to binary storage...')
+        try:
+            for statement in statements:
+                self.session.execute(statement)
+            self.session.commit()
+        except:
+            self.session.rollback()
+            raise
+        self.logger.info('Binary storage migration complete.')
+
+    def migrate_to_address_ids(self):
+        """
+        Move the raw sender and receipt columns of an existing PostgreSQL
+        transaction table into the address table, replacing them with
+        sender_id and receipt_id references. Run after
+        `migrate_to_binary_storage`. Safe to re-run; does nothing once
+        the columns have been replaced.
+        """
+        schema = settings.ETHEREUM_SCHEMA
+        has_sender = self.session.execute(
+            "SELECT count(*) FROM information_schema.columns "
+            "WHERE table_schema = :schema AND table_name = 'transaction' "
+            "AND column_name = 'sender'",
+            {'schema': schema}
+        ).scalar()
+        if not has_sender:
+            self.logger.info('Address id migration not needed.')
+            return
+
+        transaction = f'{schema}.transaction'
+        statements = [
+            f"INSERT INTO {schema}.address (address, dt_inserted) "
+            f"SELECT a, now() FROM ("
+            f"SELECT sender AS a FROM {transaction} "
+            f"UNION SELECT receipt FROM {transaction}) AS seen "
+            f"WHERE a IS NOT NULL ORDER BY a ON CONFLICT DO NOTHING",
+            f"ALTER TABLE {transaction} "
+            f"ADD COLUMN IF NOT EXISTS sender_id bigint, "
+            f"ADD COLUMN IF NOT EXISTS receipt_id bigint",
+            f"UPDATE {transaction} t SET sender_id = a.id "
+            f"FROM {schema}.address a WHERE a.address = t.sender",
+            f"UPDATE {transaction} t SET receipt_id = a.id "
+            f"FROM {schema}.address a WHERE a.address = t.receipt",
+            f"ALTER TABLE {transaction} DROP COLUMN sender, DROP COLUMN receipt",
+            f"CREATE INDEX ix_{schema}_transaction_sender_id ON {transaction} (sender_id)",
+            f"CREATE INDEX ix_{schema}_transaction_receipt_id ON {transaction} (receipt_id)",
+            f"ALTER TABLE {transaction} ADD CONSTRAINT transaction_sender_id_fkey "
+            f"FOREIGN KEY (sender_id) REFERENCES {schema}.address (id)",
+            f"ALTER TABLE {transaction} ADD CONSTRAINT transaction_receipt_id_fkey "
+            f"FOREIGN KEY (receipt_id) REFERENCES {schema}.address (id)",
+        ]
+
+        self.logger.info('Migrating transaction addresses to the address table...')
+        try:
+            for statement in statements:
+                self.session.execute(statement)
+            self.session.commit()
+        except:
+            self.session.rollback()
+            raise
+        self.logger.info('Address id migration complete.')
+
+    def rebuild_rollups(self):
+        """
+        Recompute the rollup tables from scratch, e.g. after a bulk
+        backfill run with MAINTAIN_ROLLUPS disabled. On PostgreSQL this
+        is a set-based GROUP BY per table; elsewhere the blocks are
+        streamed through the same code as incremental updates.
+        """
+        schema = settings.ETHEREUM_SCHEMA
+        self.logger.info('Rebuilding rollup tables...')
+        try:
+            for model, _, _ in rollup_util.ROLLUPS:
+                self.session.query(model).delete(synchronize_session=False)
+            if self._is_postgresql():
+                statements = [
+                    f"INSERT INTO {schema}.daily_stats "
+                    f"(day, block_count, transaction_count, gas_used) "
+                    f"SELECT b.timestamp::date, count(*), coalesce(sum(t.n), 0), "
+                    f"coalesce(sum(b.gase_used), 0) FROM {schema}.block b "
+                    f"LEFT JOIN (SELECT block_number, count(*) AS n "
+                    f"FROM {schema}.transaction GROUP BY block_number) t "
+                    f"ON t.block_number = b.number GROUP BY 1",
+                    f"INSERT INTO {schema}.sender_stats (sender_id, transaction_count, value) "
+                    f"SELECT sender_id, count(*), coalesce(sum(value), 0) "
+                    f"FROM {schema}.transaction WHERE sender_id IS NOT NULL "
+                    f"GROUP BY sender_id",
+                    f"INSERT INTO {schema}.miner_stats (miner, block_count, gas_used) "
+                    f"SELECT miner, count(*), coalesce(sum(gase_used), 0) "
+                    f"FROM {schema}.block WHERE miner IS NOT NULL GROUP BY miner",
+                ]
+                for statement in statements:
+                    self.session.execute(statement)
+            else:
+                lowest, highest = self.session.query(
+                    func.min(Block.number), func.max(Block.number)).one()
+                window = settings.GAP_SCAN_WINDOW
+                for lo in range(lowest or 0, (highest or -1) + 1, window):
+                    hi = lo + window - 1
+                    blocks = self.session.query(
+                        *[getattr(Block, c) for c in rollup_util.BLOCK_COLUMNS]
+                    ).filter(Block.number.between(lo, hi)).all()
+                    transactions = self.session.query(
+                        *[getattr(Transaction, c) for c in rollup_util.TRANSACTION_COLUMNS]
+                    ).filter(Transaction.block_number.between(lo, hi)).all()
+                    self.apply_rollup_deltas(rollup_util.rollup_deltas(
+                        rows_to_columns(rollup_util.BLOCK_COLUMNS, blocks),
+                        rows_to_columns(rollup_util.TRANSACTION_COLUMNS, transactions)))
+            self.session.commit()
+        except:
+            self.session.rollback()
+            raise
+        self.logger.info('Rollup tables rebuilt.')
+
+    def _is_postgresql(self):
+        return self.session.get_bind().dialect.name == 'postgresql'
+
+    def ensure_partitions(self, last_block):
+        """
+        Create the block and transaction partitions needed to hold blocks
+        up to `last_block`, plus one spare so that ingest crossing a
+        partition boundary never waits on DDL. Does nothing unless the
+        tables were created partitioned.
+
+        Call this outside of chunk transactions: attaching a partition
+        locks the parent table until commit.
+        """
+        if not self.partition_size or not self._is_postgresql():
+            return
+        if self.partitioned_up_to is None:
+            partitioned = self.session.execute(
+                "SELECT count(*) FROM pg_partitioned_table p "
+                "JOIN pg_class c ON c.oid = p.partrelid "
+                "JOIN pg_namespace n ON n.oid = c.relnamespace "
+                "WHERE n.nspname = :schema AND c.relname = 'block'",
+                {'schema': settings.ETHEREUM_SCHEMA}
+            ).scalar()
+            self.session.commit()
+            if not partitioned:
+                self.partition_size = 0
+                return
+            self.partitioned_up_to = -1
+        if last_block <= self.partitioned_up_to:
+            return
+
+        schema = settings.ETHEREUM_SCHEMA
+        size = self.partition_size
+        first = self.partitioned_up_to + 1
+        last = last_block - last_block % size + 2 * size
+        with self.session.get_bind().begin() as connection:
+            for start in range(first - first % size, last, size):
+                for table in PARTITIONED_TABLES:
+                    connection.execute(
+                        f'CREATE TABLE IF NOT EXISTS {schema}.{table}_p{start} '
+                        f'PARTITION OF {schema}.{table} '
+                        f'FOR VALUES FROM ({start}) TO ({start + size})')
+        self.partitioned_up_to = last - 1
+        self.logger.info(f'Partitions cover blocks up to {last - 1}.')
+
+    def defer_indexes(self, brin=True):
+        """
+        Prepare for a bulk load by dropping the non-unique secondary
+        indexes and foreign keys of the BULK_LOAD_TABLES, recording the
+        DDL to rebuild each in the deferred index table. With `brin`,
+        B-tree indexes on monotone columns (BRIN_COLUMNS) are rebuilt as
+        BRIN indexes.
+
+        Primary keys and unique constraints are kept: ON CONFLICT DO
+        NOTHING relies on them to skip rows that are already loaded (a
+        replay, a dead-letter retry, an overlapping re-run), and the
+        rollups only count the blocks it actually inserts.
+
+        Returns the number of indexes and foreign keys deferred.
+        """
+        if not self._is_postgresql():
+            self.logger.warning('Deferring indexes needs PostgreSQL; skipped.')
+            return 0
+
+        schema = settings.ETHEREUM_SCHEMA
+        params = {'schema': schema, 'tables': BULK_LOAD_TABLES}
+        foreign_keys = self.session.execute(
+            "SELECT con.conname, t.relname, "
+            "pg_get_constraintdef(con.oid) "
+            "FROM pg_constraint con "
+            "JOIN pg_class t ON t.oid = con.conrelid "
+            "JOIN pg_namespace n ON n.oid = t.relnamespace "
+            "WHERE n.nspname = :schema AND t.relname IN :tables "
+            "AND con.contype = 'f' "
+            "ORDER BY con.conname", params
+        ).fetchall()
+        indexes = self.session.execute(
+            "SELECT c.relname, t.relname, pg_get_indexdef(i.indexrelid) "
+            "FROM pg_index i "
+            "JOIN pg_class c ON c.oid = i.indexrelid "
+            "JOIN pg_class t ON t.oid = i.indrelid "
+            "JOIN pg_namespace n ON n.oid = t.relnamespace "
+            "WHERE n.nspname = :schema AND t.relname IN :tables "
+            "AND NOT i.indisprimary AND NOT i.indisunique AND NOT EXISTS ("
+            "  SELECT 1 FROM pg_constraint con "
+            "  WHERE con.conrelid = t.oid AND con.conindid = i.indexrelid) "
+            "ORDER BY c.relname", params
+        ).fetchall()
+
+        try:
+            for name, table, definition in foreign_keys:
+                target = f'{schema}.{table}'
+                rebuild = f'ALTER TABLE {target} ADD CONSTRAINT {name} {definition}'
+                self.session.add(DeferredIndex(
+                    name=name, table_name=table, kind='foreign_key',
+                    definition=rebuild))
+                self.session.execute(f'ALTER TABLE {target} DROP CONSTRAINT {name}')
+            for name, table, definition in indexes:
+                definition = _recursive_index_definition(definition)
+                if brin:
+                    definition = _brin_index_definition(definition, table)
+                self.session.add(DeferredIndex(
+                    name=name, table_name=table, kind='index', definition=definition))
+                self.session.execute(f'DROP INDEX {schema}.{name}')
+            self.session.commit()
+        except:
+            self.session.rollback()
+            raise
+
+        deferred = len(foreign_keys) + len(indexes)
+        self.logger.info(f'Deferred {deferred} indexes and foreign keys for bulk load.')
+        return deferred
+
+    def rebuild_deferred_indexes(self, workers=settings.INDEX_BUILD_WORKERS):
+        """
+        Rebuild everything dropped by `defer_indexes`, `workers` at a time,
+        each on its own connection: first the indexes (and any unique
+        constraints deferred by older versions), then the foreign keys.
+        The tables are analyzed afterwards.
+
+        Each rebuild commits on its own, so after a failure this can
+        simply be run again.
+        """
+        deferred = self.session.query(
+            DeferredIndex.name, DeferredIndex.kind, DeferredIndex.definition
+        ).order_by(DeferredIndex.name).all()
+        self.session.commit()
+        if not deferred:
+            return
+
+        engine = self.session.get_bind()
+        table = DeferredIndex.__table__
+
+        def rebuild(entry):
+            name, kind, definition = entry
+            self.logger.info(f'Rebuilding {name}...')
+            with self.metrics.timer('index_build_seconds', {'kind': kind}):
+                with engine.begin() as connection:
+                    connection.execute(
+                        f"SET LOCAL maintenance_work_mem = '{settings.INDEX_BUILD_MEMORY}'")
+                    # Definitions recorded by older versions may still
+                    # say ON ONLY
+                    connection.execute(_recursive_index_definition(definition))
+                    connection.execute(table.delete().where(table.c.name == name))
+            self.logger.info(f'Rebuilt {name}.')
+
+        phases = (
+            [d for d in deferred if d.kind != 'foreign_key'],
+            [d for d in deferred if d.kind == 'foreign_key'],
+        )
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+            for phase in phases:
+                # list() waits for the phase and re-raises the first failure
+                list(executor.map(rebuild, phase))
+
+        invalid = self.get_invalid_indexes()
+        if invalid:
+            raise InvalidIndexes(
+                f'Rebuilt indexes are not valid: {", ".join(invalid)}. Drop '
+                'and recreate them (e.g. with REINDEX) before querying.')
+
+        with engine.begin() as connection:
+            for name in BULK_LOAD_TABLES:
+                connection.execute(f'ANALYZE {settings.ETHEREUM_SCHEMA}.{name}')
+        self.logger.info(f'Rebuilt {len(deferred)} indexes and constraints.')
+
+    def get_invalid_indexes(self):
+        """
+        Returns the names of the indexes in the ethereum schema that
+        PostgreSQL marks as not valid, e.g. a partitioned index missing on
+        some partitions or a failed concurrent build.
+        """
+        results = self.session.execute(
+            "SELECT c.relname FROM pg_index i "
+            "JOIN pg_class c ON c.oid = i.indexrelid "
+            "JOIN pg_namespace n ON n.oid = c.relnamespace "
+            "WHERE n.nspname = :schema AND NOT i.indisvalid "
+            "ORDER BY c.relname", {'schema': settings.ETHEREUM_SCHEMA}
+        ).fetchall()
         self.session.commit()
-        self.logger.info(f'{num_transactions} transactions inserted.')
+        return [name for name, in results]
+
+    def insert_chunk(self, block_columns, transaction_columns, synced_ranges=(),
+                     receipt_columns=None, log_columns=None):
+        """
+        Inserts decoded block, transaction and (optionally) receipt and
+        log columns and records `synced_ranges` in the sync state table,
+        all in a single transaction. On failure the session is rolled
+        back and the exception re-raised.
+
+        synced_ranges :: inclusive (first, last) ranges fully covered by
+                         `block_columns`
+        """
+        # Addresses are committed first, in their own short transaction
+        transaction_columns = self.encode_addresses(transaction_columns)
+        try:
+            new_blocks = self.insert_columns(
+                Block, block_columns, commit=False, returning='number')
+            self.insert_columns(Transaction, transaction_columns, commit=False)
+            if receipt_columns is not None:
+                self.insert_columns(Receipt, receipt_columns, commit=False)
+            if log_columns is not None:
+                self.insert_columns(Log, log_columns, commit=False)
+            if self.rollups and new_blocks:
+                with self.metrics.timer('rollup_seconds'):
+                    self.apply_rollup_deltas(rollup_util.rollup_deltas(
+                        block_columns, transaction_columns, set(new_blocks)))
+            for first, last in synced_ranges:
+                self.mark_range_synced(first, last)
+            numbers = block_columns['number']
+            payload = self._announce_chain_change(
+                f'commit:{min(numbers)}:{max(numbers)}') if numbers else None
+            with self.metrics.timer('commit_seconds'):
+                self.session.commit()
+        except:
+            self.session.rollback()
+            self.metrics.inc('insert_errors_total')
+            raise
+        if payload is not None:
+            self._chain_changed(payload)
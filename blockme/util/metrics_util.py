@@ -0,0 +1,284 @@
+"""
+In-process metrics for the crawler and database helpers.
+
+A single registry per process collects:
+
+    counters :: monotonically increasing totals (blocks, txs, errors, retries)
+    histograms :: latency distributions with fixed buckets
+    gauges :: values sampled when read, e.g. queue depths
+
+and exposes them as Prometheus text over HTTP (`MetricsServer`) and/or as
+a JSON file rewritten periodically (`StatsFileWriter`).
+
+Stages named in settings.PROFILE_STAGES are additionally run under
+cProfile, and the accumulated profiles are written to settings.PROFILE_DIR
+as <stage>.prof.
+"""
+import contextlib
+import cProfile
+import json
+import os
+import pstats
+import threading
+import time
+
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+import settings
+
+
+DEFAULT_BUCKETS = (
+    0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+registry_cache = {}
+
+
+def _key(name, labels):
+    return (name, tuple(sorted((labels or {}).items())))
+
+
+def _format_labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{k}="{v}"' for k, v in pairs) + '}'
+
+
+class Histogram(object):
+    """A cumulative-bucket histogram of observed values."""
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * len(self.buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+
+    def cumulative(self):
+        total = 0
+        result = []
+        for bound, count in zip(self.buckets, self.counts):
+            total += count
+            result.append((bound, total))
+        return result
+
+
+class MetricsRegistry(object):
+    """
+    Thread-safe store of counters, histograms and gauges.
+
+    Metrics are identified by a name plus an optional dict of labels.
+    """
+
+    def __init__(self, profile_stages=(), profile_dir=None):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+        self.gauges = {}
+        self.profile_stages = set(profile_stages)
+        self.profile_dir = profile_dir
+        self.profiles = {}
+        self.profiler_lock = threading.Lock()
+
+    def inc(self, name, amount=1, labels=None):
+        """Increment a counter."""
+        key = _key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def value(self, name, labels=None):
+        """Returns the current value of a counter."""
+        return self.counters.get(_key(name, labels), 0)
+
+    def observe(self, name, value, labels=None):
+        """Record a value in a histogram."""
+        key = _key(name, labels)
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(value)
+
+    def set_gauge(self, name, func, labels=None):
+        """Register a callable returning a gauge's current value."""
+        with self.lock:
+            self.gauges[_key(name, labels)] = func
+
+    def remove_gauge(self, name, labels=None):
+        with self.lock:
+            self.gauges.pop(_key(name, labels), None)
+
+    @contextlib.contextmanager
+    def timer(self, name, labels=None):
+        """
+        Time the enclosed block into the `name` histogram (in seconds).
+
+        If `name` is one of the profiled stages the block also runs under
+        cProfile. Only one thread is profiled at a time; calls that find
+        the profiler busy are timed but not profiled.
+        """
+        profiler = None
+        if name in self.profile_stages and self.profiler_lock.acquire(blocking=False):
+            profiler = cProfile.Profile()
+            profiler.enable()
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(name, time.monotonic() - started, labels)
+            if profiler is not None:
+                profiler.disable()
+                self.profiler_lock.release()
+                with self.lock:
+                    stats = self.profiles.get(name)
+                    if stats is None:
+                        self.profiles[name] = pstats.Stats(profiler)
+                    else:
+                        stats.add(profiler)
+
+    def dump_profiles(self):
+        """Write accumulated per-stage profiles to the profile directory."""
+        if not self.profile_dir:
+            return
+        os.makedirs(self.profile_dir, exist_ok=True)
+        with self.lock:
+            for name, stats in self.profiles.items():
+                stats.dump_stats(os.path.join(self.profile_dir, f'{name}.prof'))
+
+    def _read_gauges(self):
+        with self.lock:
+            gauges = list(self.gauges.items())
+        values = []
+        for key, func in gauges:
+            try:
+                values.append((key, func()))
+            except Exception:
+                continue
+        return values
+
+    def snapshot(self):
+        """Returns every metric as a JSON-serialisable dict."""
+        def name_of(key):
+            name, labels = key
+            return name + _format_labels(labels)
+
+        with self.lock:
+            counters = {name_of(k): v for k, v in self.counters.items()}
+            histograms = {
+                name_of(k): {
+                    'count': h.count,
+                    'sum': h.sum,
+                    'mean': h.sum / h.count if h.count else None,
+                    'buckets': {str(b): c for b, c in h.cumulative()},
+                }
+                for k, h in self.histograms.items()
+            }
+        gauges = {name_of(k): v for k, v in self._read_gauges()}
+        return {
+            'timestamp': time.time(),
+            'counters': counters,
+            'histograms': histograms,
+            'gauges': gauges,
+        }
+
+    def render_prometheus(self):
+        """Returns every metric in the Prometheus text exposition format."""
+        lines = []
+        with self.lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted(
+                (k, (h.cumulative(), h.count, h.sum))
+                for k, h in self.histograms.items())
+        for (name, labels), value in counters:
+            lines.append(f'blockme_{name}{_format_labels(labels)} {value}')
+        for (name, labels), (cumulative, count, total) in histograms:
+            for bound, c in cumulative:
+                lines.append(
+                    f'blockme_{name}_bucket'
+                    f'{_format_labels(labels, [("le", bound)])} {c}')
+            lines.append(
+                f'blockme_{name}_bucket{_format_labels(labels, [("le", "+Inf")])} {count}')
+            lines.append(f'blockme_{name}_sum{_format_labels(labels)} {total}')
+            lines.append(f'blockme_{name}_count{_format_labels(labels)} {count}')
+        for (name, labels), value in sorted(self._read_gauges()):
+            lines.append(f'blockme_{name}{_format_labels(labels)} {value}')
+        return '\n'.join(lines) + '\n'
+
+
+def get_metrics_registry():
+    """
+    Utility to obtain the process-wide metrics registry.
+    """
+    if registry_cache.get('registry') is None:
+        stages = [s for s in settings.PROFILE_STAGES.split(',') if s]
+        registry_cache['registry'] = MetricsRegistry(
+            profile_stages=stages, profile_dir=settings.PROFILE_DIR)
+    return registry_cache['registry']
+
+
+class MetricsServer(object):
+    """Serve a registry as Prometheus text on http://host:port/metrics."""
+
+    def __init__(self, registry, port, host='0.0.0.0'):
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] not in ('/', '/metrics'):
+                    self.send_error(404)
+                    return
+                body = registry.render_prometheus().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = HTTPServer((host, port), Handler)
+        self.thread = threading.Thread(
+            target=self.server.serve_forever, daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class StatsFileWriter(object):
+    """Rewrite a JSON snapshot of a registry to `path` every `interval` seconds."""
+
+    def __init__(self, registry, path, interval=10.0):
+        self.registry = registry
+        self.path = path
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._loop, daemon=True)
+
+    def write(self):
+        tmp = f'{self.path}.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self.registry.snapshot(), f, indent=2, sort_keys=True)
+        os.replace(tmp, self.path)
+
+    def _loop(self):
+        while not self.stopped.wait(self.interval):
+            self.write()
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stopped.set()
+        self.write()
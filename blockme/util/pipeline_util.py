@@ -0,0 +1,188 @@
+"""
+A small threaded pipeline used to overlap RPC fetching, decoding and
+database writes.
+
+Work items flow through three stages connected by bounded queues:
+
+    fetchers (N threads) -> decoders (M threads) -> writer (1 thread)
+
+The writer commits items strictly in the order they were submitted so
+that a crawl killed part way through never leaves holes behind the
+last committed item.
+"""
+import queue
+import threading
+import time
+
+from blockme.util.logging_util import get_blockme_console_logger
+
+
+_STOP = object()
+
+
+class PipelineError(Exception):
+    pass
+
+
+class OrderedPipeline(object):
+    """
+    Run `fetch`, `decode` and `write` over a stream of work items.
+
+    fetch :: callable(item) -> raw, run concurrently by `fetchers` threads
+    decode :: callable(item, raw) -> decoded, run by `decoders` threads
+    write :: callable(item, decoded), run by a single thread in submit order
+
+    `max_in_flight` bounds the number of items that have been submitted
+    but not yet written, which bounds memory regardless of how far the
+    fetchers get ahead of the writer.
+    """
+
+    def __init__(self, fetch, decode, write, fetchers=4, decoders=2,
+                 max_in_flight=8):
+        self.logger = get_blockme_console_logger()
+        self.fetch = fetch
+        self.decode = decode
+        self.write = write
+        self.fetchers = max(1, fetchers)
+        self.decoders = max(1, decoders)
+        self.max_in_flight = max(1, max_in_flight)
+
+        self.fetch_queue = queue.Queue(maxsize=self.max_in_flight)
+        self.decode_queue = queue.Queue(maxsize=self.max_in_flight)
+        self.write_queue = queue.Queue(maxsize=self.max_in_flight)
+        self.in_flight = threading.BoundedSemaphore(self.max_in_flight)
+
+        self.stopped = threading.Event()
+        self.errors = []
+
+        # Seconds spent inside each stage, summed over its threads
+        self.stage_seconds = {'fetch': 0.0, 'decode': 0.0, 'write': 0.0}
+        self.items_written = 0
+        self._stats_lock = threading.Lock()
+
+    def queue_depths(self):
+        """Returns the current depth of each stage's input queue."""
+        return {
+            'fetch': self.fetch_queue.qsize(),
+            'decode': self.decode_queue.qsize(),
+            'write': self.write_queue.qsize(),
+        }
+
+    def _timed(self, stage, func, *args):
+        started = time.monotonic()
+        try:
+            return func(*args)
+        finally:
+            elapsed = time.monotonic() - started
+            with self._stats_lock:
+                self.stage_seconds[stage] += elapsed
+
+    def _fail(self, stage, item, exc):
+        self.logger.error(f'Pipeline {stage} stage failed on {item!r}: {exc!r}')
+        self.errors.append(exc)
+        self.stopped.set()
+
+    def _put(self, q, entry):
+        """Put onto a bounded queue without blocking forever after a failure."""
+        while not self.stopped.is_set():
+            try:
+                q.put(entry, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _fetch_worker(self):
+        while True:
+            entry = self.fetch_queue.get()
+            if entry is _STOP:
+                break
+            seq, item = entry
+            if self.stopped.is_set():
+                continue
+            try:
+                raw = self._timed('fetch', self.fetch, item)
+            except Exception as e:
+                self._fail('fetch', item, e)
+                continue
+            self._put(self.decode_queue, (seq, item, raw))
+
+    def _decode_worker(self):
+        while True:
+            entry = self.decode_queue.get()
+            if entry is _STOP:
+                break
+            seq, item, raw = entry
+            if self.stopped.is_set():
+                continue
+            try:
+                decoded = self._timed('decode', self.decode, item, raw)
+            except Exception as e:
+                self._fail('decode', item, e)
+                continue
+            self._put(self.write_queue, (seq, item, decoded))
+
+    def _write_worker(self):
+        pending = {}
+        next_seq = 0
+        while True:
+            entry = self.write_queue.get()
+            if entry is _STOP:
+                break
+            seq, item, decoded = entry
+            pending[seq] = (item, decoded)
+            # Only commit once every earlier item has been committed
+            while next_seq in pending and not self.stopped.is_set():
+                item, decoded = pending.pop(next_seq)
+                try:
+                    self._timed('write', self.write, item, decoded)
+                except Exception as e:
+                    self._fail('write', item, e)
+                    break
+                next_seq += 1
+                self.items_written += 1
+                self.in_flight.release()
+
+    def _start(self, target, count):
+        threads = [
+            threading.Thread(target=target, daemon=True) for _ in range(count)
+        ]
+        for t in threads:
+            t.start()
+        return threads
+
+    def _stop(self, q, threads):
+        for _ in threads:
+            q.put(_STOP)
+        for t in threads:
+            t.join()
+
+    def run(self, items):
+        """
+        Push every item through the pipeline and wait for it to drain.
+
+        Raises PipelineError if any stage failed; items submitted after
+        the failure are not written.
+        """
+        fetch_threads = self._start(self._fetch_worker, self.fetchers)
+        decode_threads = self._start(self._decode_worker, self.decoders)
+        write_threads = self._start(self._write_worker, 1)
+
+        try:
+            for seq, item in enumerate(items):
+                # Wait for the writer to make room before submitting more work
+                while not self.in_flight.acquire(timeout=0.1):
+                    if self.stopped.is_set():
+                        break
+                if self.stopped.is_set():
+                    break
+                self._put(self.fetch_queue, (seq, item))
+        finally:
+            self._stop(self.fetch_queue, fetch_threads)
+            self._stop(self.decode_queue, decode_threads)
+            self._stop(self.write_queue, write_threads)
+
+        if self.errors:
+            raise PipelineError(
+                f'{len(self.errors)} pipeline error(s), first: {self.errors[0]!r}'
+            ) from self.errors[0]
@@ -0,0 +1,405 @@
+"""
+Cached read access to stored blocks and transactions.
+
+`QueryService` answers the lookups other services make against the
+crawled chain (blocks by number or hash, transactions by hash, the latest
+blocks and an address's transaction history) from a bounded in-memory
+cache in front of the database. `QueryServer` exposes it as JSON over a
+small local HTTP server:
+
+    GET /blocks/latest?count=10
+    GET /blocks/<number or 0xhash>
+    GET /blocks?numbers=1,2,3            (or ?hashes=0x..,0x..)
+    GET /transactions/<0xhash>
+    GET /transactions?hashes=0x..,0x..
+    GET /addresses/<0xaddress>/transactions?limit=100&after=<cursor>
+
+Stored blocks and transactions only change when a reorg rolls them back,
+so they are cached until then (or until `cache_ttl` passes). Results that
+new blocks can change, such as the latest blocks and address histories,
+are dropped whenever blocks are committed. Changes are heard from the
+crawler's database helper in-process, and from other processes through
+PostgreSQL LISTEN on db_util.CHAIN_CHANNEL.
+"""
+import contextlib
+import datetime
+import decimal
+import re
+import select
+import threading
+
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import urlparse, parse_qs
+
+from sqlalchemy import and_, or_
+from sqlalchemy.orm import aliased, scoped_session
+
+import settings
+
+from blockme.models.ethereum import Address, Block, Transaction
+from blockme.util.cache_util import LRUCache
+from blockme.util.crawler_util import hex_to_bytes, json_dumps
+from blockme.util.db_util import CHAIN_CHANNEL, EthereumDatabaseHelper
+from blockme.util.logging_util import get_blockme_console_logger
+from blockme.util.metrics_util import get_metrics_registry
+
+
+# Keys looked up per IN (...) query by the multi-get methods
+LOOKUP_BATCH_SIZE = 500
+
+# The most rows a single history page may ask for
+MAX_PAGE_SIZE = 1000
+
+BLOCK_COLUMNS = [c for c in Block.__table__.columns if c.name != 'dt_inserted']
+
+TRANSACTION_COLUMNS = [
+    c for c in Transaction.__table__.columns
+    if c.name not in ('db_id', 'sender_id', 'receipt_id', 'dt_inserted')
+]
+
+
+def _json_value(value):
+    """Render a column value as JSON: bytes as 0x hex, exact numbers as strings."""
+    if isinstance(value, (bytes, memoryview)):
+        return '0x' + bytes(value).hex()
+    if isinstance(value, decimal.Decimal):
+        return str(value)
+    if isinstance(value, (datetime.datetime, datetime.date)):
+        return value.isoformat()
+    return value
+
+
+def _to_bytes(value):
+    """Accept hashes and addresses as bytes or "0x..." strings."""
+    if isinstance(value, str):
+        return hex_to_bytes(value)
+    return bytes(value)
+
+
+def _chunks(values, size):
+    for i in range(0, len(values), size):
+        yield values[i:i + size]
+
+
+class QueryService(object):
+    """
+    Cached lookups of blocks and transactions. Returned dicts are shared
+    with the cache and must not be modified.
+
+    database_client :: an EthereumDatabaseHelper to read through; its
+                       commits and rollbacks invalidate the cache
+    cache_size :: entries kept in each of the two caches
+    cache_ttl :: seconds before a cached entry is looked up again
+    listen :: on PostgreSQL, also hear of changes made by other processes
+    """
+
+    def __init__(self, database_client=None, cache_size=settings.QUERY_CACHE_SIZE,
+                 cache_ttl=settings.QUERY_CACHE_TTL, listen=True):
+        self.logger = get_blockme_console_logger()
+        self.metrics = get_metrics_registry()
+        if database_client is None:
+            database_client = EthereumDatabaseHelper()
+        database_client.chain_listeners.append(self.invalidate)
+        self.engine = database_client.engine
+
+        # One session per thread, so the HTTP front end can serve requests
+        # concurrently
+        self.Session = scoped_session(database_client.Session)
+
+        # Rows of stored blocks and transactions, and results that change
+        # as blocks are added
+        self.cache = LRUCache(cache_size, ttl=cache_ttl)
+        self.volatile = LRUCache(cache_size, ttl=cache_ttl)
+
+        # The sender and recipient addresses joined onto transactions
+        self.sender = aliased(Address)
+        self.receipt = aliased(Address)
+
+        self.stopped = threading.Event()
+        self.listener = None
+        if listen and self.engine.dialect.name == 'postgresql':
+            self.listener = threading.Thread(target=self._listen, daemon=True)
+            self.listener.start()
+
+    def close(self):
+        self.stopped.set()
+        if self.listener is not None:
+            self.listener.join()
+        self.Session.remove()
+
+    @contextlib.contextmanager
+    def _session(self, query):
+        """A thread-local session, released after each lookup."""
+        try:
+            with self.metrics.timer('query_seconds', {'query': query}):
+                yield self.Session()
+        finally:
+            self.Session.remove()
+
+    def invalidate(self, payload):
+        """
+        Drop cached results made stale by a CHAIN_CHANNEL change: every
+        commit stales the volatile results, a rollback everything.
+        """
+        kind = payload.split(':', 1)[0]
+        self.volatile.clear()
+        if kind != 'commit':
+            self.cache.clear()
+        self.metrics.inc('query_cache_invalidations_total', labels={'kind': kind})
+
+    def _listen(self):
+        """Apply CHAIN_CHANNEL notifications until closed, reconnecting on errors."""
+        while not self.stopped.is_set():
+            connection = None
+            try:
+                connection = self.engine.raw_connection()
+                dbapi_connection = connection.connection
+                dbapi_connection.autocommit = True
+                dbapi_connection.cursor().execute(f'LISTEN {CHAIN_CHANNEL}')
+                # Changes may have been missed while not listening
+                self.invalidate('reconnect')
+                while not self.stopped.is_set():
+                    if select.select([dbapi_connection], [], [], 1.0)[0]:
+                        dbapi_connection.poll()
+                        while dbapi_connection.notifies:
+                            self.invalidate(dbapi_connection.notifies.pop(0).payload)
+            except Exception as e:
+                self.logger.warning(f'Lost {CHAIN_CHANNEL} listener connection: {e}')
+                self.stopped.wait(1.0)
+            finally:
+                if connection is not None:
+                    connection.invalidate()
+
+    def _multi_get(self, kind, keys, load):
+        """
+        Look up `keys` in the cache and the rest with `load(missing keys)`,
+        which returns a dict of key -> row dict. Returns a list aligned with
+        `keys`, with None for keys not stored.
+        """
+        found = {}
+        missing = set()
+        for key in keys:
+            value = self.cache.get((kind, key))
+            if value is None:
+                missing.add(key)
+            else:
+                found[key] = value
+        self.metrics.inc('query_cache_hits_total', len(keys) - len(missing), {'kind': kind})
+        self.metrics.inc('query_cache_misses_total', len(missing), {'kind': kind})
+        if missing:
+            for key, value in load(sorted(missing)).items():
+                self.cache.put((kind, key), value)
+                found[key] = value
+        return [found.get(key) for key in keys]
+
+    def _block_dicts(self, rows):
+        names = [c.name for c in BLOCK_COLUMNS]
+        return [
+            {name: _json_value(v) for name, v in zip(names, row)}
+            for row in rows
+        ]
+
+    def _load_blocks(self, column, keys):
+        loaded = {}
+        with self._session('blocks') as session:
+            for batch in _chunks(keys, LOOKUP_BATCH_SIZE):
+                rows = session.query(*BLOCK_COLUMNS).filter(column.in_(batch)).all()
+                for block in self._block_dicts(rows):
+                    # Cache under the other key too
+                    self.cache.put(('block', block['number']), block)
+                    self.cache.put(('block_hash', hex_to_bytes(block['block_hash'])), block)
+                    key = block['number'] if column is Block.number \
+                        else hex_to_bytes(block['block_hash'])
+                    loaded[key] = block
+        return loaded
+
+    def get_blocks(self, numbers):
+        """Returns stored blocks by number, as a list aligned with `numbers`."""
+        numbers = [int(n) for n in numbers]
+        return self._multi_get(
+            'block', numbers, lambda keys: self._load_blocks(Block.number, keys))
+
+    def get_blocks_by_hash(self, hashes):
+        """Returns stored blocks by hash, as a list aligned with `hashes`."""
+        hashes = [_to_bytes(h) for h in hashes]
+        return self._multi_get(
+            'block_hash', hashes, lambda keys: self._load_blocks(Block.block_hash, keys))
+
+    def get_block(self, number=None, block_hash=None):
+        """Returns one stored block by number or hash, or None."""
+        if block_hash is not None:
+            return self.get_blocks_by_hash([block_hash])[0]
+        return self.get_blocks([number])[0]
+
+    def latest_blocks(self, count=10):
+        """Returns the `count` highest stored blocks, highest first."""
+        count = max(1, min(int(count), MAX_PAGE_SIZE))
+        key = ('latest', count)
+        blocks = self.volatile.get(key)
+        if blocks is None:
+            with self._session('latest_blocks') as session:
+                rows = session.query(*BLOCK_COLUMNS).order_by(
+                    Block.number.desc()).limit(count).all()
+            blocks = self._block_dicts(rows)
+            self.volatile.put(key, blocks)
+        return blocks
+
+    def _transaction_query(self, session):
+        return session.query(
+            *TRANSACTION_COLUMNS,
+            self.sender.address.label('sender'),
+            self.receipt.address.label('receipt')
+        ).outerjoin(
+            self.sender, Transaction.sender_id == self.sender.id
+        ).outerjoin(
+            self.receipt, Transaction.receipt_id == self.receipt.id
+        )
+
+    def _transaction_dicts(self, rows):
+        names = [c.name for c in TRANSACTION_COLUMNS] + ['sender', 'receipt']
+        return [
+            {name: _json_value(v) for name, v in zip(names, row)}
+            for row in rows
+        ]
+
+    def _load_transactions(self, keys):
+        loaded = {}
+        with self._session('transactions') as session:
+            for batch in _chunks(keys, LOOKUP_BATCH_SIZE):
+                rows = self._transaction_query(session).filter(
+                    Transaction.transaction_hash.in_(batch)).all()
+                for transaction in self._transaction_dicts(rows):
+                    loaded[hex_to_bytes(transaction['transaction_hash'])] = transaction
+        return loaded
+
+    def get_transactions(self, hashes):
+        """Returns stored transactions by hash, as a list aligned with `hashes`."""
+        hashes = [_to_bytes(h) for h in hashes]
+        return self._multi_get('transaction', hashes, self._load_transactions)
+
+    def get_transaction(self, transaction_hash):
+        """Returns one stored transaction by hash, or None."""
+        return self.get_transactions([transaction_hash])[0]
+
+    def address_history(self, address, limit=100, after=None):
+        """
+        Returns a page of the transactions sent or received by `address`,
+        newest first, as {'transactions': [...], 'next': cursor}. Pass
+        `next` back as `after` for the following page; it is None on the
+        last page.
+
+        Pages are found by keyset on (block_number, transaction_index)
+        rather than by offset, so deep pages cost the same as the first.
+        """
+        address = _to_bytes(address)
+        limit = max(1, min(int(limit), MAX_PAGE_SIZE))
+        key = ('history', address, limit, after)
+        page = self.volatile.get(key)
+        if page is not None:
+            return page
+
+        with self._session('address_history') as session:
+            address_id = session.query(Address.id).filter(
+                Address.address == address).scalar()
+            rows = []
+            if address_id is not None:
+                query = self._transaction_query(session).filter(or_(
+                    Transaction.sender_id == address_id,
+                    Transaction.receipt_id == address_id
+                ))
+                if after is not None:
+                    block_number, transaction_index = map(int, after.split(':'))
+                    query = query.filter(or_(
+                        Transaction.block_number < block_number,
+                        and_(Transaction.block_number == block_number,
+                             Transaction.transaction_index < transaction_index)
+                    ))
+                rows = query.order_by(
+                    Transaction.block_number.desc(),
+                    Transaction.transaction_index.desc()
+                ).limit(limit).all()
+        transactions = self._transaction_dicts(rows)
+        next_cursor = None
+        if len(transactions) == limit:
+            last = transactions[-1]
+            next_cursor = f"{last['block_number']}:{last['transaction_index']}"
+        page = {'transactions': transactions, 'next': next_cursor}
+        self.volatile.put(key, page)
+        return page
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def _split(values):
+    return [v for v in values.split(',') if v]
+
+
+class QueryServer(object):
+    """Serve a QueryService as JSON on http://host:port."""
+
+    ROUTES = (
+        (re.compile(r'^/blocks/latest$'),
+         lambda service, query: service.latest_blocks(query.get('count', 10))),
+        (re.compile(r'^/blocks/(?P<key>0x[0-9a-fA-F]+)$'),
+         lambda service, query, key: service.get_block(block_hash=key)),
+        (re.compile(r'^/blocks/(?P<key>\d+)$'),
+         lambda service, query, key: service.get_block(number=key)),
+        (re.compile(r'^/blocks$'),
+         lambda service, query: service.get_blocks_by_hash(_split(query['hashes']))
+         if 'hashes' in query else service.get_blocks(_split(query['numbers']))),
+        (re.compile(r'^/transactions/(?P<key>0x[0-9a-fA-F]+)$'),
+         lambda service, query, key: service.get_transaction(key)),
+        (re.compile(r'^/transactions$'),
+         lambda service, query: service.get_transactions(_split(query['hashes']))),
+        (re.compile(r'^/addresses/(?P<key>0x[0-9a-fA-F]+)/transactions$'),
+         lambda service, query, key: service.address_history(
+             key, query.get('limit', 100), query.get('after'))),
+    )
+
+    def __init__(self, service, port=settings.QUERY_API_PORT,
+                 host=settings.QUERY_API_HOST):
+        routes = self.ROUTES
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                url = urlparse(self.path)
+                query = {k: v[-1] for k, v in parse_qs(url.query).items()}
+                for pattern, handler in routes:
+                    match = pattern.match(url.path)
+                    if match is not None:
+                        break
+                else:
+                    self.send_error(404)
+                    return
+                try:
+                    result = handler(service, query, **match.groupdict())
+                except (KeyError, ValueError) as e:
+                    self.send_error(400, f'Bad request: {e}')
+                    return
+                if result is None:
+                    self.send_error(404)
+                    return
+                body = json_dumps(result)
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = _ThreadingHTTPServer((host, port), Handler)
+        self.thread = threading.Thread(
+            target=self.server.serve_forever, daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
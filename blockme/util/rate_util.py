@@ -0,0 +1,116 @@
+"""
+Adaptive concurrency control for requests to geth.
+"""
+import contextlib
+import threading
+import time
+
+
+class AdaptiveConcurrencyLimiter(object):
+    """
+    Bound the number of in-flight requests with an AIMD limit.
+
+    While requests succeed and the smoothed latency stays under
+    `latency_target`, the limit grows additively by roughly one slot per
+    `limit` completed requests. A failed request, or a latency above
+    target, shrinks the limit multiplicatively by `backoff`. The limit
+    always stays within [min_limit, max_limit].
+
+    Callers wrap each request in `slot()`:
+
+        with limiter.slot():
+            response = do_request()
+
+    Exceptions raised inside the block count as errors and are re-raised.
+    """
+
+    def __init__(self, initial_limit=4, min_limit=1, max_limit=64,
+                 latency_target=1.0, backoff=0.5, smoothing=0.1):
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.latency_target = latency_target
+        self.backoff = backoff
+        self.smoothing = smoothing
+
+        self._limit = float(max(min_limit, min(initial_limit, max_limit)))
+        self._in_flight = 0
+        self._latency = None
+        self._error_rate = 0.0
+        self._last_backoff = 0.0
+        self._condition = threading.Condition()
+
+    @property
+    def limit(self):
+        """The current number of requests allowed in flight."""
+        return int(self._limit)
+
+    @property
+    def in_flight(self):
+        """The number of requests currently in flight."""
+        return self._in_flight
+
+    @property
+    def latency(self):
+        """Exponentially smoothed request latency in seconds, or None."""
+        return self._latency
+
+    @property
+    def error_rate(self):
+        """Exponentially smoothed fraction of requests that failed."""
+        return self._error_rate
+
+    def stats(self):
+        """Returns a dict snapshot of the limiter's state."""
+        return {
+            'limit': self.limit,
+            'in_flight': self.in_flight,
+            'latency': self.latency,
+            'error_rate': self.error_rate,
+        }
+
+    def acquire(self):
+        """Block until a request slot is free."""
+        with self._condition:
+            while self._in_flight >= int(self._limit):
+                self._condition.wait()
+            self._in_flight += 1
+
+    def release(self, latency, ok=True):
+        """
+        Free a request slot and adjust the limit.
+
+        latency :: seconds the request took
+        ok :: False if the request failed or timed out
+        """
+        with self._condition:
+            self._in_flight -= 1
+            a = self.smoothing
+            if self._latency is None:
+                self._latency = latency
+            else:
+                self._latency = (1 - a) * self._latency + a * latency
+            self._error_rate = (1 - a) * self._error_rate + a * (0.0 if ok else 1.0)
+
+            healthy = ok and latency <= self.latency_target
+            if healthy:
+                self._limit = min(self.max_limit, self._limit + 1.0 / self._limit)
+            else:
+                # Back off at most once per smoothed round trip, so one burst
+                # of failures doesn't collapse the limit to the floor
+                now = time.monotonic()
+                if now - self._last_backoff >= (self._latency or 0):
+                    self._limit = max(self.min_limit, self._limit * self.backoff)
+                    self._last_backoff = now
+            self._condition.notify_all()
+
+    @contextlib.contextmanager
+    def slot(self):
+        """Context manager that holds a request slot for one request."""
+        self.acquire()
+        started = time.monotonic()
+        ok = False
+        try:
+            yield
+            ok = True
+        finally:
+            self.release(time.monotonic() - started, ok)
@@ -0,0 +1,73 @@
+"""
+Incrementally maintained rollups of the block and transaction tables.
+
+Every committed chunk adds the contributions of its blocks and
+transactions to:
+
+    daily_stats :: blocks, transactions and gas used per UTC day
+    sender_stats :: transactions and ether sent per sender
+    miner_stats :: blocks mined and their gas used per miner
+
+Contributions are only counted for blocks that were actually inserted,
+so re-loading blocks already in the database leaves the rollups alone,
+and they are subtracted again when blocks are rolled back.
+"""
+from blockme.models.ethereum import DailyStats, SenderStats, MinerStats
+
+
+# (model, key column, value columns) for each rollup table
+ROLLUPS = (
+    (DailyStats, 'day', ('block_count', 'transaction_count', 'gas_used')),
+    (SenderStats, 'sender_id', ('transaction_count', 'value')),
+    (MinerStats, 'miner', ('block_count', 'gas_used')),
+)
+
+# Block and transaction columns the rollups are computed from
+BLOCK_COLUMNS = ('number', 'timestamp', 'gase_used', 'miner')
+TRANSACTION_COLUMNS = ('block_number', 'sender_id', 'value')
+
+
+def _add(totals, key, values):
+    current = totals.get(key)
+    if current is None:
+        totals[key] = list(values)
+    else:
+        for i, v in enumerate(values):
+            current[i] += v
+
+
+def rollup_deltas(block_columns, transaction_columns, numbers=None):
+    """
+    Compute the rollup contributions of decoded block and transaction
+    columns. Transactions must already have a `sender_id` column.
+
+    numbers :: optional collection of block numbers; only these blocks
+               and their transactions are counted
+
+    Returns a dict of model -> {key: [values]}, with values in the order
+    of the model's value columns in ROLLUPS.
+    """
+    daily = {}
+    miners = {}
+    senders = {}
+    days = {}
+    rows = zip(*[block_columns[c] for c in BLOCK_COLUMNS])
+    for number, timestamp, gas_used, miner in rows:
+        if numbers is not None and number not in numbers:
+            continue
+        day = days[number] = timestamp.date()
+        gas_used = gas_used or 0
+        _add(daily, day, (1, 0, gas_used))
+        if miner is not None:
+            _add(miners, bytes(miner), (1, gas_used))
+
+    rows = zip(*[transaction_columns[c] for c in TRANSACTION_COLUMNS])
+    for block_number, sender_id, value in rows:
+        day = days.get(block_number)
+        if day is None:
+            continue
+        _add(daily, day, (0, 1, 0))
+        if sender_id is not None:
+            _add(senders, sender_id, (1, value or 0))
+
+    return {DailyStats: daily, SenderStats: senders, MinerStats: miners}
@@ -0,0 +1,444 @@
+"""
+Transports and a retrying client for geth's JSON-RPC interface.
+
+Two transports are provided:
+
+    HTTPTransport :: a pooled, keep-alive `requests.Session`
+    IPCTransport :: a pool of Unix socket connections to `geth.ipc`
+
+`make_transport` picks one from an endpoint string: anything starting
+with http:// or https:// is sent over HTTP, anything else is treated as
+the path of geth's IPC socket. Given several endpoints it returns a
+`LoadBalancedTransport` spreading requests across them.
+"""
+import queue
+import random
+import socket
+import threading
+import time
+
+import requests
+
+from blockme.util import crawler_util
+from blockme.util.logging_util import get_blockme_console_logger
+from blockme.util.metrics_util import get_metrics_registry
+
+
+class RPCError(Exception):
+    pass
+
+
+class RPCTransportError(RPCError):
+    """The request could not be delivered or its response could not be read."""
+    pass
+
+
+class _ChunkReader(object):
+    """A minimal file-like view of an iterator of byte chunks, for ijson."""
+
+    def __init__(self, chunks):
+        self.chunks = chunks
+
+    def read(self, size=-1):
+        # ijson probes the stream's type with read(0)
+        if size == 0:
+            return b''
+        return next(self.chunks, b'')
+
+
+class HTTPTransport(object):
+    """
+    Send JSON-RPC payloads over HTTP with a pooled keep-alive session.
+
+    pool_size :: the number of connections kept open to geth; should be
+                 at least the number of threads sharing the transport
+    """
+
+    def __init__(self, url, pool_size=8, timeout=30, stream_chunk_size=65536):
+        self.url = url
+        self.stream_chunk_size = stream_chunk_size
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=1, pool_maxsize=pool_size, max_retries=0)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.session.headers.update({"content-type": "application/json"})
+
+    def send(self, body, projection=None):
+        """
+        Send an encoded payload and return the decoded response.
+
+        projection :: optional crawler_util.json_load_projected filter.
+                      When given (and ijson is installed) the response is
+                      decoded as it streams in, without buffering the body
+                      or building the members the filter drops.
+        """
+        stream = projection is not None and crawler_util.ijson is not None
+        try:
+            response = self.session.post(
+                self.url, data=body, timeout=self.timeout, stream=stream)
+            try:
+                response.raise_for_status()
+                if not stream:
+                    return crawler_util.json_loads(response.content)
+                chunks = response.iter_content(self.stream_chunk_size)
+                return crawler_util.json_load_projected(
+                    _ChunkReader(chunks), projection)
+            finally:
+                response.close()
+        except (requests.RequestException, ValueError) as e:
+            raise RPCTransportError(f'{self.url}: {e!r}') from e
+
+    def close(self):
+        self.session.close()
+
+
+class IPCTransport(object):
+    """
+    Send JSON-RPC payloads over geth's Unix domain socket.
+
+    Connections are pooled and reused; a connection that fails is
+    discarded rather than returned to the pool.
+    """
+
+    def __init__(self, path, pool_size=8, timeout=30, buffer_size=65536):
+        self.path = path
+        self.timeout = timeout
+        self.buffer_size = buffer_size
+        self.pool = queue.LifoQueue(maxsize=pool_size)
+
+    def _connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        sock.connect(self.path)
+        return sock
+
+    def _receive(self, sock):
+        """Read from the socket until a complete JSON document has arrived."""
+        chunks = []
+        while True:
+            chunk = sock.recv(self.buffer_size)
+            if not chunk:
+                raise RPCTransportError(f'{self.path}: connection closed')
+            chunks.append(chunk)
+            if chunk.rstrip()[-1:] not in (b'}', b']'):
+                continue
+            try:
+                return crawler_util.json_loads(b''.join(chunks))
+            except ValueError:
+                continue
+
+    def send(self, body, projection=None):
+        """
+        Send an encoded payload and return the decoded response. Responses
+        are always decoded whole, as geth keeps the socket open after one,
+        so `projection` is ignored.
+        """
+        try:
+            sock = self.pool.get_nowait()
+        except queue.Empty:
+            sock = None
+        try:
+            if sock is None:
+                sock = self._connect()
+            sock.sendall(body)
+            result = self._receive(sock)
+        except (OSError, RPCTransportError) as e:
+            if sock is not None:
+                sock.close()
+            raise RPCTransportError(f'{self.path}: {e!r}') from e
+
+        try:
+            self.pool.put_nowait(sock)
+        except queue.Full:
+            sock.close()
+        return result
+
+    def close(self):
+        while True:
+            try:
+                self.pool.get_nowait().close()
+            except queue.Empty:
+                break
+
+
+class Endpoint(object):
+    """One node behind a LoadBalancedTransport, with its scheduling state."""
+
+    def __init__(self, name, transport):
+        self.name = name
+        self.transport = transport
+        self.outstanding = 0
+        # Exponentially smoothed latency of successful requests, in seconds
+        self.latency = None
+        self.failures = 0
+        self.ejected_until = 0.0
+        # The node's last reported block number, and whether it is within
+        # the allowed lag of the best node
+        self.head = None
+        self.in_sync = True
+
+    def available(self, now):
+        return self.in_sync and self.ejected_until <= now
+
+    def cost(self):
+        """Expected wait for a new request: least outstanding, latency weighted."""
+        return (self.outstanding + 1) * (self.latency or 0.0), self.outstanding
+
+
+class LoadBalancedTransport(object):
+    """
+    Spread JSON-RPC payloads over several geth nodes.
+
+    Each payload goes to the available node with the lowest
+    (outstanding requests + 1) * smoothed latency. If that node fails,
+    the payload is sent to the next best node, and so on.
+
+    A node is ejected for `eject_seconds` after `max_failures`
+    consecutive failures. A background health check polls every node's
+    eth_blockNumber every `health_interval` seconds. Nodes more than
+    `max_lag` blocks behind the best node get no requests until they
+    catch up. If no node is available, every node is tried.
+    """
+
+    def __init__(self, transports, health_interval=5.0, max_lag=5,
+                 max_failures=3, eject_seconds=30.0, smoothing=0.2):
+        self.logger = get_blockme_console_logger()
+        self.metrics = get_metrics_registry()
+        self.endpoints = [Endpoint(name, t) for name, t in transports]
+        self.health_interval = health_interval
+        self.max_lag = max_lag
+        self.max_failures = max_failures
+        self.eject_seconds = eject_seconds
+        self.smoothing = smoothing
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.stopped = threading.Event()
+
+        for endpoint in self.endpoints:
+            labels = {'endpoint': endpoint.name}
+            self.metrics.set_gauge(
+                'rpc_endpoint_outstanding', lambda e=endpoint: e.outstanding, labels)
+            self.metrics.set_gauge(
+                'rpc_endpoint_latency_seconds', lambda e=endpoint: e.latency or 0, labels)
+            self.metrics.set_gauge(
+                'rpc_endpoint_available',
+                lambda e=endpoint: int(e.available(time.monotonic())), labels)
+
+        self.check_health()
+        self.health_thread = threading.Thread(target=self._health_loop, daemon=True)
+        self.health_thread.start()
+
+    @property
+    def served_by(self):
+        """The endpoint that answered this thread's last request."""
+        return getattr(self.local, 'endpoint', None)
+
+    def _pick(self, tried):
+        now = time.monotonic()
+        with self.lock:
+            candidates = [e for e in self.endpoints if e.name not in tried]
+            available = [e for e in candidates if e.available(now)]
+            if not candidates:
+                return None
+            endpoint = min(available or candidates, key=Endpoint.cost)
+            endpoint.outstanding += 1
+            return endpoint
+
+    def _succeeded(self, endpoint, elapsed):
+        with self.lock:
+            endpoint.outstanding -= 1
+            endpoint.failures = 0
+            if endpoint.latency is None:
+                endpoint.latency = elapsed
+            else:
+                endpoint.latency += self.smoothing * (elapsed - endpoint.latency)
+
+    def _failed(self, endpoint):
+        self.metrics.inc('rpc_endpoint_errors_total', labels={'endpoint': endpoint.name})
+        with self.lock:
+            endpoint.outstanding -= 1
+            endpoint.failures += 1
+            if endpoint.failures < self.max_failures:
+                return
+            endpoint.failures = 0
+            endpoint.ejected_until = time.monotonic() + self.eject_seconds
+        self.logger.warning(
+            f'Ejecting {endpoint.name} for {self.eject_seconds}s after '
+            f'{self.max_failures} consecutive failures')
+
+    def send(self, body, exclude=(), projection=None):
+        """
+        Send an encoded payload to the best available node, failing over
+        to the others in turn. Nodes named in `exclude` are skipped.
+        """
+        tried = set(exclude)
+        error = RPCTransportError('No RPC endpoint left to try')
+        while True:
+            endpoint = self._pick(tried)
+            if endpoint is None:
+                raise error
+            tried.add(endpoint.name)
+            started = time.monotonic()
+            try:
+                result = endpoint.transport.send(body, projection=projection)
+            except RPCTransportError as e:
+                self._failed(endpoint)
+                error = e
+                continue
+            self._succeeded(endpoint, time.monotonic() - started)
+            self.local.endpoint = endpoint.name
+            return result
+
+    def check_health(self):
+        """
+        Ask every node for its block number, and take nodes that are
+        unreachable or more than `max_lag` blocks behind out of rotation.
+        """
+        body = crawler_util.json_dumps(
+            {"method": "eth_blockNumber", "params": [], "jsonrpc": "2.0", "id": 0})
+        heads = {}
+        for endpoint in self.endpoints:
+            try:
+                heads[endpoint.name] = int(endpoint.transport.send(body)["result"], 16)
+            except (RPCTransportError, KeyError, TypeError, ValueError) as e:
+                self.logger.warning(f'Health check of {endpoint.name} failed: {e!r}')
+        best = max(heads.values()) if heads else None
+
+        with self.lock:
+            for endpoint in self.endpoints:
+                endpoint.head = heads.get(endpoint.name)
+                in_sync = endpoint.head is not None and endpoint.head >= best - self.max_lag
+                if in_sync != endpoint.in_sync:
+                    self.logger.warning(
+                        f'{endpoint.name} at block {endpoint.head} (best {best}) is '
+                        f'{"back in" if in_sync else "out of"} rotation')
+                endpoint.in_sync = in_sync
+
+    def _health_loop(self):
+        while not self.stopped.wait(self.health_interval):
+            self.check_health()
+
+    def close(self):
+        self.stopped.set()
+        for endpoint in self.endpoints:
+            self.metrics.remove_gauge('rpc_endpoint_outstanding', {'endpoint': endpoint.name})
+            self.metrics.remove_gauge('rpc_endpoint_latency_seconds', {'endpoint': endpoint.name})
+            self.metrics.remove_gauge('rpc_endpoint_available', {'endpoint': endpoint.name})
+            endpoint.transport.close()
+
+
+def make_transport(endpoint, pool_size=8, timeout=30, health_interval=5.0,
+                   max_lag=5):
+    """
+    Build a transport for `endpoint`: an http(s):// URL, or the path of
+    geth's IPC socket (optionally prefixed with ipc://).
+
+    `endpoint` may also be a list, or a comma separated string, of
+    several endpoints, which are load balanced (see LoadBalancedTransport).
+    """
+    if isinstance(endpoint, str) and ',' in endpoint:
+        endpoint = endpoint.split(',')
+    if not isinstance(endpoint, str):
+        endpoints = [e.strip() for e in endpoint if e.strip()]
+        if len(endpoints) > 1:
+            return LoadBalancedTransport(
+                [(e, make_transport(e, pool_size, timeout)) for e in endpoints],
+                health_interval=health_interval,
+                max_lag=max_lag
+            )
+        endpoint = endpoints[0]
+    if endpoint.startswith(('http://', 'https://')):
+        return HTTPTransport(endpoint, pool_size=pool_size, timeout=timeout)
+    if endpoint.startswith('ipc://'):
+        endpoint = endpoint[len('ipc://'):]
+    return IPCTransport(endpoint, pool_size=pool_size, timeout=timeout)
+
+
+class RPCClient(object):
+    """
+    Make JSON-RPC calls through a transport with bounded, jittered retries.
+
+    Failed attempts are retried up to `retries` times, sleeping a random
+    amount between 0 and min(max_backoff, backoff * 2 ** attempt) first
+    ("full jitter"), so a pool of fetchers hitting the same hiccup don't
+    retry in lockstep. Each attempt holds a slot of `limiter`, if given.
+    """
+
+    def __init__(self, transport, limiter=None, retries=3, backoff=0.1,
+                 max_backoff=5.0):
+        self.logger = get_blockme_console_logger()
+        self.metrics = get_metrics_registry()
+        self.transport = transport
+        self.limiter = limiter
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+
+    @property
+    def served_by(self):
+        """
+        The endpoint that answered this thread's last request, if the
+        transport balances over several; otherwise None.
+        """
+        return getattr(self.transport, 'served_by', None)
+
+    def _send(self, body, exclude=(), projection=None):
+        # Only load-balanced transports take an exclude list
+        args = (body, exclude) if exclude else (body,)
+        self.metrics.inc('rpc_requests_total')
+        with self.metrics.timer('rpc_seconds'):
+            if self.limiter is None:
+                return self.transport.send(*args, projection=projection)
+            with self.limiter.slot():
+                return self.transport.send(*args, projection=projection)
+
+    def send(self, payload, exclude=(), projection=None):
+        """
+        Encode `payload` once and send it, retrying transport failures.
+
+        exclude :: endpoints of a LoadBalancedTransport not to send to
+        projection :: optional filter of the response members to decode
+                      (see crawler_util.json_load_projected)
+        """
+        body = crawler_util.json_dumps(payload)
+        attempt = 0
+        while True:
+            try:
+                return self._send(body, exclude, projection)
+            except RPCTransportError as e:
+                self.metrics.inc('rpc_errors_total')
+                if attempt >= self.retries:
+                    raise
+                self.metrics.inc('rpc_retries_total')
+                delay = random.uniform(
+                    0, min(self.max_backoff, self.backoff * 2 ** attempt))
+                self.logger.warning(
+                    f'RPC attempt {attempt + 1} failed, retrying in {delay:.2f}s: {e}')
+                time.sleep(delay)
+                attempt += 1
+
+    def call(self, method, params):
+        """Make a single call and return its result."""
+        response = self.send(
+            {"method": method, "params": params, "jsonrpc": "2.0", "id": 0})
+        if response.get("error") is not None:
+            raise RPCError(f'{method} failed: {response["error"]}')
+        return response.get("result")
+
+    def batch(self, calls, exclude=(), projection=None):
+        """
+        Make a JSON-RPC 2.0 batch of (method, params) calls.
+
+        exclude :: endpoints of a LoadBalancedTransport not to send to
+        projection :: optional filter of the response members to decode
+
+        Returns a list of (result, error) tuples in the same order as `calls`.
+        """
+        response = self.send(
+            crawler_util.build_batch_payload(calls), exclude, projection)
+        return crawler_util.match_batch_responses(response, len(calls))
+
+    def close(self):
+        self.transport.close()
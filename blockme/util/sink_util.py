@@ -0,0 +1,320 @@
+"""
+Destinations the crawler writes decoded chunks to.
+
+Every sink receives the same decoded columns for each committed chunk:
+
+    database :: rows inserted through EthereumDatabaseHelper (the default)
+    parquet :: columnar Parquet files, one row group per chunk, laid out
+               by block range under an output directory:
+
+        <output_dir>/<table>/range_start=000001000000/<table>-000001000000-000001000999.parquet
+
+Several sinks can run at once. The database always keeps the crawl's
+sync state, so whichever sinks are used, a range is only recorded as
+synced once every sink has written it.
+"""
+import decimal
+import os
+import re
+import settings
+
+from sqlalchemy import Date, DateTime, Integer, LargeBinary, Numeric
+
+from blockme.models.ethereum import Block, Transaction, Receipt, Log
+from blockme.util.crawler_util import numbers_to_ranges
+from blockme.util.metrics_util import get_metrics_registry
+
+# Imported by the first ParquetSink, so crawls that only write to the
+# database don't pay for loading pyarrow
+pyarrow = None
+
+
+def _import_pyarrow():
+    global pyarrow
+    if pyarrow is None:
+        try:
+            # Binds the module-level name
+            import pyarrow.compute
+            import pyarrow.parquet
+        except ImportError:
+            raise ImportError(
+                'The parquet sink needs pyarrow (pip install pyarrow)')
+
+
+class Sink(object):
+    """A destination for decoded chunks of blocks."""
+
+    name = None
+
+    def write_chunk(self, block_columns, transaction_columns, synced_ranges=(),
+                    receipt_columns=None, log_columns=None):
+        """
+        Write one decoded chunk. Raises on failure, in which case the
+        chunk is not recorded as synced and is crawled again later.
+
+        synced_ranges :: inclusive (first, last) ranges fully covered by
+                         `block_columns`
+        """
+        raise NotImplementedError
+
+    def delete_blocks(self, first, last=None):
+        """
+        Remove blocks `first` to `last` (or every block from `first` up)
+        and their rows, after they were rolled back or deleted from the
+        database.
+        """
+        raise NotImplementedError
+
+
+class DatabaseSink(Sink):
+    """
+    Inserts chunks through an EthereumDatabaseHelper, recording
+    `synced_ranges` in the same transaction.
+    """
+
+    name = 'database'
+
+    def __init__(self, database_client):
+        self.database_client = database_client
+
+    def write_chunk(self, block_columns, transaction_columns, synced_ranges=(),
+                    receipt_columns=None, log_columns=None):
+        self.database_client.insert_chunk(
+            block_columns, transaction_columns, synced_ranges,
+            receipt_columns, log_columns)
+
+    def delete_blocks(self, first, last=None):
+        # The database helper removes the rows itself
+        pass
+
+
+def _arrow_type(column_type):
+    """The Arrow type matching a SQLAlchemy column type."""
+    if isinstance(column_type, Integer):
+        return pyarrow.int64()
+    if isinstance(column_type, LargeBinary):
+        return pyarrow.binary()
+    if isinstance(column_type, DateTime):
+        return pyarrow.timestamp('us')
+    if isinstance(column_type, Date):
+        return pyarrow.date32()
+    if isinstance(column_type, Numeric):
+        # decimal256 holds at most 76 digits, plenty for real uint256 values
+        return pyarrow.decimal256(
+            min(column_type.precision, 76), column_type.scale)
+    return None
+
+
+def _arrow_array(values, arrow_type):
+    if arrow_type is not None and pyarrow.types.is_decimal(arrow_type):
+        Decimal = decimal.Decimal
+        values = [Decimal(v) if isinstance(v, int) else v for v in values]
+    return pyarrow.array(values, type=arrow_type)
+
+
+# <table>-<first>-<last>.parquet
+_FILE_NAME = re.compile(r'^(\w+)-(\d{12})-(\d{12})\.parquet$')
+
+
+class ParquetSink(Sink):
+    """
+    Writes each chunk's rows, per table, to Parquet files of a single row
+    group, split by `partition_size`-block ranges.
+
+    Every file is named after the inclusive block range it covers, and no
+    two files of a table cover the same block: before a range is written,
+    existing files overlapping it are cut down to the blocks outside it.
+    Re-writing blocks with different chunk boundaries (a dead-letter
+    retry, a gap re-crawl) therefore replaces their rows, and
+    `delete_blocks` removes rolled back blocks the same way.
+
+    Files are written under a temporary name and renamed into place, so
+    readers never see a partial file. Transactions keep their raw `sender`
+    and `receipt` addresses, as there is no address table to refer to.
+
+    output_dir :: the root directory of the dataset
+    partition_size :: block numbers per range_start= directory
+    compression :: Parquet compression codec, e.g. 'zstd' or 'snappy'
+    """
+
+    name = 'parquet'
+
+    # (table, model, block number column) for every table written
+    TABLES = (
+        ('block', Block, 'number'),
+        ('transaction', Transaction, 'block_number'),
+        ('receipt', Receipt, 'block_number'),
+        ('log', Log, 'block_number'),
+    )
+
+    def __init__(self, output_dir, partition_size=1000000, compression='zstd'):
+        _import_pyarrow()
+        self.metrics = get_metrics_registry()
+        self.output_dir = output_dir
+        self.partition_size = partition_size
+        self.compression = compression
+        self.types = {
+            table: {c.name: _arrow_type(c.type) for c in model.__table__.columns}
+            for table, model, _ in self.TABLES
+        }
+        os.makedirs(output_dir, exist_ok=True)
+
+    def write_chunk(self, block_columns, transaction_columns, synced_ranges=(),
+                    receipt_columns=None, log_columns=None):
+        numbers = block_columns['number']
+        if not numbers:
+            return
+        # A retried chunk can hold scattered blocks; files only ever cover
+        # the contiguous runs actually written, so blocks in between keep
+        # their files
+        runs = numbers_to_ranges(numbers)
+        tables = zip(
+            self.TABLES,
+            (block_columns, transaction_columns, receipt_columns, log_columns)
+        )
+        for (table, _, number_column), columns in tables:
+            if columns is not None:
+                self.write_table(table, columns, number_column, runs)
+
+    def _partitions(self, numbers):
+        """Returns a dict of partition start -> row indices of `numbers`."""
+        size = self.partition_size
+        partitions = {}
+        for i, n in enumerate(numbers):
+            partitions.setdefault(n - n % size, []).append(i)
+        return partitions
+
+    def _path(self, table, first, last):
+        range_start = first - first % self.partition_size
+        directory = os.path.join(
+            self.output_dir, table, f'range_start={range_start:012d}')
+        return os.path.join(directory, f'{table}-{first:012d}-{last:012d}.parquet')
+
+    def _files(self, table, directory=None):
+        """
+        Yields (path, first, last) for every file of `table`, or only
+        those in `directory`.
+        """
+        table_dir = os.path.join(self.output_dir, table)
+        if directory is not None:
+            directories = [directory]
+        elif os.path.isdir(table_dir):
+            directories = [
+                os.path.join(table_dir, d) for d in sorted(os.listdir(table_dir))]
+        else:
+            directories = []
+        for directory in directories:
+            if not os.path.isdir(directory):
+                continue
+            for name in sorted(os.listdir(directory)):
+                match = _FILE_NAME.match(name)
+                if match and match.group(1) == table:
+                    yield (os.path.join(directory, name),
+                           int(match.group(2)), int(match.group(3)))
+
+    def _write_file(self, table, arrow_table, path):
+        with self.metrics.timer('parquet_write_seconds', {'table': table}):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            pyarrow.parquet.write_table(
+                arrow_table, path + '.tmp',
+                row_group_size=max(1, arrow_table.num_rows),
+                compression=self.compression
+            )
+            os.replace(path + '.tmp', path)
+
+    def _cut_files(self, table, number_column, first, last=None, keep=(),
+                   directory=None):
+        """
+        Remove blocks `first` to `last` (or from `first` up) from the
+        files of `table`, looking only in `directory` if given. An
+        overlapping file is replaced by files holding its rows outside the
+        range, if there are any. Paths in `keep` are left alone.
+        """
+        for path, file_first, file_last in list(self._files(table, directory)):
+            if path in keep or file_last < first or \
+                    (last is not None and file_first > last):
+                continue
+            pieces = []
+            if file_first < first:
+                pieces.append((file_first, first - 1))
+            if last is not None and file_last > last:
+                pieces.append((last + 1, file_last))
+            if pieces:
+                existing = pyarrow.parquet.read_table(path)
+                numbers = existing.column(number_column)
+                for piece_first, piece_last in pieces:
+                    mask = pyarrow.compute.and_(
+                        pyarrow.compute.greater_equal(numbers, piece_first),
+                        pyarrow.compute.less_equal(numbers, piece_last))
+                    piece = existing.filter(mask)
+                    if piece.num_rows:
+                        self._write_file(
+                            table, piece, self._path(table, piece_first, piece_last))
+            os.remove(path)
+
+    def write_table(self, table, columns, number_column, runs):
+        """
+        Write decoded `columns` of `table` for the inclusive block ranges
+        `runs`, one file per range and range_start= directory, replacing
+        any rows already written for those blocks.
+        """
+        types = self.types[table]
+        arrow_table = pyarrow.Table.from_arrays(
+            [_arrow_array(values, types.get(name)) for name, values in columns.items()],
+            names=list(columns)
+        )
+        partitions = self._partitions(columns[number_column])
+        for first, last in runs:
+            for range_start in range(
+                    first - first % self.partition_size, last + 1, self.partition_size):
+                file_first = max(first, range_start)
+                file_last = min(last, range_start + self.partition_size - 1)
+                path = self._path(table, file_first, file_last)
+                indices = [
+                    i for i in partitions.get(range_start, ())
+                    if file_first <= columns[number_column][i] <= file_last]
+                if indices:
+                    if len(indices) < arrow_table.num_rows:
+                        part = arrow_table.take(pyarrow.array(indices))
+                    else:
+                        part = arrow_table
+                    self._write_file(table, part, path)
+                    self.metrics.inc(
+                        'parquet_rows_written_total', part.num_rows, {'table': table})
+                # Older files overlapping these blocks go, whether or not
+                # the blocks have rows in this table now
+                self._cut_files(
+                    table, number_column, file_first, file_last,
+                    keep=(path,) if indices else (),
+                    directory=os.path.dirname(path))
+
+    def delete_blocks(self, first, last=None):
+        for table, _, number_column in self.TABLES:
+            self._cut_files(table, number_column, first, last)
+
+
+def make_sinks(names, database_client, parquet_dir=settings.PARQUET_DIR,
+               parquet_partition_size=settings.PARQUET_PARTITION_SIZE,
+               parquet_compression=settings.PARQUET_COMPRESSION):
+    """
+    Build the sinks named in `names`, a list or comma separated string.
+    The database sink is always put last, so its commit (which records
+    the sync state) only happens once the other sinks have written.
+    """
+    if isinstance(names, str):
+        names = [n.strip() for n in names.split(',') if n.strip()]
+    sinks = []
+    for name in names:
+        if name == ParquetSink.name:
+            sinks.append(ParquetSink(
+                parquet_dir,
+                partition_size=parquet_partition_size,
+                compression=parquet_compression
+            ))
+        elif name != DatabaseSink.name:
+            raise ValueError(f'Unknown sink: {name}')
+    if DatabaseSink.name in names:
+        sinks.append(DatabaseSink(database_client))
+    if not sinks:
+        raise ValueError('At least one sink is needed')
+    return sinks
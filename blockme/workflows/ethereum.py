@@ -5,20 +5,31 @@ to a specified database.
 NOTE: This file was modified from its original version
 created by Alex Miller: https://github.com/alex-miller-0/Ethereum_Blockchain_Parser
 """
-import requests
-import json
+import multiprocessing
 import os
+import random
+import socket
 import time
 import datetime
-import sys
-import tqdm
+import traceback
 
 import settings
 
 from blockme.util.db_util import EthereumDatabaseHelper
 from blockme.util import crawler_util
+from blockme.util.archive_util import BlockArchive
+from blockme.util.sink_util import DatabaseSink, make_sinks
+from blockme.util.rate_util import AdaptiveConcurrencyLimiter
+from blockme.util.rpc_util import RPCClient, RPCError, make_transport
+from blockme.util import pipeline_util
 from blockme.util.logging_util import get_blockme_console_logger, \
     get_insertion_error_file_logger
+from blockme.util.metrics_util import get_metrics_registry, MetricsServer, \
+    StatsFileWriter
+
+
+class ReorgError(Exception):
+    pass
 
 
 class Crawler(object):
@@ -31,19 +42,54 @@ class Crawler(object):
         start=True,
         rpc_port=settings.ETHEREUM_JSON_RPC_PORT,
         host="http://127.0.0.1",
-        delay=0.0001,
-        chunk_size=10000
+        ipc_path=settings.ETHEREUM_IPC_PATH,
+        endpoints=settings.ETHEREUM_RPC_ENDPOINTS,
+        chunk_size=settings.CRAWLER_CHUNK_SIZE,
+        batch_size=settings.ETHEREUM_RPC_BATCH_SIZE,
+        fetchers=settings.CRAWLER_FETCHERS,
+        decoders=settings.CRAWLER_DECODERS,
+        max_in_flight=settings.CRAWLER_MAX_IN_FLIGHT,
+        start_block=1,
+        receipts=settings.CRAWLER_RECEIPTS,
+        workers=settings.CRAWLER_WORKERS,
+        lease_size=settings.LEASE_SIZE,
+        lease_seconds=settings.LEASE_SECONDS,
+        archive_dir=settings.ARCHIVE_DIR,
+        replay=False,
+        bulk_load=settings.BULK_LOAD,
+        retry_failed=settings.DEAD_LETTER_RETRY,
+        stream_parse=settings.RPC_STREAM_PARSE,
+        sinks=settings.CRAWLER_SINKS,
+        parquet_dir=settings.PARQUET_DIR,
+        db_url=settings.DATABASE_URL
     ):
         """Initialize the Crawler."""
         self.logger = get_blockme_console_logger()
         self.logger.debug("Starting Crawler")
+        self.metrics = get_metrics_registry()
+        self.metrics_exporters = []
         self.url = "{}:{}".format(host, rpc_port)
-        self.headers = {"content-type": "application/json"}
 
         self.chunk_size = chunk_size
 
+        # The number of calls sent to geth in a single JSON-RPC batch
+        self.batch_size = batch_size
+
+        # Concurrency of the fetch and decode stages, and the number of
+        # chunks allowed between being fetched and being committed
+        self.fetchers = fetchers
+        self.decoders = decoders
+        self.max_in_flight = max_in_flight
+
         # Initializes to default host/port = localhost/27017
-        self.database_client = EthereumDatabaseHelper()
+        self.database_client = EthereumDatabaseHelper(db_url=db_url)
+
+        # Where decoded chunks are written. The database keeps the sync
+        # state even when rows only go to other sinks
+        self.sinks = make_sinks(sinks, self.database_client, parquet_dir=parquet_dir)
+        self.writes_database = any(isinstance(s, DatabaseSink) for s in self.sinks)
+        # Blocks rolled back or deleted in the database leave every sink
+        self.database_client.chain_listeners.append(self.remove_from_sinks)
 
         # The max block number that is in the database
         self.max_block_db = None
@@ -54,37 +100,416 @@ class Crawler(object):
         # Record errors for inserting block data into the database
         self.insertion_error_logger = get_insertion_error_file_logger()
 
-        # Make a stack of block numbers that are in the database
-        self.block_queue = self.database_client.get_block_queue()
+        # The first block number to crawl
+        self.start_block = start_block
 
-        # The delay between requests to geth
-        self.delay = delay
+        # Whether receipts and logs are fetched along with blocks, and
+        # whether the node supports eth_getBlockReceipts (None until known)
+        self.receipts = receipts
+        self.block_receipts_supported = None
+
+        # Inclusive (first, last) ranges of blocks missing from the database
+        self.missing_ranges = []
+
+        # Blocks follow mode has dead-lettered and not yet stored
+        self.follow_dead_lettered = set()
+
+        # The most recently run pipeline, kept for its stage statistics
+        self.pipeline = None
+
+        # Adapts the number of concurrent requests to geth to its latency
+        # and error rate; the fetcher threads are the upper bound
+        self.rpc_limiter = AdaptiveConcurrencyLimiter(
+            initial_limit=min(settings.RPC_INITIAL_CONCURRENCY, fetchers),
+            max_limit=fetchers,
+            latency_target=settings.RPC_LATENCY_TARGET
+        )
+
+        self.metrics.set_gauge(
+            'rpc_concurrency_limit', lambda: self.rpc_limiter.limit)
+        self.metrics.set_gauge(
+            'rpc_in_flight', lambda: self.rpc_limiter.in_flight)
+        self.metrics.set_gauge(
+            'rpc_latency_ewma_seconds', lambda: self.rpc_limiter.latency or 0)
+
+        # Pooled connections to geth over HTTP, or over geth.ipc if given,
+        # or load balanced over several nodes if `endpoints` lists them
+        self.rpc = RPCClient(
+            make_transport(
+                endpoints or ipc_path or self.url,
+                pool_size=fetchers,
+                timeout=settings.RPC_TIMEOUT,
+                health_interval=settings.RPC_HEALTH_INTERVAL,
+                max_lag=settings.RPC_MAX_LAG
+            ),
+            limiter=self.rpc_limiter,
+            retries=settings.RPC_RETRIES,
+            backoff=settings.RPC_RETRY_BACKOFF
+        )
+
+        # Sharded backfill: number of worker processes, the size of the
+        # block ranges they lease and how long a lease lasts unrenewed
+        self.workers = workers
+        self.lease_size = lease_size
+        self.lease_seconds = lease_seconds
+        if workers > 1 and self.database_client.engine.dialect.name != 'postgresql':
+            raise ValueError(
+                'Sharded backfill (CRAWLER_WORKERS > 1) needs a PostgreSQL database')
+
+        # Optional raw block archive. Fetched blocks are appended to it, and
+        # in replay mode blocks are read from it instead of from geth
+        self.archive = None
+        if archive_dir:
+            self.archive = BlockArchive(
+                archive_dir,
+                segment_size=settings.ARCHIVE_SEGMENT_SIZE,
+                compression_level=settings.ARCHIVE_COMPRESSION_LEVEL
+            )
+        self.replay = replay
+        if replay and self.archive is None:
+            raise ValueError('Replay mode needs an archive_dir')
+
+        # Decode geth's block responses as they stream in, keeping only
+        # the fields that are loaded, so memory doesn't grow with the size
+        # of the blocks (HTTP only, and not while archiving raw blocks)
+        self.stream_parse = stream_parse
+        if stream_parse and crawler_util.ijson is None:
+            self.logger.warning(
+                'RPC_STREAM_PARSE needs ijson (pip install ijson); '
+                'decoding whole responses instead.')
+
+        # Drop secondary indexes and foreign keys for the crawl and rebuild
+        # them once it has finished
+        self.bulk_load = bulk_load
+
+        # Re-fetch dead-lettered blocks once a crawl has finished
+        self.retry_failed = retry_failed
+
+        # The arguments each worker process builds its own Crawler with
+        self.worker_kwargs = {
+            'rpc_port': rpc_port,
+            'host': host,
+            'ipc_path': ipc_path,
+            'endpoints': endpoints,
+            'chunk_size': chunk_size,
+            'batch_size': batch_size,
+            'fetchers': fetchers,
+            'decoders': decoders,
+            'max_in_flight': max_in_flight,
+            'start_block': start_block,
+            'receipts': receipts,
+            'archive_dir': archive_dir,
+            'replay': replay,
+            'stream_parse': stream_parse,
+            'sinks': sinks,
+            'parquet_dir': parquet_dir,
+            'db_url': db_url,
+        }
 
         if start:
-            self.max_block_db = self.database_client.get_latest_block_in_database()
-            self.max_block_geth = self.highest_block_eth()
-            self.run()
+            self.start_metrics_exporters()
+            self.database_client.initialize_sync_state()
+            self.max_block_db = self.highest_block_database()
+            if self.replay:
+                self.max_block_geth = self.highest_block_archive()
+            else:
+                self.max_block_geth = self.highest_block_eth()
+            self.database_client.ensure_partitions(self.max_block_geth)
+            if self.workers > 1:
+                self.run_sharded()
+            else:
+                self.run()
+
+    def start_metrics_exporters(self, file_suffix=''):
+        """
+        Start the Prometheus endpoint and/or the JSON stats file writer, if
+        METRICS_PORT / METRICS_FILE are configured.
+        """
+        if settings.METRICS_PORT:
+            self.metrics_exporters.append(
+                MetricsServer(self.metrics, int(settings.METRICS_PORT)).start())
+            self.logger.info(
+                f"Serving metrics on port {settings.METRICS_PORT}")
+        if settings.METRICS_FILE:
+            self.metrics_exporters.append(StatsFileWriter(
+                self.metrics,
+                settings.METRICS_FILE + file_suffix,
+                settings.METRICS_INTERVAL
+            ).start())
+
+    def stop_metrics_exporters(self):
+        """Stop the metrics exporters and write any stage profiles."""
+        for exporter in self.metrics_exporters:
+            exporter.stop()
+        self.metrics_exporters = []
+        self.metrics.dump_profiles()
+
+    def close(self):
+        """
+        Stop the metrics exporters, close the connections to geth
+        (including the load balancer's health checks) and the raw block
+        archive, and return the database connection to the pool. Safe to
+        call twice.
+        """
+        self.stop_metrics_exporters()
+        self.rpc.close()
+        if self.archive is not None:
+            self.archive.close()
+        self.database_client.close()
 
     def _rpcRequest(self, method, params, key):
-        """Make an RPC request to geth on port 8545."""
+        """Make an RPC request to geth."""
         payload = {
             "method": method,
             "params": params,
             "jsonrpc": "2.0",
             "id": 0
         }
-        time.sleep(self.delay)
-        res = requests.post(
-              self.url,
-              data=json.dumps(payload),
-              headers=self.headers).json()
+        res = self.rpc.send(payload)
         return res[key]
 
-    def get_block_and_associated_transactions(self, n):
-        """Get a specific block from the blockchain and filter the data."""
-        data = self._rpcRequest("eth_getBlockByNumber", [hex(n), True], "result")
-        block, transactions = crawler_util.decode_block(data)
-        return block, transactions
+    def _rpcBatchRequest(self, calls, projection=None):
+        """
+        Make a JSON-RPC 2.0 batch request to geth.
+
+        calls :: a list of (method, params) tuples
+        projection :: optional filter of the response members to decode
+                      (see crawler_util.json_load_projected)
+
+        Returns a list of (result, error) tuples in the same order as `calls`.
+        """
+        return self.rpc.batch(calls, projection=projection)
+
+    def fetch_blocks(self, numbers):
+        """
+        Fetch raw blocks from geth using batched RPC calls.
+
+        numbers :: an iterable of block numbers
+
+        Returns a list of (number, result, error) tuples. In replay mode
+        the blocks are read from the archive instead.
+        """
+        if self.replay:
+            return self.read_archived_blocks(numbers)
+
+        # The archive keeps whole blocks, so only stream-parse without one
+        projection = None
+        if self.stream_parse and self.archive is None:
+            projection = crawler_util.keep_block_field
+
+        fetched = []
+        for batch in self.chunk(list(numbers), self.batch_size):
+            calls = [("eth_getBlockByNumber", [hex(n), True]) for n in batch]
+            try:
+                results = self._rpcBatchRequest(calls, projection)
+                results = self._refetch_elsewhere(calls, results, projection)
+            except RPCError as e:
+                # Out of retries; leave the batch for the next run
+                results = [(None, {"message": str(e)})] * len(batch)
+            for n, (data, error) in zip(batch, results):
+                fetched.append((n, data, error))
+
+        if self.archive is not None:
+            self.archive.append_many(
+                (n, data) for n, data, error in fetched
+                if error is None and data is not None
+            )
+        return fetched
+
+    def fetch_receipts(self, fetched):
+        """
+        Fetch the receipts of the blocks in `fetched` (the output of
+        `fetch_blocks`) with one eth_getBlockReceipts call per block, in
+        batches. Nodes without eth_getBlockReceipts fall back to batched
+        eth_getTransactionReceipt calls, one per transaction.
+
+        Returns a dict of block number -> list of receipts. Blocks whose
+        receipts could not all be fetched are left out.
+        """
+        blocks = [
+            (n, data) for n, data, error in fetched
+            if error is None and data is not None
+        ]
+        receipts = {}
+
+        if self.block_receipts_supported is not False:
+            for batch in self.chunk(blocks, self.batch_size):
+                calls = [("eth_getBlockReceipts", [hex(n)]) for n, _ in batch]
+                try:
+                    results = self._refetch_elsewhere(
+                        calls, self._rpcBatchRequest(calls))
+                except RPCError as e:
+                    self.logger.warning(f'Failed to fetch block receipts: {e}')
+                    continue
+                for (n, _), (result, error) in zip(batch, results):
+                    if error is not None and error.get("code") == -32601:
+                        self.logger.info(
+                            'eth_getBlockReceipts is not supported; '
+                            'fetching receipts per transaction.')
+                        self.block_receipts_supported = False
+                        break
+                    if error is None and result is not None:
+                        receipts[n] = result
+                if self.block_receipts_supported is False:
+                    break
+                self.block_receipts_supported = True
+
+        if self.block_receipts_supported is False:
+            hashes = [
+                (n, t["hash"]) for n, data in blocks if n not in receipts
+                for t in data["transactions"]
+            ]
+            by_block = {n: [] for n, _ in blocks if n not in receipts}
+            incomplete = set()
+            for batch in self.chunk(hashes, self.batch_size):
+                calls = [("eth_getTransactionReceipt", [h]) for _, h in batch]
+                try:
+                    results = self._refetch_elsewhere(
+                        calls, self._rpcBatchRequest(calls))
+                except RPCError as e:
+                    self.logger.warning(f'Failed to fetch receipts: {e}')
+                    incomplete.update(n for n, _ in batch)
+                    continue
+                for (n, _), (result, error) in zip(batch, results):
+                    if error is None and result is not None:
+                        by_block[n].append(result)
+                    else:
+                        incomplete.add(n)
+            for n, block_receipts in by_block.items():
+                if n not in incomplete:
+                    receipts[n] = block_receipts
+        return receipts
+
+    def fetch_chunk(self, numbers):
+        """
+        Pipeline fetcher: fetch a chunk of blocks and, if enabled, their
+        receipts. Returns a tuple of (fetched, receipts); receipts is None
+        when not fetched. Receipts are not archived, so replay skips them.
+        """
+        fetched = self.fetch_blocks(numbers)
+        if not self.receipts or self.replay:
+            return fetched, None
+        return fetched, self.fetch_receipts(fetched)
+
+    def _refetch_elsewhere(self, calls, results, projection=None):
+        """
+        When load balancing over several nodes, re-request the calls of a
+        batch that failed or came back empty (e.g. from a node that is
+        behind) from a different node. Returns the merged results.
+        """
+        served_by = self.rpc.served_by
+        if served_by is None:
+            return results
+        missing = [
+            i for i, (data, error) in enumerate(results)
+            if error is not None or data is None
+        ]
+        if not missing:
+            return results
+
+        self.metrics.inc('rpc_failovers_total')
+        try:
+            retried = self.rpc.batch(
+                [calls[i] for i in missing], exclude=(served_by,),
+                projection=projection)
+        except RPCError as e:
+            self.logger.warning(f'Re-fetch of {len(missing)} calls failed: {e}')
+            return results
+        results = list(results)
+        for i, result in zip(missing, retried):
+            results[i] = result
+        return results
+
+    def read_archived_blocks(self, numbers):
+        """
+        Read raw blocks from the archive in the same form as `fetch_blocks`.
+        """
+        fetched = []
+        for n in numbers:
+            data = self.archive.get(n)
+            error = None if data is not None else {"message": "not in archive"}
+            fetched.append((n, data, error))
+        return fetched
+
+    def decode_blocks(self, fetched):
+        """
+        Decode the output of `fetch_blocks`.
+
+        Returns a tuple of (blocks, transactions, failed) where `failed` is a
+        list of block numbers geth could not return.
+        """
+        blocks = []
+        transactions = []
+        failed = []
+        for n, data, error in fetched:
+            if error is not None or data is None:
+                self.logger.warning(f"Failed to fetch block {n}: {error}")
+                self.metrics.inc('fetch_errors_total')
+                failed.append(n)
+                continue
+            block, block_transactions = crawler_util.decode_block(data)
+            if block:
+                blocks.append(block)
+            if block_transactions:
+                transactions.extend(block_transactions)
+        return blocks, transactions, failed
+
+    def decode_receipts(self, receipts, numbers):
+        """
+        Decode the receipts of blocks `numbers`, from the output of
+        `fetch_receipts`, into (receipt_columns, log_columns).
+        """
+        block_receipts = [r for n in numbers for r in receipts[n]]
+        logs = [log for r in block_receipts for log in r["logs"]]
+        self.metrics.inc('receipts_fetched_total', len(block_receipts))
+        self.metrics.inc('logs_fetched_total', len(logs))
+        return (
+            crawler_util.decode_receipt_columns(block_receipts),
+            crawler_util.decode_log_columns(logs)
+        )
+
+    def decode_chunk(self, fetched, receipts=None):
+        """
+        Pipeline decoder: decode the output of `fetch_chunk` into columns.
+        Blocks whose receipts are missing are treated as failed.
+
+        Returns a tuple of (block_columns, transaction_columns, failed,
+        receipt_columns, log_columns); the last two are None when
+        receipts were not fetched.
+        """
+        with self.metrics.timer('decode_seconds'):
+            if receipts is not None:
+                fetched = [
+                    (n, data, error) if error is not None or n in receipts
+                    else (n, None, {"message": "receipts unavailable"})
+                    for n, data, error in fetched
+                ]
+            blocks, transactions, failed = self.decode_blocks(fetched)
+            receipt_columns = log_columns = None
+            if receipts is not None:
+                receipt_columns, log_columns = self.decode_receipts(
+                    receipts, [int(b['number'], 16) for b in blocks])
+            decoded = (
+                crawler_util.decode_block_columns(blocks),
+                crawler_util.decode_transaction_columns(transactions),
+                failed,
+                receipt_columns,
+                log_columns
+            )
+        self.metrics.inc('blocks_fetched_total', len(blocks))
+        self.metrics.inc('transactions_fetched_total', len(transactions))
+        return decoded
+
+    def get_blocks_and_associated_transactions(self, numbers):
+        """
+        Get a list of blocks from the blockchain using batched RPC calls.
+
+        numbers :: an iterable of block numbers
+
+        Returns a tuple of (blocks, transactions, failed) where `failed` is a
+        list of block numbers geth could not return.
+        """
+        return self.decode_blocks(self.fetch_blocks(numbers))
 
     def highest_block_eth(self):
         """Find the highest numbered block in geth."""
@@ -93,43 +518,467 @@ class Crawler(object):
         self.logger.info(f"Highest block found: {num_hex}.")
         return num_hex
 
-    def save_blocks_and_transactions_to_database(self, blocks, transactions):
-        """Insert a given parsed block into database."""
+    def highest_block_archive(self):
+        """Find the highest numbered block in the archive."""
+        highest_block = self.archive.highest_block()
+        self.logger.info(f"Highest block found in archive: {highest_block}")
+        return highest_block if highest_block is not None else 0
+
+    def save_blocks_and_transactions_to_database(
+            self, block_columns, transaction_columns, synced_ranges=(),
+            receipt_columns=None, log_columns=None, dead_lettered=None):
+        """
+        Write decoded block, transaction and optionally receipt and log
+        columns to every sink, then record `synced_ranges` as committed.
+        With the database sink, rows and sync state share one transaction.
+
+        On failure the traceback is logged to INSERTION_ERROR_FILE, the
+        session is rolled back and the blocks are dead-lettered for
+        `retry_failed_blocks`. Returns whether the chunk was saved.
+
+        dead_lettered :: optional set of blocks already dead-lettered for
+                         this failure, which are not recorded again; the
+                         newly dead-lettered blocks are added to it
+        """
         try:
-            self.database_client.insert_blocks(blocks)
-        except:
-            the_type, the_value, the_traceback = sys.exc_info()
-            message = f'\n------\n{the_type}\n{the_value}\n{the_traceback}\n------'
+            for sink in self.sinks:
+                with self.metrics.timer('sink_seconds', {'sink': sink.name}):
+                    sink.write_chunk(
+                        block_columns, transaction_columns, synced_ranges,
+                        receipt_columns, log_columns)
+            if not self.writes_database:
+                self.database_client.record_synced_ranges(synced_ranges)
+        except Exception as e:
+            message = f'\n------\n{traceback.format_exc()}------'
             self.insertion_error_logger.error(message)
+            self.database_client.recover_session()
+            numbers = [
+                n for first, last in synced_ranges for n in range(first, last + 1)]
+            if dead_lettered is not None:
+                numbers = [n for n in numbers if n not in dead_lettered]
+                dead_lettered.update(numbers)
+            self.dead_letter(numbers, 'insert', repr(e))
+            return False
+        return True
 
+    def remove_from_sinks(self, payload):
+        """
+        Chain listener passing blocks removed from the database (a reorg
+        rollback or a verify repair) on to the sinks.
+        """
+        action, *numbers = payload.split(':')
+        if action == 'rollback':
+            first, last = int(numbers[0]) + 1, None
+        elif action == 'delete':
+            first, last = int(numbers[0]), int(numbers[1])
+        else:
+            return
+        for sink in self.sinks:
+            sink.delete_blocks(first, last)
+
+    def dead_letter(self, numbers, stage, error=None):
+        """
+        Record blocks that failed at `stage` in the dead-letter table. If
+        even that fails they are only logged; as they were never marked
+        synced, the next gap scan still finds them.
+        """
+        if not numbers:
+            return
         try:
-            self.database_client.insert_transactions(transactions)
-        except:
-            the_type, the_value, the_traceback = sys.exc_info()
-            message = f'\n------\n{the_type}\n{the_value}\n{the_traceback}\n------'
-            self.insertion_error_logger.error(message)
+            self.database_client.record_failed_blocks(numbers, stage, error)
+        except Exception as e:
+            self.database_client.recover_session()
+            self.insertion_error_logger.error(
+                f'Could not dead-letter blocks {numbers[0]} to {numbers[-1]}: {e!r}')
+
+    def retry_failed_blocks(self, max_attempts=settings.DEAD_LETTER_MAX_ATTEMPTS,
+                            chunk_size=settings.DEAD_LETTER_CHUNK_SIZE):
+        """
+        Re-fetch and re-insert the blocks in the dead-letter table that
+        have failed fewer than `max_attempts` times, in small chunks of
+        `chunk_size` blocks so that a block that keeps failing only holds
+        back its own chunk. Blocks that are stored leave the table; the
+        rest have their attempts bumped.
+
+        Returns the number of blocks still dead-lettered.
+        """
+        numbers = self.database_client.get_failed_blocks(max_attempts)
+        if numbers:
+            self.logger.info(f'Retrying {len(numbers)} dead-lettered blocks...')
+            self.process_ranges(
+                crawler_util.numbers_to_ranges(numbers), chunk_size=chunk_size)
+        remaining = len(self.database_client.get_failed_blocks())
+        if remaining:
+            self.logger.warning(
+                f'{remaining} blocks remain dead-lettered '
+                f'(see the {settings.ETHEREUM_SCHEMA}.failed_block table)')
+        return remaining
 
     def highest_block_database(self):
         """Find the highest numbered block in the database."""
-        highest_block = self.database_client.get_latest_block_in_database()
+        highest_block = self.database_client.get_highest_synced_block()
         self.logger.info(f"Highest block found in database: {highest_block}")
         return highest_block
 
-    def collect_block_and_transactions(self, n):
-        """Prepare blocks and transactions to add to database"""
-        block, transactions = self.get_block_and_associated_transactions(n)
-        blocks_to_insert = []
-        transactions_to_insert = []
-        
-        if block:
-            blocks_to_insert.append(block)
-            time.sleep(0.001)
-        
-        if transactions:
-            transactions_to_insert.extend(transactions)
-            time.sleep(0.001)
-
-        return blocks_to_insert, transactions_to_insert
+    def _write_chunk(self, chunk, decoded, on_commit=None):
+        """Pipeline writer: save one decoded chunk to the database."""
+        (block_columns, transaction_columns, failed,
+         receipt_columns, log_columns) = decoded
+        if failed:
+            self.insertion_error_logger.error(
+                f'Failed to fetch blocks: {failed}')
+            self.dead_letter(failed, 'fetch', 'block or receipts unavailable')
+        synced_ranges = crawler_util.numbers_to_ranges(
+            set(chunk).difference(failed))
+        saved = self.save_blocks_and_transactions_to_database(
+            block_columns, transaction_columns, synced_ranges,
+            receipt_columns, log_columns)
+        if saved:
+            self.logger.info(
+                f'Committed blocks {chunk[0]} to {chunk[-1]} '
+                f'(rpc limit {self.rpc_limiter.limit}, '
+                f'latency {self.rpc_limiter.latency or 0:.3f}s)')
+        else:
+            self.logger.warning(
+                f'Failed to save blocks {chunk[0]} to {chunk[-1]}; dead-lettered')
+        if on_commit is not None:
+            on_commit(chunk)
+
+    def chunk_ranges(self, ranges, chunk_size=None):
+        """Yield chunk_size-sized ranges of block numbers from (first, last) ranges."""
+        for first, last in ranges:
+            for chunk in self.chunk(range(first, last + 1), chunk_size or self.chunk_size):
+                yield chunk
+
+    def process_ranges(self, ranges, on_commit=None, chunk_size=None):
+        """
+        Fetch, decode and save the blocks in `ranges` through a concurrent
+        pipeline.
+
+        Chunks of `chunk_size` blocks are fetched by `fetchers` threads and
+        decoded by `decoders` threads while the database writes the
+        previous chunks. Chunks are always committed in order.
+
+        ranges :: a list of inclusive (first, last) block number ranges
+        on_commit :: optional callable(chunk) run after each chunk is saved
+        chunk_size :: blocks per chunk; defaults to the crawler's chunk_size
+        """
+        pipeline = self.pipeline = pipeline_util.OrderedPipeline(
+            fetch=self.fetch_chunk,
+            decode=lambda chunk, fetched: self.decode_chunk(*fetched),
+            write=lambda chunk, decoded: self._write_chunk(
+                chunk, decoded, on_commit),
+            fetchers=self.fetchers,
+            decoders=self.decoders,
+            max_in_flight=self.max_in_flight
+        )
+        for stage in ('fetch', 'decode', 'write'):
+            self.metrics.set_gauge(
+                'queue_depth',
+                lambda stage=stage: pipeline.queue_depths()[stage],
+                {'stage': stage}
+            )
+        pipeline.run(self.chunk_ranges(ranges, chunk_size))
+
+    def process_leases(self, owner):
+        """
+        Lease block ranges from the database and crawl them until no work
+        is left. The lease is renewed after every committed chunk; if it is
+        lost or the range fails, it is left to expire and be reclaimed.
+        """
+        db = self.database_client
+        while True:
+            leased = db.lease_range(owner, self.lease_seconds)
+            if leased is None:
+                break
+            first, last = leased
+            last = min(last, self.max_block_geth)
+            ranges = db.get_unsynced_ranges(first, last)
+            self.logger.info(f'{owner} leased blocks {first} to {last}')
+            try:
+                self.process_ranges(
+                    ranges,
+                    on_commit=lambda chunk: db.renew_lease(
+                        leased[0], owner, self.lease_seconds)
+                )
+            except pipeline_util.PipelineError as e:
+                self.logger.error(f'{owner} gave up blocks {first} to {last}: {e}')
+                continue
+            db.complete_lease(leased[0], owner, last)
+
+    def run_sharded(self):
+        """
+        Crawl with `workers` processes, each with its own RPC and database
+        connections, coordinating through leased block ranges.
+
+        Several machines may run this against the same database at once.
+        """
+        try:
+            start_time = datetime.datetime.utcnow()
+            self.logger.info("Highest block found as: {}".format(self.max_block_geth))
+            ranges = self.database_client.get_unsynced_ranges(
+                self.start_block, self.max_block_geth)
+            self.database_client.create_range_leases(ranges, self.lease_size)
+            if self.bulk_load:
+                self.database_client.defer_indexes()
+
+            self.logger.info(f"Starting {self.workers} backfill workers...")
+            context = multiprocessing.get_context('spawn')
+            processes = [
+                context.Process(
+                    target=_lease_worker,
+                    args=(self.worker_kwargs, self.max_block_geth, self.lease_size,
+                          self.lease_seconds)
+                )
+                for _ in range(self.workers)
+            ]
+            for p in processes:
+                p.start()
+            for p in processes:
+                p.join()
+                if p.exitcode != 0:
+                    self.logger.error(f"Worker {p.pid} exited with code {p.exitcode}")
+            if self.retry_failed:
+                self.retry_failed_blocks()
+            if self.bulk_load:
+                self.finish_bulk_load(
+                    all(p.exitcode == 0 for p in processes) and
+                    not self.database_client.get_unsynced_ranges(
+                        self.start_block, self.max_block_geth))
+
+            runtime = time.strftime(
+                '%H:%M:%S',
+                time.gmtime((datetime.datetime.utcnow() - start_time).seconds)
+            )
+            self.logger.info(f'Sharded backfill finished. Runtime (HH:MM:SS): {runtime}')
+        finally:
+            self.close()
+
+    def finish_bulk_load(self, complete):
+        """
+        Rebuild the indexes and constraints deferred for a bulk load once
+        the crawl is `complete`. Otherwise they stay deferred, so the next
+        bulk-load run carries on at full speed; `python runner.py
+        build-indexes` rebuilds them by hand.
+        """
+        if not complete:
+            self.logger.warning(
+                "Crawl incomplete; leaving indexes deferred until the next "
+                "bulk load finishes (or run `python runner.py build-indexes`).")
+            return
+        self.logger.info("Rebuilding deferred indexes and constraints...")
+        self.database_client.rebuild_deferred_indexes(settings.INDEX_BUILD_WORKERS)
+
+    def spot_check(self, start, end, sample_size):
+        """
+        Compare the stored hashes of up to `sample_size` random blocks in
+        [start, end] with geth's, in batched calls. Returns the numbers of
+        the blocks that differ.
+        """
+        population = range(start, end + 1)
+        sample = random.sample(population, min(sample_size, len(population)))
+        stored = self.database_client.get_block_hashes(sample)
+        bad = []
+        for batch in self.chunk(sorted(stored), self.batch_size):
+            calls = [("eth_getBlockByNumber", [hex(n), False]) for n in batch]
+            try:
+                results = self._rpcBatchRequest(calls)
+            except RPCError as e:
+                self.logger.warning(f'Spot check of {len(batch)} blocks failed: {e}')
+                continue
+            for n, (data, error) in zip(batch, results):
+                if error is None and data is not None and \
+                        crawler_util.hex_to_bytes(data['hash']) != stored[n]:
+                    bad.append(n)
+        self.logger.info(
+            f'Spot-checked {len(stored)} blocks against geth: {len(bad)} differ')
+        return bad
+
+    def verify(self, start=None, end=None, sample_size=settings.VERIFY_SAMPLE_SIZE,
+               repair=False):
+        """
+        Check that the database holds a contiguous, consistent chain from
+        `start` (default: start_block) to `end` (default: the highest
+        stored block). Broken parent hash links and transactions that
+        disagree with their block are found in parallel in the database,
+        gaps with the gap scan, and `sample_size` random blocks are
+        compared with geth (0 skips the spot check).
+
+        With `repair`, the bad ranges are deleted, taken out of the sync
+        state and crawled again.
+
+        Returns the bad ranges as a sorted list of inclusive (first, last)
+        ranges.
+        """
+        db = self.database_client
+        start = self.start_block if start is None else start
+        if end is None:
+            end = db.get_highest_stored_block()
+            if end is None:
+                self.logger.info('No blocks stored; nothing to verify.')
+                return []
+        self.logger.info(f'Verifying blocks {start} to {end}...')
+
+        bad = set(db.verify_chain(start, end))
+        if sample_size and not self.replay:
+            bad.update(self.spot_check(start, end, sample_size))
+        missing = db.get_missing_block_ranges(start, end)
+        ranges = crawler_util.merge_ranges(
+            crawler_util.numbers_to_ranges(bad) + missing)
+
+        num_bad = sum(last - first + 1 for first, last in ranges)
+        self.metrics.inc('verify_bad_blocks_total', num_bad)
+        if not ranges:
+            self.logger.info(f'Blocks {start} to {end} are consistent.')
+            return ranges
+        self.logger.warning(
+            f'{len(bad)} inconsistent blocks and '
+            f'{sum(last - first + 1 for first, last in missing)} missing blocks '
+            f'in {len(ranges)} ranges: {ranges[:10]}'
+            f'{" ..." if len(ranges) > 10 else ""}')
+        if repair:
+            db.delete_block_ranges(ranges)
+            self.logger.info(f'Re-crawling {num_bad} blocks...')
+            self.process_ranges(ranges)
+        return ranges
+
+    def find_fork_point(self, tip, max_depth=settings.FOLLOW_MAX_REORG_DEPTH):
+        """
+        Walk back from `tip` to the highest block whose stored hash still
+        matches geth's canonical chain and return its number.
+        """
+        n = tip
+        while n >= max(self.start_block - 1, tip - max_depth):
+            stored = self.database_client.get_block_hash(n)
+            if stored is None:
+                return n
+            block = self._rpcRequest(
+                "eth_getBlockByNumber", [hex(n), False], "result")
+            if block is not None and crawler_util.hex_to_bytes(block['hash']) == stored:
+                return n
+            n -= 1
+        raise ReorgError(
+            f'No common ancestor within {max_depth} blocks of {tip}')
+
+    def _follow_step(self, tip, tip_hash, head):
+        """
+        Ingest blocks tip + 1 .. head, checking each block's parent hash
+        against the block before it. Returns the new (tip, tip_hash).
+
+        On a parent hash mismatch at the old tip the orphaned blocks are
+        rolled back to the fork point; a mismatch further along means the
+        chain moved while fetching, and only the blocks before it are kept.
+        """
+        fetched, receipts = self.fetch_chunk(range(tip + 1, head + 1))
+        blocks, transactions, failed = self.decode_blocks(fetched)
+
+        accepted = []
+        expected_parent = tip_hash
+        for n, block in zip(range(tip + 1, head + 1), blocks):
+            if int(block['number'], 16) != n:
+                break
+            if receipts is not None and n not in receipts:
+                break
+            parent_hash = crawler_util.hex_to_bytes(block['parentHash'])
+            if expected_parent is not None and parent_hash != expected_parent:
+                if not accepted:
+                    fork = self.find_fork_point(tip)
+                    self.logger.warning(
+                        f'Reorg detected at block {tip + 1}; rolling back to {fork}')
+                    self.metrics.inc('reorgs_total')
+                    self.metrics.inc('reorged_blocks_total', tip - fork)
+                    self.database_client.rollback_blocks_after(fork)
+                    return fork, self.database_client.get_block_hash(fork)
+                break
+            accepted.append(block)
+            expected_parent = crawler_util.hex_to_bytes(block['hash'])
+
+        if not accepted:
+            return tip, tip_hash
+
+        last = tip + len(accepted)
+        accepted_transactions = [
+            t for t in transactions if int(t['blockNumber'], 16) <= last]
+        receipt_columns = log_columns = None
+        if receipts is not None:
+            receipt_columns, log_columns = self.decode_receipts(
+                receipts, range(tip + 1, last + 1))
+        # Blocks that keep failing are retried on every poll, but only
+        # dead-lettered the first time
+        saved = self.save_blocks_and_transactions_to_database(
+            crawler_util.decode_block_columns(accepted),
+            crawler_util.decode_transaction_columns(accepted_transactions),
+            [(tip + 1, last)],
+            receipt_columns,
+            log_columns,
+            dead_lettered=self.follow_dead_lettered
+        )
+        if not saved or self.database_client.get_block_hash(last) != expected_parent:
+            # The insert failed and was logged; retry on the next poll
+            return tip, tip_hash
+        self.follow_dead_lettered.difference_update(range(tip + 1, last + 1))
+        self.logger.info(f'Ingested blocks {tip + 1} to {last}')
+        return last, expected_parent
+
+    def follow(self, poll_interval=settings.FOLLOW_POLL_INTERVAL,
+               max_backoff=settings.FOLLOW_MAX_BACKOFF):
+        """
+        Keep the database at the head of the chain until interrupted.
+
+        Polls geth for new heads every `poll_interval` seconds and ingests
+        new blocks as they appear, rolling back blocks orphaned by reorgs.
+        If the database is more than a chunk behind, it first catches up
+        through the normal pipeline. Memory use does not grow over time.
+
+        While geth is unreachable or returns errors (e.g. during a
+        restart), polls back off, doubling from `poll_interval` up to
+        `max_backoff` seconds.
+        """
+        if not self.writes_database:
+            raise ValueError('Follow mode needs the database sink')
+        self.start_metrics_exporters()
+        self.database_client.initialize_sync_state()
+        tip = self.database_client.get_highest_synced_block()
+        if tip is None:
+            tip = self.start_block - 1
+        tip_hash = self.database_client.get_block_hash(tip)
+        self.metrics.set_gauge(
+            'head_lag_blocks', lambda: (self.max_block_geth or 0) - tip)
+
+        self.logger.info(f"Following the chain from block {tip}...")
+        backoff = poll_interval
+        try:
+            while True:
+                previous_tip = tip
+                try:
+                    self.max_block_geth = int(
+                        self._rpcRequest("eth_blockNumber", [], "result"), 16)
+                    head = self.max_block_geth
+                    self.database_client.ensure_partitions(head)
+                    if head - tip > self.chunk_size:
+                        self.logger.info(f"Catching up from {tip} to {head}...")
+                        self.process_ranges(
+                            self.database_client.get_unsynced_ranges(tip + 1, head))
+                        tip = self.database_client.get_highest_synced_block() or tip
+                        tip_hash = self.database_client.get_block_hash(tip)
+                    elif head > tip:
+                        tip, tip_hash = self._follow_step(tip, tip_hash, head)
+                except (RPCError, KeyError, pipeline_util.PipelineError) as e:
+                    # A KeyError is geth answering with an error instead of
+                    # a result
+                    self.metrics.inc('follow_errors_total')
+                    self.logger.warning(
+                        f'Polling geth failed ({e!r}); retrying in {backoff:g}s')
+                    time.sleep(backoff)
+                    backoff = min(backoff * 2, max_backoff)
+                    continue
+                backoff = poll_interval
+                if tip == previous_tip:
+                    # Nothing new, or the next blocks aren't served or
+                    # stored yet
+                    time.sleep(poll_interval)
+        finally:
+            self.close()
 
     def chunk(self, l, n):
         """Yield successive n-sized chunks from l."""
@@ -143,56 +992,63 @@ class Crawler(object):
         Iterate through the blockchain on geth and fill up db
         with block data.
         """
-        start_time = datetime.datetime.utcnow()
-        self.logger.debug("Processing geth blockchain:")
-        self.logger.info("Highest block found as: {}".format(self.max_block_geth))
-        self.logger.info(f"Number of blocks to process: {len(self.block_queue)}")
+        try:
+            start_time = datetime.datetime.utcnow()
+            self.logger.debug("Processing geth blockchain:")
+            self.logger.info("Highest block found as: {}".format(self.max_block_geth))
 
-        # Make sure the database isn't missing any blocks up to this point
-        self.logger.debug("Verifying that the database isn't missing any blocks...")
-        self.max_block_db = 1
-        if len(self.block_queue) > 0:
+            # Find every block range not yet committed, including the one
+            # between the highest stored block and the head of the chain
             self.logger.info("Looking for missing blocks...")
-            self.max_block_db = self.block_queue.pop()
-            for n in tqdm.tqdm(range(1, self.max_block_db)):
-                if len(self.block_queue) == 0:
-                    # If we have reached the max index of the queue,
-                    # break the loop
-                    break
-                else:
-                    # -If a block with number = current index is not in
-                    # the queue, add it to the database.
-                    # -If the lowest block number in the queue (_n) is
-                    # not the current running index (n), then _n > n
-                    # and we must add block n to the database. After doing so,
-                    # we will add _n back to the queue.
-                    _n = self.block_queue.popleft()
-                    if n != _n:
-                        blocks, transactions = self.collect_block_and_transactions(n)
-                        self.block_queue.appendleft(_n)
-
-        # Get all new blocks
-        self.logger.info("Processing remainder of the blockchain...")
-        blocks_to_pull = range(self.max_block_db, self.max_block_geth)
-        chunked_blocks = self.chunk(blocks_to_pull, self.chunk_size)
-        total = len([i for i in self.chunk(blocks_to_pull, self.chunk_size)])
-        for i,chunk in enumerate(chunked_blocks):
-            self.logger.info(f'Processing chunk {i} of {total}')
-            for n in tqdm.tqdm(chunk):
-                blocks, transactions = self.collect_block_and_transactions(n)
-                self.save_blocks_and_transactions_to_database(
-                    blocks, transactions)
-
-        end_time = datetime.datetime.utcnow()
-        self.logger.info("===============================")
-        self.logger.info("Processing complete.")
-        self.logger.info(f"Identified {len(self.insertion_errors)} insertion errors.")
-        self.logger.info(
-            f"These can be viewed in {settings.INSERTION_ERROR_FILE}")
-        runtime = time.strftime(
-            '%H:%M:%S',
-            time.gmtime((end_time - start_time).seconds)
-        )
-        self.logger.info('----------')
-        self.logger.info(f'Runtime (HH:MM:SS): {runtime}')
-        self.logger.info("===============================")
+            self.missing_ranges = self.database_client.get_unsynced_ranges(
+                self.start_block, self.max_block_geth)
+            num_missing = sum(last - first + 1 for first, last in self.missing_ranges)
+            self.logger.info(
+                f"Number of blocks to process: {num_missing} "
+                f"in {len(self.missing_ranges)} ranges")
+
+            if self.bulk_load:
+                self.database_client.defer_indexes()
+            completed = False
+            try:
+                self.process_ranges(self.missing_ranges)
+                if self.retry_failed:
+                    self.retry_failed_blocks()
+                completed = True
+            finally:
+                if self.bulk_load:
+                    self.finish_bulk_load(completed)
+
+            end_time = datetime.datetime.utcnow()
+            self.logger.info("===============================")
+            self.logger.info("Processing complete.")
+            self.logger.info(
+                f"Identified {self.metrics.value('insert_errors_total')} insertion errors "
+                f"and {self.metrics.value('fetch_errors_total')} fetch errors.")
+            self.logger.info(
+                f"These can be viewed in {settings.INSERTION_ERROR_FILE}")
+            runtime = time.strftime(
+                '%H:%M:%S',
+                time.gmtime((end_time - start_time).seconds)
+            )
+            self.logger.info('----------')
+            self.logger.info(f'Runtime (HH:MM:SS): {runtime}')
+            self.logger.info("===============================")
+        finally:
+            self.close()
+
+
+def _lease_worker(crawler_kwargs, max_block_geth, lease_size, lease_seconds):
+    """Entry point for a sharded backfill worker process."""
+    crawler = Crawler(
+        start=False,
+        lease_size=lease_size,
+        lease_seconds=lease_seconds,
+        **crawler_kwargs
+    )
+    crawler.max_block_geth = max_block_geth
+    crawler.start_metrics_exporters(file_suffix=f'.{os.getpid()}')
+    try:
+        crawler.process_leases(f'{socket.gethostname()}:{os.getpid()}')
+    finally:
+        crawler.close()
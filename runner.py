@@ -1,4 +1,142 @@
-from blockme.workflows.ethereum import Crawler
+import argparse
+
+
+# The crawler and database modules are imported by the commands that use
+# them, so short-lived commands start without loading the whole stack
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Migrate the blockchain from geth to a database.')
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.add_parser('crawl', help='Crawl blocks from geth (default)')
+    subparsers.add_parser(
+        'follow', help='Keep the database at the head of the chain, handling reorgs')
+    subparsers.add_parser(
+        'migrate', help='Upgrade an existing database to the current schema')
+    subparsers.add_parser(
+        'build-indexes', help='Rebuild indexes and constraints deferred by a bulk load')
+    subparsers.add_parser(
+        'status', help='Print the synced ranges and dead-lettered blocks')
+    subparsers.add_parser(
+        'retry-failed', help='Re-fetch and re-insert blocks in the dead-letter table')
+    subparsers.add_parser(
+        'rebuild-rollups', help='Recompute the daily, sender and miner rollup tables')
+
+    verify = subparsers.add_parser(
+        'verify', help='Check the stored chain is contiguous and consistent')
+    verify.add_argument('--start', type=int, help='Defaults to the first block')
+    verify.add_argument('--end', type=int, help='Defaults to the highest stored block')
+    verify.add_argument('--sample', type=int,
+                        help='Blocks spot-checked against geth; defaults to $VERIFY_SAMPLE_SIZE')
+    verify.add_argument('--repair', action='store_true',
+                        help='Delete and re-crawl the bad ranges')
+
+    serve = subparsers.add_parser(
+        'serve', help='Serve cached block and transaction lookups as JSON over HTTP')
+    serve.add_argument('--host', help='Defaults to $QUERY_API_HOST')
+    serve.add_argument('--port', type=int, help='Defaults to $QUERY_API_PORT')
+
+    replay = subparsers.add_parser(
+        'replay', help='Re-ingest blocks from the raw block archive without geth')
+    replay.add_argument('--archive-dir', help='Defaults to $ARCHIVE_DIR')
+
+    benchmark = subparsers.add_parser(
+        'benchmark', help='Measure crawler throughput against a fake geth')
+    benchmark.add_argument('--blocks', type=int, default=2000)
+    benchmark.add_argument('--transactions-per-block', type=int, default=100)
+    benchmark.add_argument('--latency', type=float, default=0.0,
+                           help='Seconds the fake geth waits per request')
+    benchmark.add_argument('--db-url', help='Defaults to a temporary SQLite file')
+    benchmark.add_argument('--fixtures', help='JSON file of recorded blocks to serve')
+    benchmark.add_argument('--output', default='bench_results.json')
+    benchmark.add_argument('--receipts', action='store_true',
+                           help='Also fetch and store receipts and logs')
+    return parser.parse_args()
+
+
+def print_status():
+    from blockme.util.db_util import EthereumDatabaseHelper
+    database_client = EthereumDatabaseHelper()
+    try:
+        ranges = database_client.get_synced_ranges()
+        failed = database_client.get_failed_blocks()
+        print(f'Highest synced block: {database_client.get_highest_synced_block()}')
+        print(f'Synced ranges: {len(ranges)} {ranges[:10]}'
+              f'{" ..." if len(ranges) > 10 else ""}')
+        print(f'Dead-lettered blocks: {len(failed)}')
+    finally:
+        database_client.close()
+
 
 if __name__ == '__main__':
-    Crawler()
+    args = parse_args()
+    if args.command in (None, 'crawl', 'replay', 'follow', 'retry-failed', 'verify'):
+        from blockme.workflows.ethereum import Crawler
+
+    if args.command == 'status':
+        print_status()
+    elif args.command == 'replay':
+        kwargs = {'replay': True}
+        if args.archive_dir:
+            kwargs['archive_dir'] = args.archive_dir
+        Crawler(**kwargs)
+    elif args.command == 'follow':
+        Crawler(start=False).follow()
+    elif args.command == 'migrate':
+        from blockme.util.db_util import EthereumDatabaseHelper
+        database_client = EthereumDatabaseHelper()
+        try:
+            database_client.migrate_to_binary_storage()
+            database_client.migrate_to_address_ids()
+        finally:
+            database_client.close()
+    elif args.command == 'build-indexes':
+        from blockme.util.db_util import EthereumDatabaseHelper
+        database_client = EthereumDatabaseHelper()
+        try:
+            database_client.rebuild_deferred_indexes()
+        finally:
+            database_client.close()
+    elif args.command == 'retry-failed':
+        crawler = Crawler(start=False)
+        try:
+            crawler.retry_failed_blocks()
+        finally:
+            crawler.close()
+    elif args.command == 'rebuild-rollups':
+        from blockme.util.db_util import EthereumDatabaseHelper
+        database_client = EthereumDatabaseHelper()
+        try:
+            database_client.rebuild_rollups()
+        finally:
+            database_client.close()
+    elif args.command == 'verify':
+        kwargs = {'start': args.start, 'end': args.end, 'repair': args.repair}
+        if args.sample is not None:
+            kwargs['sample_size'] = args.sample
+        crawler = Crawler(start=False)
+        try:
+            crawler.verify(**kwargs)
+        finally:
+            crawler.close()
+    elif args.command == 'serve':
+        from blockme.util.query_util import QueryService, QueryServer
+        kwargs = {}
+        if args.host:
+            kwargs['host'] = args.host
+        if args.port:
+            kwargs['port'] = args.port
+        QueryServer(QueryService(), **kwargs).start().thread.join()
+    elif args.command == 'benchmark':
+        from blockme.benchmarks.crawler_benchmark import run_benchmark
+        run_benchmark(
+            blocks=args.blocks,
+            transactions_per_block=args.transactions_per_block,
+            latency=args.latency,
+            db_url=args.db_url,
+            fixture_file=args.fixtures,
+            output=args.output,
+            receipts=args.receipts
+        )
+    else:
+        Crawler()
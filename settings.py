@@ -13,7 +13,133 @@ PG_HOST = os.environ.get('PG_HOST', 'localhost')
 PG_PORT = os.environ.get('PG_PORT', 5432)
 PG_DATABASE_NAME = os.environ.get('PG_DATABASE_NAME', 'dev')
 PG_DATABASE = f"postgresql://{PG_USERNAME}:{PG_PASSWORD}@{PG_HOST}:{PG_PORT}/{PG_DATABASE_NAME}"
+# Any SQLAlchemy URL; defaults to the PostgreSQL database above
+DATABASE_URL = os.environ.get('DATABASE_URL', PG_DATABASE)
+
+# How rows are loaded: 'orm' (batched SQLAlchemy inserts that skip existing rows)
+# or 'copy' (COPY FROM STDIN)
+DB_LOADER = os.environ.get('DB_LOADER', 'orm')
+
+# Connection pool shared by every database helper and worker thread in a
+# process: connections kept open, extra connections allowed under load,
+# seconds to wait for a free connection, and seconds after which an idle
+# connection is replaced
+DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', 10))
+DB_MAX_OVERFLOW = int(os.environ.get('DB_MAX_OVERFLOW', 10))
+DB_POOL_TIMEOUT = float(os.environ.get('DB_POOL_TIMEOUT', 30))
+DB_POOL_RECYCLE = int(os.environ.get('DB_POOL_RECYCLE', 1800))
 
 ETHEREUM_SCHEMA = 'ethereum'
 
 ETHEREUM_JSON_RPC_PORT = os.environ.get('RPC_PORT', 8545)
+# Path to geth.ipc; when set it is used instead of HTTP
+ETHEREUM_IPC_PATH = os.environ.get('IPC_PATH')
+ETHEREUM_RPC_BATCH_SIZE = int(os.environ.get('RPC_BATCH_SIZE', 100))
+
+# Comma separated geth endpoints (http(s):// URLs and/or IPC paths) to load
+# balance over; overrides RPC_PORT and IPC_PATH when set. Nodes are health
+# checked every RPC_HEALTH_INTERVAL seconds and taken out of rotation while
+# more than RPC_MAX_LAG blocks behind the best node
+ETHEREUM_RPC_ENDPOINTS = os.environ.get('RPC_ENDPOINTS')
+RPC_HEALTH_INTERVAL = float(os.environ.get('RPC_HEALTH_INTERVAL', 5))
+RPC_MAX_LAG = int(os.environ.get('RPC_MAX_LAG', 5))
+
+# Decode block responses incrementally as they arrive over HTTP, building
+# only the fields that are stored, so memory stays flat however large the
+# blocks are. Needs ijson; costs some CPU over decoding whole responses
+RPC_STREAM_PARSE = os.environ.get('RPC_STREAM_PARSE', '').lower() in ('1', 'true', 'yes')
+
+# Seconds before a request to geth times out, the number of concurrent
+# requests to start with, and the latency above which concurrency backs off
+RPC_TIMEOUT = float(os.environ.get('RPC_TIMEOUT', 30))
+RPC_INITIAL_CONCURRENCY = int(os.environ.get('RPC_INITIAL_CONCURRENCY', 2))
+RPC_LATENCY_TARGET = float(os.environ.get('RPC_LATENCY_TARGET', 2.0))
+
+# Retries for failed requests to geth, and the base of their jittered backoff
+RPC_RETRIES = int(os.environ.get('RPC_RETRIES', 3))
+RPC_RETRY_BACKOFF = float(os.environ.get('RPC_RETRY_BACKOFF', 0.1))
+
+CRAWLER_CHUNK_SIZE = int(os.environ.get('CRAWLER_CHUNK_SIZE', 1000))
+CRAWLER_FETCHERS = int(os.environ.get('CRAWLER_FETCHERS', 8))
+CRAWLER_DECODERS = int(os.environ.get('CRAWLER_DECODERS', 2))
+CRAWLER_MAX_IN_FLIGHT = int(os.environ.get('CRAWLER_MAX_IN_FLIGHT', 8))
+# Also fetch and store transaction receipts and event logs
+CRAWLER_RECEIPTS = os.environ.get('CRAWLER_RECEIPTS', '').lower() in ('1', 'true', 'yes')
+
+# Comma separated sinks decoded chunks are written to: 'database' (rows in
+# DATABASE_URL) and/or 'parquet' (files under PARQUET_DIR, split into
+# directories of PARQUET_PARTITION_SIZE blocks). Sync state is always kept
+# in the database
+CRAWLER_SINKS = os.environ.get('CRAWLER_SINKS', 'database')
+PARQUET_DIR = os.environ.get('PARQUET_DIR', 'data/parquet')
+PARQUET_PARTITION_SIZE = int(os.environ.get('PARQUET_PARTITION_SIZE', 1000000))
+PARQUET_COMPRESSION = os.environ.get('PARQUET_COMPRESSION', 'zstd')
+
+# Blocks that fail to fetch or insert are recorded in the failed_block
+# dead-letter table. At the end of a crawl (and with `runner.py
+# retry-failed`) those that have failed fewer than DEAD_LETTER_MAX_ATTEMPTS
+# times are re-fetched in chunks of DEAD_LETTER_CHUNK_SIZE blocks
+DEAD_LETTER_RETRY = os.environ.get('DEAD_LETTER_RETRY', '1').lower() in ('1', 'true', 'yes')
+DEAD_LETTER_MAX_ATTEMPTS = int(os.environ.get('DEAD_LETTER_MAX_ATTEMPTS', 5))
+DEAD_LETTER_CHUNK_SIZE = int(os.environ.get('DEAD_LETTER_CHUNK_SIZE', 10))
+
+# Keep the daily, sender and miner rollup tables up to date as chunks are
+# committed (disable for a bulk backfill and run `runner.py rebuild-rollups`)
+MAINTAIN_ROLLUPS = os.environ.get('MAINTAIN_ROLLUPS', '1').lower() in ('1', 'true', 'yes')
+
+# Address -> id mappings kept in memory by each database helper
+ADDRESS_CACHE_SIZE = int(os.environ.get('ADDRESS_CACHE_SIZE', 500000))
+
+# Blocks per partition when new block/transaction tables are created as
+# range-partitioned tables (PostgreSQL 12+); 0 creates plain tables
+PARTITION_SIZE = int(os.environ.get('PARTITION_SIZE', 0))
+
+# Bulk-load mode: drop secondary indexes and foreign keys for the crawl and
+# rebuild them at the end with INDEX_BUILD_WORKERS parallel connections,
+# each allowed INDEX_BUILD_MEMORY of maintenance_work_mem
+BULK_LOAD = os.environ.get('BULK_LOAD', '').lower() in ('1', 'true', 'yes')
+INDEX_BUILD_WORKERS = int(os.environ.get('INDEX_BUILD_WORKERS', 4))
+INDEX_BUILD_MEMORY = os.environ.get('INDEX_BUILD_MEMORY', '1GB')
+
+# Number of block numbers scanned per query when looking for missing blocks
+GAP_SCAN_WINDOW = int(os.environ.get('GAP_SCAN_WINDOW', 1000000))
+
+# Chain verification (`runner.py verify`): blocks checked per query, queries
+# run in parallel, and stored blocks spot-checked against geth
+VERIFY_WINDOW = int(os.environ.get('VERIFY_WINDOW', 100000))
+VERIFY_WORKERS = int(os.environ.get('VERIFY_WORKERS', 4))
+VERIFY_SAMPLE_SIZE = int(os.environ.get('VERIFY_SAMPLE_SIZE', 1000))
+
+# Sharded backfill: worker processes, blocks per leased range and lease timeout
+CRAWLER_WORKERS = int(os.environ.get('CRAWLER_WORKERS', 1))
+LEASE_SIZE = int(os.environ.get('LEASE_SIZE', 100000))
+LEASE_SECONDS = int(os.environ.get('LEASE_SECONDS', 600))
+
+# Raw block archive: directory (unset disables archiving), blocks per
+# segment file and zlib compression level
+ARCHIVE_DIR = os.environ.get('ARCHIVE_DIR')
+ARCHIVE_SEGMENT_SIZE = int(os.environ.get('ARCHIVE_SEGMENT_SIZE', 100000))
+ARCHIVE_COMPRESSION_LEVEL = int(os.environ.get('ARCHIVE_COMPRESSION_LEVEL', 6))
+
+# Follow mode: seconds between polls for a new head, the deepest reorg
+# that is rolled back automatically, and the longest wait between polls
+# while geth is unreachable (the wait doubles from the poll interval)
+FOLLOW_POLL_INTERVAL = float(os.environ.get('FOLLOW_POLL_INTERVAL', 0.5))
+FOLLOW_MAX_REORG_DEPTH = int(os.environ.get('FOLLOW_MAX_REORG_DEPTH', 128))
+FOLLOW_MAX_BACKOFF = float(os.environ.get('FOLLOW_MAX_BACKOFF', 30))
+
+# Read API (`runner.py serve`): entries kept in each of its caches, seconds
+# before a cached entry is looked up again, and the address it listens on
+QUERY_CACHE_SIZE = int(os.environ.get('QUERY_CACHE_SIZE', 10000))
+QUERY_CACHE_TTL = float(os.environ.get('QUERY_CACHE_TTL', 30))
+QUERY_API_HOST = os.environ.get('QUERY_API_HOST', '127.0.0.1')
+QUERY_API_PORT = int(os.environ.get('QUERY_API_PORT', 8000))
+
+# Metrics: Prometheus text endpoint port and/or JSON stats file (unset
+# disables each), the stats file refresh interval, and a comma separated
+# list of stages to run under cProfile (e.g. "rpc_seconds,decode_seconds")
+METRICS_PORT = os.environ.get('METRICS_PORT')
+METRICS_FILE = os.environ.get('METRICS_FILE')
+METRICS_INTERVAL = float(os.environ.get('METRICS_INTERVAL', 10))
+PROFILE_STAGES = os.environ.get('PROFILE_STAGES', '')
+PROFILE_DIR = os.environ.get('PROFILE_DIR', 'logs/profiles')